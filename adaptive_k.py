@@ -0,0 +1,129 @@
+# adaptive_k.py
+"""検索結果の件数を距離に応じて決める (adaptive-k) と、その閾値のオフライン較正
+
+較正の使い方: python adaptive_k.py <persist_directory> [--percentile 90]
+"""
+import os
+import json
+import time
+import argparse
+import threading
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+QUERY_LOG_FILE = 'query_log.jsonl'
+CALIBRATION_FILE = 'adaptive_k.json'
+DEFAULT_MIN_K = 2
+DEFAULT_MAX_K = 8
+DEFAULT_PERCENTILE = 90
+# 最大の差がこの割合 (距離の範囲に対して) より小さければ、はっきりした切れ目はないとみなす
+MIN_RELATIVE_GAP = 0.2
+
+_log_lock = threading.Lock()
+
+def gap_cutoff(distances, min_k=DEFAULT_MIN_K):
+    """昇順の距離から、min_k 件目以降で差が最も大きい位置の手前の距離を返す。切れ目がなければ None"""
+    distances = np.asarray(distances, dtype=np.float64)
+    if len(distances) <= min_k:
+        return None
+    gaps = np.diff(distances)[max(min_k - 1, 0):]
+    spread = distances[-1] - distances[0]
+    if len(gaps) == 0 or spread <= 0:
+        return None
+    best = int(np.argmax(gaps))
+    if gaps[best] < MIN_RELATIVE_GAP * spread:
+        return None
+    return float(distances[max(min_k - 1, 0) + best])
+
+def select_adaptive(results, min_k=DEFAULT_MIN_K, max_k=DEFAULT_MAX_K, threshold=None):
+    """距離が threshold 以下の結果を、threshold がなければ距離の最大の切れ目までの結果を、元の順序のまま返す
+
+    常に min_k 件以上 max_k 件以下にする。距離のない結果 (ハイブリッド検索の語彙検索だけの一致) は残す
+    """
+    results = results[:max_k]
+    distances = np.array([result['distance'] for result in results], dtype=np.float64)
+    finite = np.sort(distances[np.isfinite(distances)])
+    cutoff = threshold if threshold is not None else gap_cutoff(finite, min_k)
+    if cutoff is None:
+        return results
+    selected = [result for i, result in enumerate(results)
+                if i < min_k or not np.isfinite(distances[i]) or distances[i] <= cutoff]
+    logger.info(f"adaptive-k: {len(results)} 件中 {len(selected)} 件を使用します (距離の上限: {cutoff:.4f})")
+    return selected
+
+def log_query(persist_directory, query, results):
+    """較正用に、クエリと取得した結果の距離を query_log.jsonl に追記する"""
+    entry = {
+        'time': time.time(),
+        'query': query,
+        'distances': [None if not np.isfinite(result['distance']) else float(result['distance']) for result in results],
+        'chunk_ids': [result.get('chunk_id') for result in results]
+    }
+    with _log_lock:
+        with open(os.path.join(persist_directory, QUERY_LOG_FILE), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+def load_calibration(persist_directory):
+    calibration_file = os.path.join(persist_directory, CALIBRATION_FILE)
+    if not os.path.exists(calibration_file):
+        return None
+    try:
+        with open(calibration_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"adaptive-k の較正ファイルの読み込み中にエラーが発生しました: {calibration_file}, エラー: {str(e)}")
+        return None
+
+def calibrate(persist_directory, percentile=DEFAULT_PERCENTILE, min_k=DEFAULT_MIN_K):
+    """クエリログから距離の閾値を求めて adaptive_k.json に保存する
+
+    各クエリで最大の切れ目より手前にある (関連が強いとみなせる) 結果の距離を集め、その percentile を閾値とする
+    """
+    log_file = os.path.join(persist_directory, QUERY_LOG_FILE)
+    if not os.path.exists(log_file):
+        raise FileNotFoundError(f"クエリログが見つかりません: {log_file}")
+    relevant = []
+    queries = 0
+    with open(log_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                distances = [d for d in json.loads(line)['distances'] if d is not None]
+            except (ValueError, KeyError):
+                continue
+            if not distances:
+                continue
+            queries += 1
+            distances = np.sort(np.array(distances, dtype=np.float64))
+            cutoff = gap_cutoff(distances, min_k)
+            relevant.extend(distances[distances <= cutoff] if cutoff is not None else distances[:min_k])
+    if not relevant:
+        raise ValueError(f"較正に使える距離がクエリログにありません: {log_file}")
+
+    calibration = {
+        'threshold': float(np.percentile(relevant, percentile)),
+        'percentile': percentile,
+        'queries': queries,
+        'samples': len(relevant),
+        'created_at': time.time()
+    }
+    temp_file = os.path.join(persist_directory, f"{CALIBRATION_FILE}.tmp")
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(calibration, f, ensure_ascii=False, indent=2)
+    os.replace(temp_file, os.path.join(persist_directory, CALIBRATION_FILE))
+    logger.info(f"adaptive-k の閾値を較正しました: {calibration}")
+    return calibration
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="クエリログから adaptive-k の距離の閾値を較正します")
+    parser.add_argument('persist_directory', help="クエリログ (query_log.jsonl) のあるデータソースのディレクトリ")
+    parser.add_argument('--percentile', type=float, default=DEFAULT_PERCENTILE)
+    parser.add_argument('--min-k', type=int, default=DEFAULT_MIN_K)
+    args = parser.parse_args()
+    calibration = calibrate(args.persist_directory, args.percentile, args.min_k)
+    print(json.dumps(calibration, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -14,30 +14,54 @@ class AIModelManager:
         self.system_message = config.get('system_message', "You are a helpful AI assistant.")
         self.conversation_history = []
 
-    def generate_response(self, messages, new_user_input):
+    def _build_messages(self, messages, new_user_input, history=None):
         full_messages = [SystemMessage(content=self.system_message)]
-        full_messages.extend(self.conversation_history)
+        full_messages.extend(self.conversation_history if history is None else history)
         full_messages.extend(messages)
         full_messages.append(HumanMessage(content=new_user_input))
+        return full_messages
+
+    def generate_response(self, messages, new_user_input, history=None):
+        """history を渡すと、保持している会話履歴の代わりにそれをプロンプトに入れる"""
+        full_messages = self._build_messages(messages, new_user_input, history)
         
         logger.info(f"生成する質問: {new_user_input}")
         try:
             response = self.llm.invoke(full_messages)
             logger.info(f"生成された応答:\n{response.content}")
-            
-            # 会話履歴を更新
-            self.conversation_history.append(HumanMessage(content=new_user_input))
-            self.conversation_history.append(AIMessage(content=response.content))
-            
-            # 会話履歴が長くなりすぎないように制限
-            if len(self.conversation_history) > 10:  # 例えば、最新の5往復だけを保持
-                self.conversation_history = self.conversation_history[-10:]
-            
+            self.add_to_history(new_user_input, response.content)
             return response.content
         except Exception as e:
             logger.error(f"応答生成中にエラーが発生しました: {str(e)}", exc_info=True)
             return f"申し訳ありません。回答の生成中にエラーが発生しました。: {str(e)}"
 
+    def stream_response(self, messages, new_user_input, history=None):
+        """応答をトークンが届くたびに yield する。最後まで受信したら会話履歴に追加する"""
+        full_messages = self._build_messages(messages, new_user_input, history)
+        
+        logger.info(f"生成する質問 (ストリーミング): {new_user_input}")
+        chunks = []
+        try:
+            for chunk in self.llm.stream(full_messages):
+                if chunk.content:
+                    chunks.append(chunk.content)
+                    yield chunk.content
+        except Exception as e:
+            logger.error(f"応答のストリーミング中にエラーが発生しました: {str(e)}", exc_info=True)
+            yield f"申し訳ありません。回答の生成中にエラーが発生しました。: {str(e)}"
+            return
+        response_content = "".join(chunks)
+        logger.info(f"生成された応答:\n{response_content}")
+        self.add_to_history(new_user_input, response_content)
+
+    def add_to_history(self, user_input, response_content):
+        self.conversation_history.append(HumanMessage(content=user_input))
+        self.conversation_history.append(AIMessage(content=response_content))
+
+        # 会話履歴が長くなりすぎないように制限
+        if len(self.conversation_history) > 10:  # 例えば、最新の5往復だけを保持
+            self.conversation_history = self.conversation_history[-10:]
+
 def create_output_parser():
     response_schemas = [
         ResponseSchema(name="answer", description="The main answer to the user's question"),
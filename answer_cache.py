@@ -0,0 +1,123 @@
+# answer_cache.py
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ANSWER_CACHE_FILE = 'answer_cache.sqlite3'
+DEFAULT_SIMILARITY_THRESHOLD = 0.95
+DEFAULT_MAX_ENTRIES = 1000
+
+def context_key(custom_role, filters=None, history=None):
+    """回答に影響する検索以外の条件 (役割・検索フィルタ・会話履歴) をまとめたキー
+
+    会話履歴がある場合は同じ質問でも回答が変わりうるため、同じ履歴のときだけ一致する
+    """
+    history_digest = hashlib.sha256(
+        json.dumps([[type(message).__name__, message.content] for message in history or []], ensure_ascii=False).encode('utf-8')
+    ).hexdigest() if history else ''
+    payload = json.dumps({'role': custom_role or '', 'filters': filters or {}, 'history': history_digest},
+                         ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32).ravel()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+class SemanticAnswerCache:
+    """データソースごとの回答キャッシュ。クエリのエンベディングが閾値以上に似ていれば、以前の回答を返す
+
+    エントリは作成時のインデックスのバージョンと一緒に保存し、バージョンが変わったもの
+    (インデックスの再構築・差分更新・削除) は読み込み時に削除する
+    """
+
+    def __init__(self, db_path, threshold=DEFAULT_SIMILARITY_THRESHOLD, max_entries=DEFAULT_MAX_ENTRIES):
+        self.db_path = db_path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                index_version TEXT NOT NULL,
+                context_key TEXT NOT NULL,
+                query TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self._conn.commit()
+        self._version = None
+        self._entries = None
+
+    @classmethod
+    def for_directory(cls, persist_directory, **kwargs):
+        os.makedirs(persist_directory, exist_ok=True)
+        return cls(os.path.join(persist_directory, ANSWER_CACHE_FILE), **kwargs)
+
+    def _load(self, index_version):
+        """index_version のエントリを (id, context_key, エンベディング行列) として読み込み、古いバージョンのエントリを削除する"""
+        if self._version == index_version and self._entries is not None:
+            return self._entries
+        removed = self._conn.execute("DELETE FROM answers WHERE index_version != ?", (index_version,)).rowcount
+        self._conn.commit()
+        if removed:
+            logger.info(f"インデックスが更新されたため、回答キャッシュを {removed} 件削除しました: {self.db_path}")
+        rows = self._conn.execute(
+            "SELECT id, context_key, embedding FROM answers WHERE index_version = ? ORDER BY id", (index_version,)
+        ).fetchall()
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        keys = np.array([row[1] for row in rows], dtype=object)
+        vectors = (np.vstack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+                   if rows else np.empty((0, 0), dtype=np.float32))
+        self._version = index_version
+        self._entries = (ids, keys, vectors)
+        return self._entries
+
+    def lookup(self, query_vector, index_version, context):
+        """似たクエリの回答があれば (回答, 類似度) を、なければ (None, 最大の類似度) を返す"""
+        query_vector = _normalize(query_vector)
+        with self._lock:
+            ids, keys, vectors = self._load(index_version)
+            if len(ids) == 0 or vectors.shape[1] != len(query_vector):
+                return None, 0.0
+            similarities = vectors @ query_vector
+            similarities[keys != context] = -1.0
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.threshold:
+                return None, similarity
+            row = self._conn.execute("SELECT query, response FROM answers WHERE id = ?", (int(ids[best]),)).fetchone()
+        if row is None:
+            return None, similarity
+        logger.info(f"回答キャッシュにヒットしました (類似度: {similarity:.4f}, 元のクエリ: {row[0]})")
+        return json.loads(row[1]), similarity
+
+    def store(self, query, query_vector, index_version, context, response):
+        query_vector = _normalize(query_vector)
+        with self._lock:
+            self._load(index_version)
+            cursor = self._conn.execute(
+                "INSERT INTO answers (index_version, context_key, query, embedding, response, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (index_version, context, query, query_vector.tobytes(), json.dumps(response, ensure_ascii=False, default=str), time.time()))
+            # 上限を超えた分は古いものから削除する
+            self._conn.execute(
+                "DELETE FROM answers WHERE id NOT IN (SELECT id FROM answers ORDER BY id DESC LIMIT ?)", (self.max_entries,))
+            self._conn.commit()
+            self._entries = None
+            logger.info(f"回答キャッシュに保存しました: id={cursor.lastrowid}")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
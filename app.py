@@ -2,7 +2,7 @@
 import streamlit as st
 from config import load_config
 from chat_processing import process_user_input
-from ui_components import set_page_config, display_custom_css, display_sidebar_info, display_chat_interface, display_main_title
+from ui_components import set_page_config, display_custom_css, display_sidebar_info, display_chat_interface, display_main_title, display_search_filters
 import logging
 from database import DatabaseManager
 from data_sources import FileDataSource, WebDataSource, NotionDataSource
@@ -95,6 +95,7 @@ def main():
 
     # サイドバーの情報表示
     display_sidebar_info(config)
+    st.session_state.search_filters = display_search_filters(reference_type)
 
     if st.sidebar.button("詳細なデバッグ情報を表示"):
         st.sidebar.json(selected_source_config)
@@ -116,8 +117,8 @@ def main():
             df, index, default_role, embeddings, message = st.session_state.db_manager.load_or_create_db(selected_source_config)
     
             if df is None or index is None:
-                logger.error("データベースの読み込みに失敗しました")
-                st.error("データベースの読み込みに失敗しました。詳細はログを確認してください。")
+                logger.error(f"データベースの読み込みに失敗しました: {message}")
+                st.error(f"データベースの読み込みに失敗しました。詳細はログを確認してください。: {message}")
                 return
             st.session_state.df = df
             st.session_state.index = index
@@ -143,7 +144,7 @@ def main():
     if 'input_key' not in st.session_state:
         st.session_state.input_key = 0
 
-    user_input, send_button = display_chat_interface(
+    user_input, send_button, pending_container = display_chat_interface(
         st.session_state.messages,
         st.session_state.data_source,
         reference_type,
@@ -152,7 +153,8 @@ def main():
     )
 
     if send_button and user_input:
-        process_user_input(user_input, st.session_state.df, st.session_state.index, st.session_state.embeddings, config, st.session_state.data_source)
+        process_user_input(user_input, st.session_state.df, st.session_state.index, st.session_state.embeddings, config, st.session_state.data_source,
+                           chat_container=pending_container)
         st.session_state.input_key += 1
         st.session_state.conversation_count += 1
         st.rerun()
@@ -0,0 +1,91 @@
+# build_checkpoint.py
+import os
+import json
+import time
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+BUILD_STATUS_FILE = 'build_status.json'
+
+# 進捗の書き込み間隔 (秒)
+STATUS_WRITE_INTERVAL = 5.0
+
+def load_build_status(persist_directory):
+    status_file = os.path.join(persist_directory, BUILD_STATUS_FILE)
+    try:
+        if os.path.exists(status_file):
+            with open(status_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+    except Exception as e:
+        logger.error(f"構築ステータスの読み込み中にエラーが発生しました: {status_file}, エラー: {str(e)}")
+    return None
+
+class BuildCheckpoint:
+    """インデックス構築の進捗と失敗を persist_directory の build_status.json に記録する
+
+    完了したバッチのベクトルはチャンク本文のハッシュ (チャンクID) をキーに EmbeddingCache へ
+    バッチごとにコミットされるため、中断後の再実行では未完了のチャンクだけがAPIに送られる。
+    """
+
+    def __init__(self, persist_directory, operation):
+        self.persist_directory = persist_directory
+        self.status_file = os.path.join(persist_directory, BUILD_STATUS_FILE)
+        self.operation = operation
+        self.status = {}
+        self._last_write = 0.0
+
+    def previous_status(self):
+        return load_build_status(self.persist_directory)
+
+    def _write(self):
+        self.status['updated_at'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        temp_file = f"{self.status_file}.tmp"
+        try:
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.status, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, self.status_file)
+            self._last_write = time.monotonic()
+        except Exception as e:
+            logger.error(f"構築ステータスの保存中にエラーが発生しました: {self.status_file}, エラー: {str(e)}")
+
+    def start(self, total_chunks, completed_chunks=0):
+        previous = self.previous_status()
+        if previous and previous.get('state') in ('running', 'failed'):
+            logger.info(f"前回の構築が未完了のため、チェックポイントから再開します: "
+                        f"{previous.get('completed_chunks')}/{previous.get('total_chunks')} ({previous.get('state')})")
+        self.status = {
+            'operation': self.operation,
+            'state': 'running',
+            'total_chunks': total_chunks,
+            'completed_chunks': completed_chunks,
+            'resumed_chunks': completed_chunks,
+            'started_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'error': None
+        }
+        self._write()
+
+    def update(self, completed_chunks, total_chunks=None):
+        self.status['completed_chunks'] = completed_chunks
+        if total_chunks is not None:
+            self.status['total_chunks'] = total_chunks
+        if time.monotonic() - self._last_write >= STATUS_WRITE_INTERVAL:
+            self._write()
+
+    def fail(self, error):
+        self.status['state'] = 'failed'
+        self.status['error'] = str(error)
+        self._write()
+        logger.error(f"構築が失敗しました。次回の読み込み時に再開します: {self.status_file}")
+
+    def complete(self):
+        self.status['state'] = 'completed'
+        self.status['completed_chunks'] = self.status.get('total_chunks', 0)
+        self._write()
+
+    def failure_message(self):
+        return (f"ベクトルの生成が途中で失敗しました ({self.status.get('completed_chunks', 0)}/"
+                f"{self.status.get('total_chunks', 0)})。次回の読み込み時に続きから再開します: {self.status.get('error')}")
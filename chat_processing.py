@@ -1,49 +1,106 @@
 #chat_processing.py
 import streamlit as st
 import logging
-from response_processor import process_response
+from response_processor import process_response, process_response_stream, format_response
 from database import search_db
+from answer_cache import context_key
+from adaptive_k import select_adaptive, log_query, load_calibration
 from ai_models import AIModelManager
+from ui_components import chat_message_html
 
 logger = logging.getLogger(__name__)
 
-def process_user_input(user_input, df, index, embeddings, config, data_source):
+def process_user_input(user_input, df, index, embeddings, config, data_source, chat_container=None):
+    """chat_container を渡すと、送信したメッセージと受信中の回答を会話の末尾に表示する"""
     logger.info("process_user_input が呼び出されました")
     st.session_state.messages.append({"role": "user", "content": user_input})
+    if chat_container is None:
+        chat_container = st.container()
+    chat_container.markdown(chat_message_html('user', user_input), unsafe_allow_html=True)
     
     if 'ai_manager' not in st.session_state:
         st.session_state.ai_manager = AIModelManager(config)
     
+    db_manager = st.session_state.db_manager
+    source_config = data_source.source_config
+    filters = st.session_state.get('search_filters')
+
+    answer_cache = cached_response = None
     try:
-        search_results = search_db(user_input, df, index, embeddings)
-        logger.info(f"検索結果: {len(search_results)} 件")
+        answer_cache = db_manager.get_answer_cache(source_config)
+        if answer_cache is not None:
+            # クエリのエンベディングはキャッシュされるため、search_db で再び API を呼ぶことはない
+            query_vector = embeddings.embed_query(user_input)
+            version = db_manager.get_index_version(source_config)
+            cache_context = context_key(st.session_state.custom_role, filters,
+                                        st.session_state.ai_manager.conversation_history)
+            cached_response, _ = answer_cache.lookup(query_vector, version, cache_context)
     except Exception as e:
-        logger.error(f"search_db でエラーが発生しました: {e}")
-        st.error("検索中にエラーが発生しました")
-        return
-    
-    with st.spinner('回答を生成中...'):
+        logger.error(f"回答キャッシュの参照中にエラーが発生しました: {e}", exc_info=True)
+        answer_cache = None
+
+    if cached_response is not None:
+        processed_response = cached_response
+        st.session_state.ai_manager.add_to_history(user_input, processed_response['answer'])
+    else:
         try:
-            processed_response = process_response(user_input, search_results, config, st.session_state.custom_role, st.session_state.ai_manager)
+            metadata_index = vector_sidecar = lexical_index = None
+            if filters:
+                metadata_index = db_manager.get_metadata_index(source_config, df)
+            persist_directory = source_config.get('persist_directory') or source_config.get('persist_directory_web')
+            if filters or config.get('mmr', False):
+                vector_sidecar = db_manager.get_vector_sidecar(persist_directory)
+            adaptive = config.get('adaptive_k', False)
+            # adaptive-k では max_k 件まで取得してから、距離に応じて件数を絞る
+            k = config.get('adaptive_max_k', 8) if adaptive else 5
+            if config.get('hybrid_search', False):
+                lexical_index = db_manager.get_lexical_index(source_config, df)
+            search_results = search_db(user_input, df, index, embeddings, k=k, filters=filters,
+                                       metadata_index=metadata_index, vector_sidecar=vector_sidecar,
+                                       lexical_index=lexical_index, rrf_k=config.get('rrf_k', 60),
+                                       lexical_k=config.get('lexical_k', 50), mmr=config.get('mmr', False),
+                                       mmr_lambda=config.get('mmr_lambda', 0.5), mmr_fetch_k=config.get('mmr_fetch_k', 20))
+            if config.get('query_log', False):
+                # ログの書き込みに失敗しても回答は続ける
+                try:
+                    log_query(persist_directory, user_input, search_results)
+                except Exception as e:
+                    logger.error(f"クエリログの書き込み中にエラーが発生しました: {e}", exc_info=True)
+            if adaptive:
+                calibration = load_calibration(persist_directory) or {}
+                search_results = select_adaptive(search_results, config.get('adaptive_min_k', 2), k,
+                                                 calibration.get('threshold'))
+            logger.info(f"検索結果: {len(search_results)} 件")
+        except Exception as e:
+            logger.error(f"search_db でエラーが発生しました: {e}")
+            st.error("検索中にエラーが発生しました")
+            return
+
+        try:
+            if config.get('stream_responses', True):
+                # 受信した項目から順に表示し、最初のトークンが届いた時点で回答を見せ始める
+                placeholder = chat_container.empty()
+                processed_response = process_response_stream(
+                    user_input, search_results, config, st.session_state.custom_role, st.session_state.ai_manager,
+                    on_update=lambda fields: placeholder.markdown(chat_message_html('assistant', format_response(fields)),
+                                                                  unsafe_allow_html=True))
+            else:
+                with st.spinner('回答を生成中...'):
+                    processed_response = process_response(user_input, search_results, config, st.session_state.custom_role, st.session_state.ai_manager)
             logger.info("回答が正常に生成されました")
         except Exception as e:
             logger.error(f"process_response でエラーが発生しました: {e}")
             st.error("回答の生成中にエラーが発生しました")
             return
+
+        # 構造化できなかった回答 (生成エラーを含む) はキャッシュしない
+        if answer_cache is not None and (processed_response["sources"] or processed_response["important_points"]):
+            try:
+                answer_cache.store(user_input, query_vector, version, cache_context, processed_response)
+            except Exception as e:
+                logger.error(f"回答キャッシュの保存中にエラーが発生しました: {e}", exc_info=True)
     
-    response = f"{processed_response['answer']}\n\n"
-    
-    if processed_response["important_points"]:
-        response += "**重要ポイント:**\n"
-        for point in processed_response["important_points"]:
-            response += f"- {point}\n"
-        response += "\n"
-    
-    if processed_response["additional_info"]:
-        response += f"**補足情報:**\n{processed_response['additional_info']}\n\n"
-    
-    if processed_response["sources"]:
-        response += f"**参照元:**\n{processed_response['sources']}"
+    response = format_response(processed_response)
     
     st.session_state.messages.append({
         "role": "assistant", 
@@ -0,0 +1,111 @@
+# chunk_store.py
+import os
+import uuid
+import logging
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+CHUNK_STORE_SUFFIX = '.arrow'
+# チャンクストアに含めない列 (ベクトルはFAISSインデックス側に持つ)
+EXCLUDED_COLUMNS = ('embedding',)
+CONVERT_BATCH_SIZE = 8192
+
+def chunk_store_path(parquet_file):
+    return os.path.splitext(parquet_file)[0] + CHUNK_STORE_SUFFIX
+
+def is_chunk_store_stale(parquet_file, store_file):
+    return not os.path.exists(store_file) or os.path.getmtime(store_file) < os.path.getmtime(parquet_file)
+
+def write_chunk_store(parquet_file, store_file, batch_size=CONVERT_BATCH_SIZE):
+    """Parquetをバッチごとに読み、メモリマップで読めるよう非圧縮のArrow IPCファイルに書き出す"""
+    temp_file = f"{store_file}.{uuid.uuid4().hex}.tmp"
+    try:
+        parquet = pq.ParquetFile(parquet_file)
+        columns = [name for name in parquet.schema_arrow.names if name not in EXCLUDED_COLUMNS]
+        schema = pa.schema([parquet.schema_arrow.field(name) for name in columns])
+        rows = 0
+        with pa.OSFile(temp_file, 'wb') as sink:
+            with ipc.new_file(sink, schema) as writer:
+                for batch in parquet.iter_batches(batch_size=batch_size, columns=columns):
+                    writer.write_batch(batch)
+                    rows += batch.num_rows
+        os.replace(temp_file, store_file)
+        logger.info(f"チャンクストアを作成しました: {store_file} ({rows} 行)")
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+def open_chunk_store(parquet_file, tombstones=None):
+    """Parquetより古ければ作り直してからチャンクストアを開く。作り直せない場合は None を返す"""
+    store_file = chunk_store_path(parquet_file)
+    try:
+        if is_chunk_store_stale(parquet_file, store_file):
+            write_chunk_store(parquet_file, store_file)
+        return ChunkStore(store_file, tombstones)
+    except Exception as e:
+        # Windowsでは他のセッションがメモリマップ中のファイルを置き換えられない
+        logger.error(f"チャンクストアを開けませんでした: {store_file}, エラー: {str(e)}", exc_info=True)
+        return None
+
+class ChunkStore:
+    """Arrow IPCファイルをメモリマップし、検索結果の行だけをコピーせずに取り出すチャンクストア
+
+    本文はOSのページキャッシュ上に置かれ、同じソースを開く複数のセッション・プロセスで共有される
+    """
+
+    def __init__(self, file_path, tombstones=None):
+        self.file_path = file_path
+        self._source = pa.memory_map(file_path, 'r')
+        self.table = ipc.open_file(self._source).read_all()
+        self.chunk_ids = None
+        self._id_index = None
+        if 'chunk_id' in self.table.column_names:
+            self.chunk_ids = self.table.column('chunk_id').to_numpy().astype(np.int64, copy=False)
+            self._id_index = pd.Index(self.chunk_ids)
+        self._live = None
+        if tombstones is not None and len(tombstones) > 0 and self.chunk_ids is not None:
+            self._live = ~np.isin(self.chunk_ids, tombstones)
+        logger.info(f"チャンクストアをメモリマップで開きました: {file_path} ({len(self)} 行)")
+
+    @property
+    def columns(self):
+        return self.table.column_names
+
+    @property
+    def live_mask(self):
+        """削除済み (tombstone) でない行は True。削除済みの行がなければ None"""
+        return self._live
+
+    def __len__(self):
+        if self._live is not None:
+            return int(self._live.sum())
+        return self.table.num_rows
+
+    def positions_for_ids(self, ids):
+        """FAISSのIDを行位置に変換する (見つからないIDと削除済みのIDは-1)"""
+        ids = np.asarray(ids, dtype=np.int64)
+        if self._id_index is None:
+            positions = ids.copy()
+            positions[positions >= self.table.num_rows] = -1
+        else:
+            positions = self._id_index.get_indexer(ids)
+        if self._live is not None:
+            found = positions >= 0
+            positions[found] = np.where(self._live[positions[found]], positions[found], -1)
+        return positions
+
+    def take(self, positions):
+        """指定した行位置の行だけをデータフレームとして取り出す"""
+        rows = self.table.take(pa.array(np.asarray(positions, dtype=np.int64))).to_pandas()
+        if 'page' in rows.columns:
+            rows['page'] = rows['page'].astype(str)
+        return rows
+
+    def info(self):
+        return (f"ChunkStore: {self.file_path}, 行数: {len(self)} / {self.table.num_rows}, "
+                f"列: {self.columns}, サイズ: {self.table.nbytes} bytes (メモリマップ)")
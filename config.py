@@ -8,6 +8,38 @@ import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+def load_rate_limits(config):
+    # [RateLimits] の各行は「モデル名 = リクエスト数/分, トークン数/分」
+    rate_limits = {}
+    if config.has_section('RateLimits'):
+        for model, value in config['RateLimits'].items():
+            try:
+                requests_per_minute, tokens_per_minute = (int(v.strip()) for v in value.split(','))
+                rate_limits[model] = (requests_per_minute, tokens_per_minute)
+            except ValueError:
+                logger.error(f"RateLimits の設定が不正です: {model} = {value}")
+    return rate_limits
+
+def load_context_budgets(config):
+    # [ContextBudget] の各行は「モデル名 = プロンプトのトークン数の上限」。default は記載のないモデルに使う
+    budgets = {}
+    if config.has_section('ContextBudget'):
+        for model, value in config['ContextBudget'].items():
+            try:
+                budgets[model] = int(value)
+            except ValueError:
+                logger.error(f"ContextBudget の設定が不正です: {model} = {value}")
+    return budgets
+
+def load_index_options(config):
+    # [Index] の値は未指定なら None とし、ベクトル数から自動で決める
+    options = {}
+    for key in ('nlist', 'nprobe', 'pq_m', 'pq_nbits', 'hnsw_m', 'ef_construction', 'ef_search'):
+        options[key] = config.getint('Index', key, fallback=None)
+    # none / fp16 / sq8 / pq
+    options['quantization'] = config.get('Index', 'quantization', fallback=None)
+    return options
+
 def load_config():
     config = configparser.ConfigParser()
     config.read('settings.ini', encoding='utf-8')
@@ -34,10 +66,47 @@ def load_config():
         'openai_model': config['API']['openai_model'],
         'embeddings_model': config['API']['embeddings_model'],
         'temperature': float(config['ChatBot']['temperature']),
+        'stream_responses': config.getboolean('ChatBot', 'stream', fallback=True),
+        'context_budgets': load_context_budgets(config),
+        'context_history_ratio': config.getfloat('ChatBot', 'history_ratio', fallback=0.25),
         'max_depth': int(config['WebScraper']['max_depth']),
         'data_sources': [],
         'system_message': "あなたは親切で知識豊富なAIアシスタントです。ユーザーの質問に対して、提供された情報源に基づいて日本語で回答してください。",
-        'notion_token': config['Notion']['Notion_token']  # Notion API トークンを追加
+        'notion_token': config['Notion']['Notion_token'],  # Notion API トークンを追加
+        'rate_limits': load_rate_limits(config),
+        'embedding_max_in_flight': config.getint('Embeddings', 'max_in_flight', fallback=4),
+        'embeddings_base_url': config.get('Embeddings', 'base_url', fallback=None),
+        'embedding_batch_max_tokens': config.getint('Embeddings', 'batch_max_tokens', fallback=300000),
+        'embedding_batch_max_inputs': config.getint('Embeddings', 'batch_max_inputs', fallback=2048),
+        'embedding_max_input_tokens': config.getint('Embeddings', 'max_input_tokens', fallback=8191),
+        'embedding_dimensions': config.getint('Embeddings', 'dimensions', fallback=None),
+        'query_cache_size': config.getint('Embeddings', 'query_cache_size', fallback=1024),
+        'query_cache_file': config.get('Embeddings', 'query_cache_file', fallback=None),
+        'index_type': config.get('Index', 'type', fallback='auto'),
+        'index_options': load_index_options(config),
+        'index_mmap': config.getboolean('Index', 'mmap', fallback=os.name != 'nt'),
+        'vector_dtype': config.get('Index', 'vector_dtype', fallback='float32'),
+        'chunk_store_format': config.get('Index', 'chunk_store', fallback='parquet'),
+        'compaction_tombstone_ratio': config.getfloat('Index', 'compaction_tombstone_ratio', fallback=0.2),
+        'hybrid_search': config.getboolean('Search', 'hybrid', fallback=False),
+        'rrf_k': config.getint('Search', 'rrf_k', fallback=60),
+        'lexical_k': config.getint('Search', 'lexical_k', fallback=50),
+        'mmr': config.getboolean('Search', 'mmr', fallback=False),
+        'mmr_lambda': config.getfloat('Search', 'mmr_lambda', fallback=0.5),
+        'mmr_fetch_k': config.getint('Search', 'mmr_fetch_k', fallback=20),
+        'adaptive_k': config.getboolean('Search', 'adaptive_k', fallback=False),
+        'adaptive_min_k': config.getint('Search', 'min_k', fallback=2),
+        'adaptive_max_k': config.getint('Search', 'max_k', fallback=8),
+        'query_log': config.getboolean('Search', 'query_log', fallback=False),
+        'answer_cache': config.getboolean('AnswerCache', 'enabled', fallback=False),
+        'answer_cache_threshold': config.getfloat('AnswerCache', 'threshold', fallback=0.95),
+        'answer_cache_size': config.getint('AnswerCache', 'max_entries', fallback=1000),
+        'file_hash_algorithm': config.get('Files', 'hash_algorithm', fallback='md5'),
+        'file_hash_workers': config.getint('Files', 'hash_workers', fallback=None),
+        'parse_workers': config.getint('Files', 'parse_workers', fallback=None),
+        'parse_timeout': config.getint('Files', 'parse_timeout', fallback=300),
+        'ingest_prefetch_size': config.getint('Files', 'ingest_prefetch_size', fallback=32),
+        'ingest_group_chunks': config.getint('Files', 'ingest_group_chunks', fallback=2000)
     }
 
     logger.info(f"設定が読み込まれました: {config_dict}")
@@ -51,6 +120,12 @@ def load_config():
         # 各ソースに embeddings_model を追加
         source['embeddings_model'] = config_dict['embeddings_model']
         source['openai_model'] = config_dict['openai_model']
+        source['index_type'] = config_dict['index_type']
+        source['index_options'] = config_dict['index_options']
+        source['index_mmap'] = config_dict['index_mmap']
+        source['vector_dtype'] = config_dict['vector_dtype']
+        # スプレッドシートの「次元数」列でソースごとに短いエンベディングを指定できる
+        source['dimensions'] = int(source['次元数']) if source.get('次元数') else config_dict['embedding_dimensions']
 
         # Notion トークンを Notion データソースに追加
         if source['参照形式'] == 'Notion':
@@ -0,0 +1,124 @@
+# context_packer.py
+import re
+import logging
+from collections import namedtuple
+from token_counter import get_encoding, count_tokens
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONTEXT_BUDGET = 6000
+DEFAULT_HISTORY_RATIO = 0.25
+# 1メッセージあたりにチャット形式で加算されるおおよそのトークン数
+MESSAGE_OVERHEAD_TOKENS = 4
+# 重なりとみなす最短・最長の文字数 (チャンク分割の chunk_overlap は 200 文字)
+MIN_OVERLAP_CHARS = 30
+MAX_OVERLAP_CHARS = 400
+# 切り詰めた結果がこれより短いチャンクは入れない
+MIN_CHUNK_TOKENS = 32
+
+_SENTENCE_END_RE = re.compile(r'[。！？!?．\n]|\.(?=\s)')
+
+# positions は results の各要素が元の検索結果の何番目か
+PackedContext = namedtuple('PackedContext', ['results', 'positions', 'history', 'token_counts'])
+
+def context_budget(config, model):
+    """モデルごとのプロンプトのトークン数の上限。[ContextBudget] にモデル名がなければ default の値を使う"""
+    budgets = config.get('context_budgets') or {}
+    return budgets.get(model, budgets.get('default', DEFAULT_CONTEXT_BUDGET))
+
+def truncate_at_sentence(text, model, max_tokens):
+    """max_tokens に収まるよう切り詰め、最後の文の区切りまで戻す。区切りがなければトークン単位で切る"""
+    encoding = get_encoding(model)
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    truncated = encoding.decode(tokens[:max_tokens], errors='replace').rstrip('�')
+    ends = [match.end() for match in _SENTENCE_END_RE.finditer(truncated)]
+    if ends and ends[-1] > len(truncated) // 2:
+        return truncated[:ends[-1]].rstrip()
+    return truncated
+
+def _overlap(left, right):
+    """left の末尾と right の先頭が一致する最長の文字数 (MIN_OVERLAP_CHARS 未満なら 0)"""
+    for size in range(min(len(left), len(right), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+def remove_overlap(text, selected_texts):
+    """選択済みのチャンクに含まれる部分を取り除く。全体が含まれていれば空文字を返す"""
+    stripped = text.strip()
+    for selected in selected_texts:
+        if stripped in selected:
+            return ""
+        head = _overlap(selected, stripped)
+        if head:
+            stripped = stripped[head:].lstrip()
+        tail = _overlap(stripped, selected)
+        if tail:
+            stripped = stripped[:len(stripped) - tail].rstrip()
+    return stripped
+
+def _pack_history(history, model, budget):
+    """新しいメッセージから順に予算に収まる分だけ残す。最新のメッセージ1件が収まらない場合は切り詰める"""
+    packed = []
+    used = 0
+    for message in reversed(history):
+        tokens = count_tokens(message.content, model) + MESSAGE_OVERHEAD_TOKENS
+        if used + tokens > budget:
+            if not packed and budget - MESSAGE_OVERHEAD_TOKENS >= MIN_CHUNK_TOKENS:
+                content = truncate_at_sentence(message.content, model, budget - MESSAGE_OVERHEAD_TOKENS)
+                packed.append(type(message)(content=content))
+                used += count_tokens(content, model) + MESSAGE_OVERHEAD_TOKENS
+            break
+        packed.append(message)
+        used += tokens
+    return list(reversed(packed)), used
+
+def _pack_results(search_results, model, budget):
+    packed = []
+    positions = []
+    selected_texts = []
+    used = 0
+    for position, result in enumerate(search_results):
+        remaining = budget - used
+        if remaining < MIN_CHUNK_TOKENS:
+            break
+        content = remove_overlap(result['content'], selected_texts)
+        if not content:
+            continue
+        # コンテキストでは各チャンクを "- " で始まる1行にする
+        tokens = count_tokens(content, model) + 2
+        if tokens > remaining:
+            content = truncate_at_sentence(content, model, remaining - 2)
+            tokens = count_tokens(content, model) + 2
+            if tokens - 2 < MIN_CHUNK_TOKENS:
+                continue
+        selected_texts.append(content)
+        packed.append(dict(result, content=content))
+        positions.append(position)
+        used += tokens
+    return packed, positions, used
+
+def pack_context(search_results, history, fixed_texts, model, budget, history_ratio=DEFAULT_HISTORY_RATIO):
+    """トークンの予算を、固定部分 (システムプロンプト・テンプレート・質問)、会話履歴、検索結果のチャンクに割り振る
+
+    固定部分を差し引いた残りのうち history_ratio までを会話履歴に使い、余った分と残りをチャンクに回す。
+    チャンクは検索順に、既に入れたチャンクと重なる部分を除き、収まらなければ文の区切りで切り詰める
+    """
+    fixed_tokens = sum(count_tokens(text, model) + MESSAGE_OVERHEAD_TOKENS for text in fixed_texts)
+    available = max(budget - fixed_tokens, 0)
+    packed_history, history_tokens = _pack_history(history, model, int(available * history_ratio))
+    packed_results, positions, chunk_tokens = _pack_results(search_results, model, available - history_tokens)
+
+    token_counts = {
+        'system': fixed_tokens,
+        'history': history_tokens,
+        'chunks': chunk_tokens,
+        'total': fixed_tokens + history_tokens + chunk_tokens,
+        'budget': budget
+    }
+    logger.info(f"コンテキストのトークン数: 固定部分 {fixed_tokens}, 会話履歴 {history_tokens} "
+                f"({len(packed_history)}/{len(history)} 件), チャンク {chunk_tokens} "
+                f"({len(packed_results)}/{len(search_results)} 件), 合計 {token_counts['total']} / 予算 {budget} (モデル: {model})")
+    return PackedContext(packed_results, positions, packed_history, token_counts)
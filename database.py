@@ -5,27 +5,63 @@ import pandas as pd
 import json
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain.schema import HumanMessage
-from file_cache import check_file_changes, save_file_hashes, load_file_hashes
-from document_processor import process_document, find_documents
+from file_cache import (check_file_changes, save_file_hashes, load_file_hashes, find_deleted_files, file_hash,
+                        refresh_file_hashes)
+from document_processor import iter_processed_documents, find_documents, DEFAULT_PARSE_TIMEOUT
 from vector_store import (create_faiss_index, save_to_parquet, load_from_parquet,
-                          save_faiss_index, load_faiss_index)
+                          save_faiss_index, load_faiss_index, make_chunk_ids, index_by_chunk_id,
+                          positions_for_ids, ensure_id_mapped, replace_source_chunks, ids_for_sources,
+                          load_tombstones, save_tombstones, drop_tombstoned_rows, compact_faiss_index,
+                          VectorFileWriter, ChunkParquetWriter, DEFAULT_INDEX_MMAP, take_rows, parquet_columns,
+                          load_index_params, set_embedding_info, index_version)
+from chunk_store import open_chunk_store, ChunkStore
+from metadata_filter import MetadataIndex, search_filtered, to_ns
+from vector_sidecar import VectorSidecar, backfill_from_index, rebuild_index_from_sidecar
+from lexical_index import LexicalIndex, reciprocal_rank_fusion, DEFAULT_RRF_K
+from mmr import rerank_hits, DEFAULT_MMR_LAMBDA, DEFAULT_MMR_FETCH_K
+from answer_cache import SemanticAnswerCache
 from web_scraper import scrape_website
 from notion_processor import process_notion_database, get_notion_pages
 from notion_client import Client
+from embedding_cache import EmbeddingCache, QueryEmbeddingCache, cache_model_key
+from build_checkpoint import BuildCheckpoint
+from ingest_pipeline import prefetch, iter_chunk_groups, DEFAULT_PREFETCH_SIZE, DEFAULT_GROUP_CHUNKS
+from rate_limiter import get_rate_limiter
+from embedding_engine import AsyncEmbeddingEngine, DEFAULT_MAX_IN_FLIGHT, supports_dimensions
+from token_counter import MAX_EMBEDDING_BATCH_TOKENS, MAX_EMBEDDING_BATCH_INPUTS, MAX_EMBEDDING_INPUT_TOKENS
 import logging
+import threading
 import time
+import weakref
+from contextlib import contextmanager
 from datetime import datetime
-from tenacity import retry, wait_exponential, stop_after_attempt
-import random
 
 logger = logging.getLogger(__name__)
 
+# ストリーミング構築中のベクトルを一時的に書き出すファイル
+STAGING_VECTOR_FILE = 'vectors_staging.f32'
+
 class DatabaseManager:
     def __init__(self, config):
         self.config = config
         self.faiss_index = None
         self._cache = {}
+        self._embedding_caches = {}
+        self._compacting = set()
+        self._metadata_indexes = {}
+        self._lexical_indexes = {}
+        self._vector_sidecars = {}
+        # 差分更新やエンベディングが途中で失敗したデータソースの名称。結果をキャッシュしない
+        self._failed_builds = set()
+        # persist_directory ごとの書き込みロックと、書き込みのたびに増える世代番号
+        self._write_locks = {}
+        self._write_generations = {}
+        self._write_locks_guard = threading.Lock()
+        self._answer_caches = {}
         self.embeddings = None
+        self._query_embeddings = {}
+        self._query_disk_cache = None
+        self.embedding_engines = {}
         self.ensure_embeddings()
 
     def ensure_embeddings(self):
@@ -37,69 +73,315 @@ class DatabaseManager:
                 logger.error(f"Embeddings オブジェクトの初期化に失敗しました: {str(e)}", exc_info=True)
                 raise
 
-    @retry(wait=wait_exponential(multiplier=1, min=4, max=60), stop=stop_after_attempt(5))
-    def generate_embeddings(self, texts):
+    def get_query_embeddings(self, dimensions=None):
+        """検索クエリ用のエンベディング。インデックスと同じ次元数で埋め込み、同じクエリは再利用する"""
+        if dimensions not in self._query_embeddings:
+            model = self.config['embeddings_model']
+            embeddings = OpenAIEmbeddings(model=model, dimensions=dimensions) if dimensions else self.embeddings
+            self._query_embeddings[dimensions] = QueryEmbeddingCache(
+                embeddings, model, dimensions,
+                max_entries=self.config.get('query_cache_size', 1024),
+                disk_cache=self._get_query_disk_cache())
+        return self._query_embeddings[dimensions]
+
+    def _get_query_disk_cache(self):
+        query_cache_file = self.config.get('query_cache_file')
+        if query_cache_file and self._query_disk_cache is None:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(query_cache_file)), exist_ok=True)
+                self._query_disk_cache = EmbeddingCache(query_cache_file)
+            except Exception as e:
+                logger.error(f"クエリエンベディングキャッシュを開けませんでした: {query_cache_file}, エラー: {str(e)}",
+                             exc_info=True)
+        return self._query_disk_cache
+
+    def get_embedding_engine(self, dimensions=None):
+        if dimensions not in self.embedding_engines:
+            model = self.config['embeddings_model']
+            self.embedding_engines[dimensions] = AsyncEmbeddingEngine(
+                model,
+                max_in_flight=self.config.get('embedding_max_in_flight', DEFAULT_MAX_IN_FLIGHT),
+                rate_limiter=get_rate_limiter(model, self.config.get('rate_limits')),
+                base_url=self.config.get('embeddings_base_url'),
+                batch_max_tokens=self.config.get('embedding_batch_max_tokens', MAX_EMBEDDING_BATCH_TOKENS),
+                batch_max_inputs=self.config.get('embedding_batch_max_inputs', MAX_EMBEDDING_BATCH_INPUTS),
+                max_input_tokens=self.config.get('embedding_max_input_tokens', MAX_EMBEDDING_INPUT_TOKENS),
+                dimensions=dimensions)
+        return self.embedding_engines[dimensions]
+
+    def generate_embeddings(self, texts, dimensions=None):
         try:
-            self.ensure_embeddings()
-            embeddings = self.embeddings.embed_documents(texts)
-            logger.info(f"生成されたembeddingsの型: {type(embeddings)}")
-            logger.info(f"生成されたembeddingsの長さ: {len(embeddings)}")
-            if embeddings:
-                logger.info(f"最初のembeddingの型: {type(embeddings[0])}")
-                logger.info(f"最初のembeddingの長さ: {len(embeddings[0])}")
-            return np.array(embeddings)  # リストをNumPy配列に直接変換
+            embeddings = self.get_embedding_engine(dimensions).embed(texts)
+            logger.info(f"生成されたembeddingsの形状: {embeddings.shape}")
+            return embeddings
         except Exception as e:
             logger.error(f"Embeddings生成中にエラーが発生しました: {str(e)}", exc_info=True)
             raise
 
-    def process_chunks_with_progress(self, chunks, batch_size=200):
-        total_chunks = len(chunks)
-        processed_chunks = 0
-        all_embeddings = []
+    def _data_version(self, source_config):
+        """インデックス・tombstone・Parquetファイルのどれかが書き換わると変わる文字列"""
+        parquet_file = source_config.get('parquet_file')
+        parquet_version = "none"
+        if parquet_file and os.path.exists(parquet_file):
+            stat = os.stat(parquet_file)
+            parquet_version = f"{stat.st_mtime_ns}-{stat.st_size}"
+        return f"{self.get_index_version(source_config)}:{parquet_version}"
+
+    def get_metadata_index(self, source_config, df):
+        """フィルタ検索用のメタデータインデックス。ファイルとNotionの更新日時はハッシュファイルから取る
+
+        データのバージョンが同じで、同じ df から作ったものだけを再利用する。
+        id(df) は df が破棄されると再利用されるため、弱参照で本人か確かめる
+        """
+        cache_key = (source_config['名称'], self._data_version(source_config))
+        cached = self._metadata_indexes.get(cache_key)
+        if cached is not None and cached[0]() is df:
+            return cached[1]
+        source_mtimes = {}
+        persist_directory = source_config.get('persist_directory')
+        if source_config['参照形式'] == 'ファイル':
+            hashes = load_file_hashes(os.path.join(persist_directory, 'file_hashes.json'))
+            source_mtimes = {path: entry['mtime_ns'] for path, entry in hashes.items()
+                             if isinstance(entry, dict) and 'mtime_ns' in entry}
+        elif source_config['参照形式'] == 'Notion':
+            hash_file = os.path.join(persist_directory, 'notion_hashes.json')
+            if os.path.exists(hash_file):
+                source_mtimes = {page_id: to_ns(edited)
+                                 for page_id, edited in self._load_notion_hashes(hash_file).items()}
+        metadata_index = MetadataIndex.from_frame(df, source_mtimes)
+        try:
+            df_ref = weakref.ref(df)
+        except TypeError:
+            df_ref = lambda df=df: df
+        self._metadata_indexes = {cache_key: (df_ref, metadata_index)}
+        return metadata_index
+
+    def get_vector_sidecar(self, persist_directory):
+        """persist_directory ごとに1つのベクトルファイルを保持し、IDの索引を検索のたびに作り直さないようにする
+
+        他の処理で更新されていれば開き直す
+        """
+        sidecar = self._vector_sidecars.get(persist_directory)
+        if sidecar is None or sidecar.is_stale():
+            sidecar = VectorSidecar(persist_directory, self.config.get('vector_dtype', 'float32'))
+            self._vector_sidecars[persist_directory] = sidecar
+        return sidecar
+
+    def _drop_vector_sidecar(self, persist_directory):
+        """ベクトルファイルを書き換えた後に、キャッシュしたインスタンスを破棄する"""
+        self._vector_sidecars.pop(persist_directory, None)
+
+    def get_answer_cache(self, source_config):
+        """回答キャッシュが無効なら None"""
+        if not self.config.get('answer_cache', False):
+            return None
+        persist_directory = source_config.get('persist_directory') or source_config['persist_directory_web']
+        if persist_directory not in self._answer_caches:
+            self._answer_caches[persist_directory] = SemanticAnswerCache.for_directory(
+                persist_directory,
+                threshold=self.config.get('answer_cache_threshold', 0.95),
+                max_entries=self.config.get('answer_cache_size', 1000))
+        return self._answer_caches[persist_directory]
+
+    def get_index_version(self, source_config):
+        return index_version(source_config['faiss_index_file'])
+
+    def _open_lexical_index(self, persist_directory):
+        """ハイブリッド検索が無効なら None。他の処理で更新されていれば開き直す"""
+        if not self.config.get('hybrid_search', False):
+            return None
+        lexical_index = self._lexical_indexes.get(persist_directory)
+        if lexical_index is None or lexical_index.is_stale():
+            lexical_index = LexicalIndex(persist_directory)
+            self._lexical_indexes[persist_directory] = lexical_index
+        return lexical_index
+
+    def get_lexical_index(self, source_config, df=None):
+        """ハイブリッド検索用の語彙インデックス。語彙インデックスのない既存のデータベースは df から作る"""
+        persist_directory = source_config.get('persist_directory') or source_config['persist_directory_web']
+        lexical_index = self._open_lexical_index(persist_directory)
+        if lexical_index is not None and not lexical_index.exists() and df is not None:
+            logger.info(f"語彙インデックスを作成します: {source_config['名称']}")
+            lexical_index.add(*_lexical_documents(df))
+        return lexical_index
+
+    def _update_lexical_index(self, persist_directory, stale_ids, new_ids, new_texts):
+        """差し替えたソースの古いチャンクを削除済みにし、新しいチャンクのセグメントを追加する"""
+        lexical_index = self._open_lexical_index(persist_directory)
+        if lexical_index is None or not lexical_index.exists():
+            return
+        lexical_index.delete(stale_ids, commit=False)
+        lexical_index.add(new_ids, list(new_texts))
+
+    def _store_new_vectors(self, persist_directory, df, index, new_ids, new_vectors):
+        """新しいチャンクのベクトルをベクトルファイルに追記し、古い行の割合が増えたら書き直す"""
+        sidecar = self.get_vector_sidecar(persist_directory)
+        live_ids = df['chunk_id'].to_numpy(dtype=np.int64)
+        try:
+            if not sidecar.exists():
+                backfill_from_index(sidecar, index, np.setdiff1d(live_ids, new_ids))
+            sidecar.append(new_ids, new_vectors)
+            if sidecar.dead_ratio(len(live_ids)) > self.config.get('compaction_tombstone_ratio', 0.2):
+                sidecar.compact(live_ids)
+        finally:
+            self._drop_vector_sidecar(persist_directory)
+
+    def _migrate_embedding_column(self, parquet_file):
+        """旧形式の embedding 列をベクトルファイルに移し、Parquetから取り除く"""
+        if 'embedding' not in parquet_columns(parquet_file):
+            return
+        logger.info(f"embedding 列をベクトルファイルに移行します: {parquet_file}")
+        df = load_from_parquet(parquet_file)
+        sidecar = self.get_vector_sidecar(os.path.dirname(parquet_file))
+        if not sidecar.exists() and 'chunk_id' in df.columns:
+            sidecar.write(df['chunk_id'].to_numpy(dtype=np.int64), np.vstack(df['embedding'].to_numpy()))
+        save_to_parquet(df.drop(columns=['embedding']), parquet_file)
+
+    def rebuild_index(self, source_config):
+        """保存済みのベクトルから、エンベディングをやり直さずにインデックスを作り直す (再学習を含む)"""
+        persist_directory = source_config.get('persist_directory') or source_config['persist_directory_web']
+        parquet_file = source_config['parquet_file']
+        is_web_source = source_config['参照形式'] == 'Webサイト'
+        sidecar = self.get_vector_sidecar(persist_directory)
+        if not sidecar.exists():
+            raise FileNotFoundError(f"ベクトルファイルが見つかりません: {sidecar.vector_file}")
+
+        df = load_from_parquet(parquet_file, is_web_source=is_web_source)
+        tombstones = load_tombstones(persist_directory)
+        if len(tombstones) > 0:
+            df = drop_tombstoned_rows(df, tombstones)
+            save_to_parquet(df, parquet_file, is_web_source=is_web_source)
+        live_ids = df['chunk_id'].to_numpy(dtype=np.int64) if 'chunk_id' in df.columns else np.arange(len(df))
+        try:
+            index = rebuild_index_from_sidecar(sidecar, live_ids,
+                                               index_type=source_config.get('index_type', 'flat'),
+                                               index_options=source_config.get('index_options'))
+        finally:
+            self._drop_vector_sidecar(persist_directory)
+        set_embedding_info(index, source_config['embeddings_model'], source_config.get('dimensions'))
+        save_faiss_index(index, source_config['faiss_index_file'])
+        save_tombstones(persist_directory, [])
+        self.faiss_index = index
+        logger.info(f"ベクトルファイルからインデックスを再構築しました: {source_config['名称']}")
+        return index
+
+    def get_embedding_cache(self, persist_directory):
+        if persist_directory not in self._embedding_caches:
+            self._embedding_caches[persist_directory] = EmbeddingCache.for_directory(persist_directory)
+        return self._embedding_caches[persist_directory]
+
+    def process_chunks_with_progress(self, chunks, embedding_cache=None, checkpoint=None, dimensions=None):
+        texts = [chunk.page_content for chunk in chunks]
+        total_chunks = len(texts)
+        model = cache_model_key(self.config['embeddings_model'], dimensions)
+
+        # キャッシュにないチャンクだけをAPIに送る
+        if embedding_cache is not None:
+            cached_vectors = embedding_cache.get_many(model, texts)
+        else:
+            cached_vectors = [None] * total_chunks
+        miss_indices = [i for i, vector in enumerate(cached_vectors) if vector is None]
+        logger.info(f"エンベディング対象: {len(miss_indices)} / {total_chunks} チャンク (残りはキャッシュを使用)")
+
+        progress_state = {'processed': total_chunks - len(miss_indices)}
+        if checkpoint is not None:
+            checkpoint.start(total_chunks, progress_state['processed'])
+
+        def on_batch_done(batch_positions, batch_embeddings, token_count):
+            batch_indices = [miss_indices[p] for p in batch_positions]
+            for j, vector in zip(batch_indices, batch_embeddings):
+                cached_vectors[j] = vector
+            if embedding_cache is not None:
+                embedding_cache.put_many(model, [texts[j] for j in batch_indices], batch_embeddings)
+            progress_state['processed'] += len(batch_indices)
+            if checkpoint is not None:
+                checkpoint.update(progress_state['processed'])
+            progress = (progress_state['processed'] / total_chunks) * 100
+            logger.info(f"処理進捗: {progress:.2f}% ({progress_state['processed']}/{total_chunks}), バッチのトークン数: {token_count}")
 
-        for i in range(0, total_chunks, batch_size):
-            batch = chunks[i:i+batch_size]
+        if miss_indices:
             try:
-                batch_embeddings = self.generate_embeddings([chunk.page_content for chunk in batch])
-                if batch_embeddings is not None:
-                    all_embeddings.append(batch_embeddings)
-                    processed_chunks += len(batch)
-                    
-                    progress = (processed_chunks / total_chunks) * 100
-                    logger.info(f"処理進捗: {progress:.2f}% ({processed_chunks}/{total_chunks})")
-                else:
-                    logger.error(f"バッチ {i} の embeddings 生成に失敗しました")
-                
-                time.sleep(random.uniform(10.0, 15.0))  # APIレート制限を回避するための待機時間
-            
+                self.get_embedding_engine(dimensions).embed([texts[j] for j in miss_indices], on_batch_done=on_batch_done)
             except Exception as e:
+                # 完了したバッチはキャッシュに保存済みなので、次回はその続きから再開できる
                 logger.error(f"バッチ処理中にエラーが発生しました: {str(e)}", exc_info=True)
-                user_input = input("処理を再開しますか？ (y/n): ")
-                if user_input.lower() != 'y':
-                    logger.info("処理を中断しました")
-                    break
-                else:
-                    logger.info("処理を再開します")
-                    continue
+                if checkpoint is not None:
+                    checkpoint.update(progress_state['processed'])
+                    checkpoint.fail(e)
+                return None
 
-        if not all_embeddings:
+        processed_chunks = progress_state['processed']
+        if total_chunks == 0 or any(vector is None for vector in cached_vectors):
+            logger.error(f"エンベディングが揃っていません ({processed_chunks}/{total_chunks})")
+            if checkpoint is not None:
+                checkpoint.fail("エンベディングが揃っていません")
             return None
         
-        # 全てのバッチのエンベディングを1つの大きなNumPy配列に結合
-        combined_embeddings = np.vstack(all_embeddings)
+        # 全てのチャンクのエンベディングを1つの大きなNumPy配列に結合
+        combined_embeddings = np.vstack(cached_vectors).astype(np.float32, copy=False)
         logger.info(f"結合後のエンベディングの形状: {combined_embeddings.shape}")
         return combined_embeddings
 
     def load_or_create_db(self, source_config):
         logger.info(f"load_or_create_db called with source_config: {source_config}")
+        source_config = self._resolve_dimensions(source_config)
         if source_config['参照形式'] == 'ファイル':
-            return self.load_or_create_file_db(source_config)
+            result = self.load_or_create_file_db(source_config)
         elif source_config['参照形式'] == 'Webサイト':
-            return self.load_or_create_web_db(source_config)
+            result = self.load_or_create_web_db(source_config)
         elif source_config['参照形式'] == 'Notion':
-            return self.load_or_create_notion_db(source_config)
+            result = self.load_or_create_notion_db(source_config)
         else:
             raise ValueError(f"Unsupported data source type: {source_config['参照形式']}")
+        # クエリはインデックスと同じ次元数で埋め込む
+        if result[0] is not None:
+            result = result[:3] + (self.get_query_embeddings(source_config.get('dimensions')),) + result[4:]
+            try:
+                self.get_lexical_index(source_config, result[0])
+            except Exception as e:
+                logger.error(f"語彙インデックスの作成中にエラーが発生しました: {str(e)}", exc_info=True)
+        return result
+
+    def _resolve_dimensions(self, source_config):
+        """設定の dimensions とインデックスに記録された次元数を照合し、実際に使う次元数を反映した source_config を返す
+
+        設定の方が小さい場合は、保存済みのベクトルを切り詰めて正規化し直し、エンベディングをやり直さずにインデックスを作り直す
+        """
+        dimensions = source_config.get('dimensions')
+        model = source_config.get('embeddings_model', self.config['embeddings_model'])
+        if dimensions and not supports_dimensions(model):
+            logger.warning(f"{model} は dimensions の指定に対応していないため無視します: {dimensions}")
+            dimensions = None
+
+        faiss_index_file = source_config.get('faiss_index_file')
+        if not faiss_index_file or not os.path.exists(faiss_index_file):
+            return dict(source_config, dimensions=dimensions)
+
+        params = load_index_params(faiss_index_file) or {}
+        persist_directory = source_config.get('persist_directory') or source_config.get('persist_directory_web')
+        sidecar = self.get_vector_sidecar(persist_directory)
+        stored_dim = params.get('dim') or sidecar.dim
+        stored_dimensions = params.get('dimensions')
+        if dimensions == stored_dimensions or stored_dim is None:
+            return dict(source_config, dimensions=stored_dimensions)
+        if dimensions == stored_dim:
+            return dict(source_config, dimensions=dimensions)
+
+        if dimensions and dimensions < stored_dim and sidecar.dim == stored_dim:
+            logger.info(f"保存済みのベクトルを {stored_dim} 次元から {dimensions} 次元に切り詰めてインデックスを作り直します")
+            source_config = dict(source_config, dimensions=dimensions)
+            try:
+                sidecar.truncate(dimensions)
+                self.rebuild_index(source_config)
+                self.clear_cache()
+                return source_config
+            except Exception as e:
+                logger.error(f"ベクトルの切り詰め中にエラーが発生しました: {str(e)}", exc_info=True)
+                self._drop_vector_sidecar(persist_directory)
+
+        logger.warning(f"設定の次元数 ({dimensions}) とインデックスの次元数 ({stored_dim}) が異なるため、インデックスの次元数で検索します。"
+                       f"変更するにはデータベースを作り直してください")
+        return dict(source_config, dimensions=stored_dimensions)
     
     def load_or_create_notion_db(self, source_config):
         logger.info(f"load_or_create_notion_db が呼び出されました: {source_config['名称']}")
@@ -115,7 +397,7 @@ class DatabaseManager:
                 old_hashes = self._load_notion_hashes(hash_file)
                 if current_hashes == old_hashes:
                     logger.info("Notionデータベースに変更がありません。既存のデータベースを使用します。")
-                    return self._use_existing_db(parquet_file, faiss_index_file)
+                    return self._use_existing_db(parquet_file, faiss_index_file, as_chunk_store=True)
                 else:
                     logger.info("Notionデータベースに変更があります。差分更新を行います。")
                     return self._update_notion_db(source_config, notion_client, current_hashes, old_hashes, parquet_file, faiss_index_file, hash_file)
@@ -141,34 +423,46 @@ class DatabaseManager:
 
     def _update_notion_db(self, source_config, notion_client, current_hashes, old_hashes, parquet_file, faiss_index_file, hash_file):
         df, index, _, _, _ = self._use_existing_db(parquet_file, faiss_index_file)
+        persist_directory = source_config['persist_directory']
         
         updated_pages = [page_id for page_id, last_edited in current_hashes.items() 
                          if page_id not in old_hashes or old_hashes[page_id] != last_edited]
+        deleted_pages = find_deleted_files(old_hashes, current_hashes)
         
-        new_documents = process_notion_database(notion_client, source_config['参照先'], page_ids=updated_pages)
+        new_documents = []
+        if updated_pages:
+            new_documents = process_notion_database(notion_client, source_config['参照先'], page_ids=updated_pages)
         
         if new_documents:
+            df, index = ensure_id_mapped(df, index)
             new_content = [doc.page_content for doc in new_documents]
             new_metadata = [doc.metadata for doc in new_documents]
-            new_vectors = self.generate_embeddings(new_content)
+            new_vectors = self.process_chunks_with_progress(
+                new_documents, embedding_cache=self.get_embedding_cache(persist_directory),
+                dimensions=source_config.get('dimensions'))
+            if new_vectors is None:
+                return df, index, None, self.embeddings, "ベクトルの生成に失敗しました"
             
             new_df = pd.DataFrame({
                 'content': new_content,
-                'metadata': new_metadata,
-                'embedding': new_vectors.tolist()
+                'source': [meta['source'] for meta in new_metadata],
+                'page': [meta['title'] for meta in new_metadata],
+                'metadata': new_metadata
             })
             
-            # 更新されたページを既存のデータフレームから削除
-            df = df[~df['metadata'].apply(lambda x: x['source']).isin(updated_pages)]
-            
-            # 新しいデータを追加
-            df = pd.concat([df, new_df], ignore_index=True)
-            
-            # FAISSインデックスを更新
-            index.add(new_vectors)
+            # 更新・削除されたページの古いチャンクと削除済みIDを取り除いてから新しいチャンクを追加
+            stale_ids = ids_for_sources(df, updated_pages + deleted_pages)
+            df, index = replace_source_chunks(df, index, updated_pages + deleted_pages, new_df, new_vectors,
+                                              tombstones=load_tombstones(persist_directory))
+            new_ids = df['chunk_id'].to_numpy()[len(df) - len(new_df):]
+            self._store_new_vectors(persist_directory, df, index, new_ids, new_vectors)
+            self._update_lexical_index(persist_directory, stale_ids, new_ids, new_content)
             
             save_to_parquet(df, parquet_file)
             save_faiss_index(index, faiss_index_file)
+            save_tombstones(persist_directory, [])
+        elif deleted_pages:
+            df, index = self._tombstone_sources(df, index, deleted_pages, persist_directory, parquet_file, faiss_index_file, hash_file)
         
         self._save_notion_hashes(current_hashes, hash_file)
         return df, index, None, self.embeddings, "Notionデータベースを更新しました。"
@@ -183,24 +477,36 @@ class DatabaseManager:
         content_list = [doc.page_content for doc in documents]
         metadata_list = [doc.metadata for doc in documents]
 
-        vectors = self.generate_embeddings(content_list)
+        vectors = self.process_chunks_with_progress(
+            documents, embedding_cache=self.get_embedding_cache(source_config['persist_directory']),
+            dimensions=source_config.get('dimensions'))
         
         if vectors is None or len(vectors) == 0:
             logger.error("ベクトルの生成に失敗しました")
             return None, None, None, None, "ベクトルの生成に失敗しました"
 
-        index = create_faiss_index(vectors)
-        
         df = pd.DataFrame({
             'content': content_list,
             'source': [meta['source'] for meta in metadata_list],
             'page': [meta['title'] for meta in metadata_list],
-            'metadata': metadata_list,
-            'embedding': vectors.tolist()
+            'metadata': metadata_list
         })
+        df['chunk_id'] = make_chunk_ids(df['source'].tolist(), content_list)
+        index_by_chunk_id(df)
+
+        index = create_faiss_index(vectors, df['chunk_id'].to_numpy(),
+                                   index_type=source_config.get('index_type', 'flat'),
+                                   index_options=source_config.get('index_options'))
+        set_embedding_info(index, source_config['embeddings_model'], source_config.get('dimensions'))
         
         save_to_parquet(df, parquet_file)
         save_faiss_index(index, faiss_index_file)
+        self.get_vector_sidecar(source_config['persist_directory']).write(df['chunk_id'].to_numpy(), vectors)
+        self._drop_vector_sidecar(source_config['persist_directory'])
+        lexical_index = self._open_lexical_index(source_config['persist_directory'])
+        if lexical_index is not None:
+            lexical_index.clear()
+            lexical_index.add(df['chunk_id'].to_numpy(), content_list)
         self._save_notion_hashes(current_hashes, hash_file)
 
         return df, index, None, self.embeddings, "新しいNotionデータベースを作成しました。"
@@ -218,6 +524,31 @@ class DatabaseManager:
     def _find_documents(self, directory):
         return find_documents(directory)
 
+    def _process_documents(self, document_files):
+        """(チャンク, 処理に失敗したファイル) を返す"""
+        all_chunks = []
+        failed_files = []
+        processed_files = iter_processed_documents(
+            document_files,
+            max_workers=self.config.get('parse_workers'),
+            timeout=self.config.get('parse_timeout', DEFAULT_PARSE_TIMEOUT))
+        for doc_file, chunks in processed_files:
+            if chunks is None:
+                failed_files.append(doc_file)
+                continue
+            all_chunks.extend(chunks)
+            logger.info(f"処理完了: {doc_file}, チャンク数: {len(chunks)}")
+        return all_chunks, failed_files
+
+    def _skip_failed_files(self, failed_files, current_hashes, old_hashes):
+        """処理に失敗したファイルのハッシュを前回の値に戻し、次回の読み込みで再処理されるようにする"""
+        for doc_file in failed_files:
+            logger.warning(f"処理に失敗したため、このファイルの変更は反映しません (次回再試行します): {doc_file}")
+            if doc_file in old_hashes:
+                current_hashes[doc_file] = old_hashes[doc_file]
+            else:
+                current_hashes.pop(doc_file, None)
+
     def load_or_create_file_db(self, source_config):
         logger.info(f"load_or_create_file_db が呼び出されました: {source_config['名称']}")
 
@@ -225,6 +556,7 @@ class DatabaseManager:
         if cache_key in self._cache:
             logger.info(f"キャッシュされたデータベースを使用します: {cache_key}")
             return self._cache[cache_key]
+        self._failed_builds.discard(cache_key)
 
         parquet_file = source_config['parquet_file']
         faiss_index_file = source_config['faiss_index_file']
@@ -235,104 +567,310 @@ class DatabaseManager:
         hash_file = os.path.join(persist_directory, 'file_hashes.json')
 
         document_files = self._find_documents(source_config['参照先'])
-        files_changed, current_hashes = check_file_changes(document_files, hash_file)
+        files_changed, current_hashes = check_file_changes(
+            document_files, hash_file,
+            algorithm=self.config.get('file_hash_algorithm', 'md5'),
+            max_workers=self.config.get('file_hash_workers'))
+        if not files_changed:
+            refresh_file_hashes(current_hashes, hash_file)
+
+        if (os.path.exists(parquet_file) and not os.path.exists(faiss_index_file)
+                and self.get_vector_sidecar(persist_directory).exists()):
+            logger.info("インデックスファイルがないため、保存済みのベクトルから再構築します")
+            try:
+                self.rebuild_index(source_config)
+            except Exception as e:
+                logger.error(f"インデックスの再構築中にエラーが発生しました: {str(e)}", exc_info=True)
 
         if os.path.exists(parquet_file) and os.path.exists(faiss_index_file):
             if not files_changed and self._check_file_timestamps(parquet_file, hash_file):
-                result = self._use_existing_db(parquet_file, faiss_index_file)
+                result = self._use_existing_db(parquet_file, faiss_index_file, as_chunk_store=True)
             else:
                 result = self._update_existing_db(source_config, document_files, current_hashes, parquet_file, faiss_index_file, hash_file)
         else:
             result = self._create_new_db_and_index(source_config, document_files, current_hashes, parquet_file, faiss_index_file, hash_file)
 
-        self._cache[cache_key] = result
+        # 失敗した結果はキャッシュせず、次回の呼び出しでチェックポイントから再開する
+        if self._is_cacheable(cache_key, result):
+            self._cache[cache_key] = result
         return result
 
-    def _use_existing_db(self, parquet_file, faiss_index_file):
+    def _is_cacheable(self, cache_key, result):
+        """読み込みに失敗した結果と、古いデータベースのまま返した失敗した差分更新の結果は False"""
+        if cache_key in self._failed_builds:
+            logger.warning(f"データベースの構築が失敗したため、結果をキャッシュしません: {cache_key}")
+            return False
+        return result[0] is not None and result[1] is not None
+
+    def _use_existing_db(self, parquet_file, faiss_index_file, as_chunk_store=False):
+        """as_chunk_store=True かつ chunk_store_format が arrow のときは、検索専用のメモリマップされたチャンクストアを返す"""
         try:
-            df = load_from_parquet(parquet_file)
+            self._migrate_embedding_column(parquet_file)
+            tombstones = load_tombstones(os.path.dirname(parquet_file))
+            df = None
+            if as_chunk_store and self.config.get('chunk_store_format', 'parquet') == 'arrow':
+                df = open_chunk_store(parquet_file, tombstones)
+            if df is None:
+                df = load_from_parquet(parquet_file)
+                df = drop_tombstoned_rows(df, tombstones)
             if self.faiss_index is None:
-                self.faiss_index = load_faiss_index(faiss_index_file)
+                self.faiss_index = load_faiss_index(faiss_index_file, mmap=self.config.get('index_mmap', DEFAULT_INDEX_MMAP))
             return df, self.faiss_index, None, self.embeddings, "既存のデータベースを使用しました。"
         except Exception as e:
             logger.error(f"既存のデータベース読み込み中にエラー: {str(e)}")
             return None, None, None, None, f"既存のデータベース読み込み中にエラー: {str(e)}"
 
     def _update_existing_db(self, source_config, document_files, current_hashes, parquet_file, faiss_index_file, hash_file):
+        with self._write_lock(source_config['persist_directory']):
+            return self._update_existing_db_locked(source_config, document_files, current_hashes,
+                                                   parquet_file, faiss_index_file, hash_file)
+
+    def _update_existing_db_locked(self, source_config, document_files, current_hashes, parquet_file, faiss_index_file, hash_file):
         try:
             df, index, _, _, _ = self._use_existing_db(parquet_file, faiss_index_file)
             old_hashes = load_file_hashes(hash_file)
+            persist_directory = source_config['persist_directory']
             
-            new_or_changed_files = [file for file in document_files if file not in old_hashes or old_hashes[file] != current_hashes[file]]
+            new_or_changed_files = [file for file in document_files
+                                    if file in current_hashes and file_hash(old_hashes.get(file)) != file_hash(current_hashes[file])]
+            deleted_files = find_deleted_files(old_hashes, current_hashes)
             
             if new_or_changed_files:
                 logger.info(f"新規または変更されたファイル: {new_or_changed_files}")
-                new_chunks = self._process_documents(new_or_changed_files)
+                df, index = ensure_id_mapped(df, index)
+                new_chunks, failed_files = self._process_documents(new_or_changed_files)
+                if failed_files:
+                    # 失敗したファイルは古いチャンクを残したまま、前回のハッシュで保存する
+                    current_hashes = dict(current_hashes)
+                    self._skip_failed_files(failed_files, current_hashes, old_hashes)
+                    new_or_changed_files = [file for file in new_or_changed_files if file not in failed_files]
                 
+                checkpoint = BuildCheckpoint(source_config['persist_directory'], 'update')
+                new_vectors = None
                 if new_chunks:
-                    new_vectors = self.process_chunks_with_progress(new_chunks)
-                    new_df = pd.DataFrame({
-                        'content': [chunk.page_content for chunk in new_chunks],
-                        'source': [chunk.metadata['source'] for chunk in new_chunks],
-                        'page': [str(chunk.metadata.get('page', 'N/A')) for chunk in new_chunks]
-                    })
-                    
-                    df = pd.concat([df, new_df], ignore_index=True)
-                    index.add(np.array(new_vectors))
-                    
-                    save_to_parquet(df, parquet_file, is_web_source=False)
-                    save_faiss_index(index, faiss_index_file)
-                    save_file_hashes(current_hashes, hash_file)
-                    os.utime(hash_file, (os.path.getatime(parquet_file), os.path.getmtime(parquet_file)))
-                    
-                    logger.info(f"データベースを更新しました。新規チャンク数: {len(new_chunks)}")
-                    return df, index, None, self.embeddings, "データベースを更新しました。"
+                    new_vectors = self.process_chunks_with_progress(
+                        new_chunks, embedding_cache=self.get_embedding_cache(source_config['persist_directory']),
+                        checkpoint=checkpoint, dimensions=source_config.get('dimensions'))
+                    if new_vectors is None:
+                        # ハッシュは保存しないので、次回も同じファイルが変更として検出され再開される
+                        self._failed_builds.add(source_config['名称'])
+                        return df, index, None, self.embeddings, checkpoint.failure_message()
+                new_df = pd.DataFrame({
+                    'content': [chunk.page_content for chunk in new_chunks],
+                    'source': [chunk.metadata['source'] for chunk in new_chunks],
+                    'page': [str(chunk.metadata.get('page', 'N/A')) for chunk in new_chunks]
+                })
+                
+                # 変更・削除されたファイルの古いチャンクと削除済みIDを取り除いてから新しいチャンクを追加
+                stale_ids = ids_for_sources(df, new_or_changed_files + deleted_files)
+                df, index = replace_source_chunks(df, index, new_or_changed_files + deleted_files, new_df, new_vectors,
+                                                  tombstones=load_tombstones(persist_directory))
+                new_ids = df['chunk_id'].to_numpy()[len(df) - len(new_df):]
+                if new_chunks:
+                    self._store_new_vectors(persist_directory, df, index, new_ids, new_vectors)
+                self._update_lexical_index(persist_directory, stale_ids, new_ids, new_df['content'])
+                self.faiss_index = index
+                
+                save_to_parquet(df, parquet_file, is_web_source=False)
+                save_faiss_index(index, faiss_index_file)
+                save_tombstones(persist_directory, [])
+                save_file_hashes(current_hashes, hash_file)
+                os.utime(hash_file, (os.path.getatime(parquet_file), os.path.getmtime(parquet_file)))
+                checkpoint.complete()
+                
+                logger.info(f"データベースを更新しました。新規チャンク数: {len(new_chunks)}")
+                return df, index, None, self.embeddings, "データベースを更新しました。"
+            
+            if deleted_files:
+                logger.info(f"削除されたファイル: {deleted_files}")
+                df, index = self._tombstone_sources(df, index, deleted_files, persist_directory, parquet_file, faiss_index_file, hash_file)
+                self.faiss_index = index
+                save_file_hashes(current_hashes, hash_file)
+                os.utime(hash_file, (os.path.getatime(parquet_file), os.path.getmtime(parquet_file)))
+                return df, index, None, self.embeddings, "削除されたファイルをデータベースから除外しました。"
             
             return df, index, None, self.embeddings, "変更はありませんでした。"
         except Exception as e:
             logger.error(f"データベースの更新中にエラーが発生しました: {str(e)}")
             return self._create_new_db_and_index(source_config, document_files, current_hashes, parquet_file, faiss_index_file, hash_file)
 
+    @contextmanager
+    def _write_lock(self, persist_directory):
+        """persist_directory のファイルを書き換える処理を、バックグラウンドのコンパクションと直列にする"""
+        with self._write_locks_guard:
+            lock = self._write_locks.setdefault(persist_directory, threading.RLock())
+        with lock:
+            self._write_generations[persist_directory] = self._write_generations.get(persist_directory, 0) + 1
+            yield
+
+    def _tombstone_sources(self, df, index, sources, persist_directory, parquet_file, faiss_index_file, hash_file):
+        """削除されたソースのチャンクを tombstone として記録し、インデックスの書き換えはコンパクションまで遅らせる"""
+        with self._write_lock(persist_directory):
+            return self._tombstone_sources_locked(df, index, sources, persist_directory, parquet_file, faiss_index_file, hash_file)
+
+    def _tombstone_sources_locked(self, df, index, sources, persist_directory, parquet_file, faiss_index_file, hash_file):
+        migrated_df, migrated_index = ensure_id_mapped(df, index)
+        if migrated_index is not index:
+            save_to_parquet(migrated_df, parquet_file)
+            save_faiss_index(migrated_index, faiss_index_file)
+        df, index = migrated_df, migrated_index
+
+        dead_ids = ids_for_sources(df, sources)
+        tombstones = np.union1d(load_tombstones(persist_directory), dead_ids)
+        save_tombstones(persist_directory, tombstones)
+        df = drop_tombstoned_rows(df, dead_ids)
+        lexical_index = self._open_lexical_index(persist_directory)
+        if lexical_index is not None and lexical_index.exists():
+            lexical_index.delete(dead_ids)
+        logger.info(f"{len(sources)} 件のソースの {len(dead_ids)} チャンクを削除済みにしました")
+
+        tombstone_ratio = len(tombstones) / max(index.ntotal, 1)
+        if tombstone_ratio > self.config.get('compaction_tombstone_ratio', 0.2):
+            logger.info(f"削除済みチャンクの割合が {tombstone_ratio:.1%} のため、コンパクションを開始します")
+            self._start_compaction(df, index, tombstones, persist_directory, parquet_file, faiss_index_file, hash_file)
+        return df, index
+
+    def _start_compaction(self, df, index, tombstones, persist_directory, parquet_file, faiss_index_file, hash_file):
+        """削除済みの行を除いたParquetとインデックスをバックグラウンドで書き直す
+
+        実行中のセッションは削除済みの行を除いたデータフレームで検索を続けるため、結果は変わらない
+        """
+        if persist_directory in self._compacting:
+            logger.info(f"コンパクションは既に実行中です: {persist_directory}")
+            return
+        self._compacting.add(persist_directory)
+
+        generation = self._write_generations.get(persist_directory, 0)
+
+        def compact():
+            try:
+                with self._write_lock(persist_directory):
+                    # 開始を待つ間に別の書き込みがあれば、df と index が古いため書き出さない
+                    if self._write_generations[persist_directory] != generation + 1:
+                        logger.info(f"コンパクションの開始前にデータベースが更新されたため中止します: {persist_directory}")
+                        return
+                    compacted_index = compact_faiss_index(index, tombstones)
+                    save_to_parquet(df, parquet_file)
+                    save_faiss_index(compacted_index, faiss_index_file)
+                    try:
+                        self.get_vector_sidecar(persist_directory).compact(df['chunk_id'].to_numpy())
+                    finally:
+                        self._drop_vector_sidecar(persist_directory)
+                    lexical_index = self._open_lexical_index(persist_directory)
+                    if lexical_index is not None and lexical_index.exists():
+                        lexical_index.compact(self.config.get('compaction_tombstone_ratio', 0.2))
+                    self._swap_compacted_index(index, compacted_index)
+                    # コンパクション中に追加された tombstone は残す
+                    save_tombstones(persist_directory, np.setdiff1d(load_tombstones(persist_directory), tombstones))
+                    if os.path.exists(hash_file):
+                        os.utime(hash_file, (os.path.getatime(parquet_file), os.path.getmtime(parquet_file)))
+                logger.info(f"コンパクションが完了しました: {persist_directory}")
+            except Exception as e:
+                logger.error(f"コンパクション中にエラーが発生しました: {str(e)}", exc_info=True)
+            finally:
+                self._compacting.discard(persist_directory)
+
+        threading.Thread(target=compact, name=f"compaction-{os.path.basename(persist_directory)}", daemon=True).start()
+
+    def _swap_compacted_index(self, index, compacted_index):
+        """保持している古いインデックスを、削除済みの行を取り除いたインデックスに差し替える"""
+        if self.faiss_index is index:
+            self.faiss_index = compacted_index
+        for cache_key, result in list(self._cache.items()):
+            if result[1] is index:
+                self._cache[cache_key] = result[:1] + (compacted_index,) + result[2:]
+
     def _create_new_db_and_index(self, source_config, document_files, current_hashes, parquet_file, faiss_index_file, hash_file):
+        """解析 → 分割 → エンベディング → 書き出しをグループ単位で流し、メモリ使用量をコーパスの大きさに依存させない"""
+        persist_directory = source_config['persist_directory']
+        vector_file = os.path.join(persist_directory, STAGING_VECTOR_FILE)
+        checkpoint = BuildCheckpoint(persist_directory, 'create')
+        processed_files = None
+        # インデックスとベクトルファイルの保存に成功するまで、既存のParquetファイルは置き換えない
+        chunk_writer = ChunkParquetWriter(parquet_file)
         try:
-            all_chunks = self._process_documents(document_files)
-            
-            logger.info(f"チャンク数: {len(all_chunks)}")
-            
-            all_vectors = self.process_chunks_with_progress(all_chunks)
-            
-            if all_vectors is None or len(all_vectors) == 0:
-                logger.error("ベクトルの生成に失敗しました")
-                return None, None, None, None, "ベクトルの生成に失敗しました"
+            embedding_cache = self.get_embedding_cache(persist_directory)
+            processed_files = prefetch(
+                iter_processed_documents(
+                    document_files,
+                    max_workers=self.config.get('parse_workers'),
+                    timeout=self.config.get('parse_timeout', DEFAULT_PARSE_TIMEOUT)),
+                maxsize=self.config.get('ingest_prefetch_size', DEFAULT_PREFETCH_SIZE))
 
-            logger.info(f"ベクトルの数: {len(all_vectors)}")
-            logger.info(f"ベクトルの型: {type(all_vectors)}")
-            logger.info(f"ベクトルの形状: {all_vectors.shape}")
+            chunk_ids = []
+            failed_files = []
+            total_chunks = 0
+            checkpoint.start(0)
+            lexical_index = self._open_lexical_index(persist_directory)
+            if lexical_index is not None:
+                lexical_index.clear()
+            with VectorFileWriter(vector_file) as vector_writer:
+                for chunks in iter_chunk_groups(processed_files, self.config.get('ingest_group_chunks', DEFAULT_GROUP_CHUNKS),
+                                                failed_files=failed_files):
+                    vectors = self.process_chunks_with_progress(chunks, embedding_cache=embedding_cache,
+                                                                dimensions=source_config.get('dimensions'))
+                    if vectors is None:
+                        # 完了したグループのベクトルはキャッシュに保存済みなので、次回はその続きから再開できる
+                        checkpoint.update(total_chunks)
+                        checkpoint.fail("エンベディングの生成に失敗しました")
+                        self._failed_builds.add(source_config['名称'])
+                        return None, None, None, None, checkpoint.failure_message()
 
-            df = pd.DataFrame({
-                'content': [chunk.page_content for chunk in all_chunks],
-                'source': [chunk.metadata['source'] for chunk in all_chunks],
-                'page': [str(chunk.metadata.get('page', 'N/A')) for chunk in all_chunks]
-            })
+                    group_df = pd.DataFrame({
+                        'content': [chunk.page_content for chunk in chunks],
+                        'source': [chunk.metadata['source'] for chunk in chunks],
+                        'page': [str(chunk.metadata.get('page', 'N/A')) for chunk in chunks]
+                    })
+                    group_df['chunk_id'] = make_chunk_ids(group_df['source'].tolist(), group_df['content'].tolist())
+                    chunk_writer.write(group_df)
+                    vector_writer.append(vectors)
+                    if lexical_index is not None:
+                        # マニフェストは最後に1回だけ書き、途中で失敗した場合は語彙インデックスも作られない
+                        lexical_index.add(group_df['chunk_id'].to_numpy(), group_df['content'].tolist(), commit=False)
+                    chunk_ids.append(group_df['chunk_id'].to_numpy())
+                    total_chunks += len(chunks)
+                    checkpoint.update(total_chunks, total_chunks)
+                    logger.info(f"書き出し済みチャンク数: {total_chunks}")
 
-            save_to_parquet(df, parquet_file, is_web_source=False)
+                if total_chunks == 0:
+                    logger.error("空のベクトル配列のため、FAISSインデックスを作成できません")
+                    return None, None, None, None, "空のベクトル配列のため、FAISSインデックスを作成できません"
 
-            logger.info(f"NumPy配列の形状: {all_vectors.shape}")
-            
-            if all_vectors.shape[0] > 0:
-                self.faiss_index = create_faiss_index(all_vectors)
-                save_faiss_index(self.faiss_index, faiss_index_file)
-            else:
-                logger.error("空のベクトル配列のため、FAISSインデックスを作成できません")
-                return None, None, None, None, "空のベクトル配列のため、FAISSインデックスを作成できません"
+            all_vectors = vector_writer.open_memmap()
+            logger.info(f"ベクトルの形状: {all_vectors.shape}")
+            self.faiss_index = create_faiss_index(all_vectors, np.concatenate(chunk_ids),
+                                                  index_type=source_config.get('index_type', 'flat'),
+                                                  index_options=source_config.get('index_options'))
+            set_embedding_info(self.faiss_index, source_config['embeddings_model'], source_config.get('dimensions'))
+            save_faiss_index(self.faiss_index, faiss_index_file)
+            self.get_vector_sidecar(persist_directory).write(np.concatenate(chunk_ids), all_vectors)
+            self._drop_vector_sidecar(persist_directory)
+            del all_vectors
+            chunk_writer.close()
+            if lexical_index is not None:
+                lexical_index.commit()
+            save_tombstones(persist_directory, [])
 
+            if failed_files:
+                current_hashes = dict(current_hashes)
+                self._skip_failed_files(failed_files, current_hashes, {})
             save_file_hashes(current_hashes, hash_file)
             os.utime(hash_file, (os.path.getatime(parquet_file), os.path.getmtime(parquet_file)))
+            checkpoint.complete()
 
+            df = load_from_parquet(parquet_file)
             return df, self.faiss_index, None, self.embeddings, "新しいデータベースを作成しました。"
         except Exception as e:
             logger.error(f"データベースの作成中にエラーが発生しました: {str(e)}", exc_info=True)
             return None, None, None, None, f"データベースの作成中にエラーが発生しました: {str(e)}"
+        finally:
+            # 途中で終了した場合も解析用のスレッドとプロセスプールを止める
+            if processed_files is not None:
+                processed_files.close()
+            # close() 済みなら何もしない。途中で失敗した場合は書きかけのParquetファイルを捨てる
+            chunk_writer.abort()
+            if os.path.exists(vector_file):
+                os.remove(vector_file)
 
     def load_or_create_web_db(self, source_config):
         logger.info(f"load_or_create_web_db が呼び出されました: {source_config['名称']}")
@@ -350,9 +888,9 @@ class DatabaseManager:
                 logger.info("既存のデータベースファイルが見つかりました。読み込みを試みます。")
                 try:
                     df = load_from_parquet(parquet_file, is_web_source=True)
-                    index = load_faiss_index(faiss_index_file)
+                    index = load_faiss_index(faiss_index_file, mmap=source_config.get('index_mmap', DEFAULT_INDEX_MMAP))
                     role = generate_role_from_db(df, source_config)
-                    embeddings = OpenAIEmbeddings(model=source_config['embeddings_model'])
+                    embeddings = OpenAIEmbeddings(model=source_config['embeddings_model'], dimensions=source_config.get('dimensions'))
                     logger.info("既存のデータベースを正常に読み込みました。")
                     return df, index, role, embeddings, "既存のWebデータベースを読み込みました。"
                 except Exception as e:
@@ -370,6 +908,10 @@ class DatabaseManager:
             # 新しいデータベースを保存
             save_to_parquet(df, parquet_file, is_web_source=True)
             save_faiss_index(index, faiss_index_file)
+            # 古い語彙インデックスは捨て、load_or_create_db で新しいデータフレームから作り直す
+            lexical_index = self._open_lexical_index(persist_directory_web)
+            if lexical_index is not None:
+                lexical_index.clear()
             
             return df, index, role, embeddings, "新しいWebデータベースを作成しました。"
 
@@ -383,13 +925,22 @@ class DatabaseManager:
             logger.info(f"キャッシュされたデータベースを使用します: {cache_key}")
             return self._cache[cache_key]
 
+        self._failed_builds.discard(cache_key)
         result = self.load_or_create_db(source_config)
-        self._cache[cache_key] = result
+        if self._is_cacheable(cache_key, result):
+            self._cache[cache_key] = result
         return result
     
     def clear_cache(self):
         self._cache.clear()
+        self._metadata_indexes.clear()
+        self._lexical_indexes.clear()
+        self._vector_sidecars.clear()
+        self._failed_builds.clear()
         self.faiss_index = None
+        for embedding_cache in self._embedding_caches.values():
+            embedding_cache.close()
+        self._embedding_caches.clear()
         logger.info("DatabaseManagerのキャッシュをクリアしました")
 
 # 以下の関数はクラスの外部に配置されます
@@ -418,12 +969,146 @@ def generate_role_from_db(df, config):
     response = llm.invoke(messages)
     return response.content.strip()
 
-def search_db(query, df, index, embeddings, k=5):
-    query_vector = embeddings.embed_query(query)
-    query_vector_np = np.array(query_vector).reshape(1, -1)  # NumPy配列に変換し、2D形状に変更
-    D, I = index.search(query_vector_np, k)
-    return [{
-        'content': df.iloc[i]['content'],
-        'source': df.iloc[i].get('source') or df.iloc[i]['metadata'].get('source', 'Unknown'),
-        'page': df.iloc[i].get('page') or df.iloc[i]['metadata'].get('title', 'N/A')
-    } for i in I[0]]
\ No newline at end of file
+def _column_values(rows, column, metadata_key, default):
+    """列がなければ metadata 列の値を使い、行ごとの値を配列で返す"""
+    if column in rows.columns:
+        values = rows[column].to_numpy(dtype=object)
+    else:
+        values = np.full(len(rows), None, dtype=object)
+    missing = np.array([not value for value in values], dtype=bool)
+    if missing.any():
+        if 'metadata' in rows.columns:
+            metadata = rows['metadata'].to_numpy(dtype=object)
+            values[missing] = [meta.get(metadata_key, default) if meta else default for meta in metadata[missing]]
+        else:
+            values[missing] = default
+    return values
+
+def _lexical_documents(df):
+    """語彙インデックスに登録する (チャンクID, 本文)。チャンクIDのないデータベースは行位置をIDとして使う"""
+    if isinstance(df, ChunkStore):
+        ids = df.chunk_ids if df.chunk_ids is not None else np.arange(df.table.num_rows, dtype=np.int64)
+        texts = df.table.column('content').to_pylist()
+        if df.live_mask is not None:
+            ids = ids[df.live_mask]
+            texts = [text for text, live in zip(texts, df.live_mask) if live]
+        return ids, texts
+    ids = df['chunk_id'].to_numpy(dtype=np.int64) if 'chunk_id' in df.columns else np.arange(len(df), dtype=np.int64)
+    return ids, df['content'].tolist()
+
+def search_vectors(query_vectors, df, index, k=5, filters=None, metadata_index=None, vector_sidecar=None):
+    """複数のクエリベクトルをまとめて検索し、クエリごとの (行位置, 距離, ID) を返す
+
+    FAISSが返す -1 や削除済み (tombstone) のIDは除き、各クエリで k 件揃うまで取得件数を増やす。
+    filters を指定すると、一致するチャンクだけを探索対象にして検索する (metadata_filter.FILTER_KEYS を参照)
+    """
+    query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+    if index.ntotal == 0 or len(query_vectors) == 0:
+        return [(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64))
+                for _ in range(len(query_vectors))]
+    if filters:
+        if metadata_index is None:
+            metadata_index = MetadataIndex.from_frame(df)
+        # 削除済みの行は候補に含まれないため、取得件数を増やす必要はない
+        D, I = search_filtered(query_vectors, index, metadata_index, filters, k, vector_sidecar)
+        positions = positions_for_ids(df, I.ravel()).reshape(I.shape)
+        valid = (I >= 0) & (positions >= 0)
+    else:
+        fetch_k = k
+        while True:
+            D, I = index.search(query_vectors, min(fetch_k, index.ntotal))
+            positions = positions_for_ids(df, I.ravel()).reshape(I.shape)
+            valid = (I >= 0) & (positions >= 0)
+            if valid.sum(axis=1).min() >= k or fetch_k >= index.ntotal:
+                break
+            fetch_k *= 2
+    results = []
+    for row_positions, row_distances, row_ids, row_valid in zip(positions, D, I, valid):
+        results.append((row_positions[row_valid][:k], row_distances[row_valid][:k], row_ids[row_valid][:k]))
+    return results
+
+def hydrate_results(df, hits):
+    """search_vectors の結果に本文と参照元を付ける。全クエリの行をまとめて1回だけ取り出す"""
+    all_positions = np.concatenate([positions for positions, _, _ in hits]) if hits else np.empty(0, dtype=np.int64)
+    unique_positions, inverse = np.unique(all_positions, return_inverse=True)
+    rows = take_rows(df, unique_positions)
+    contents = rows['content'].to_numpy(dtype=object)
+    sources = _column_values(rows, 'source', 'source', 'Unknown')
+    pages = _column_values(rows, 'page', 'title', 'N/A')
+
+    results = []
+    offset = 0
+    for positions, distances, ids in hits:
+        row_indices = inverse[offset:offset + len(positions)]
+        offset += len(positions)
+        results.append([{
+            'content': contents[j],
+            'source': sources[j],
+            'page': pages[j],
+            'distance': float(distance),
+            'chunk_id': int(chunk_id)
+        } for j, distance, chunk_id in zip(row_indices, distances, ids)])
+    return results
+
+def fuse_lexical_hits(queries, hits, df, lexical_index, k=5, filters=None, metadata_index=None, rrf_k=DEFAULT_RRF_K,
+                      lexical_k=50):
+    """ベクトル検索の結果と語彙インデックスの BM25 の結果を RRF で統合し、search_vectors と同じ形で返す
+
+    語彙検索だけで見つかったチャンクの距離は NaN とする
+    """
+    allowed_ids = None
+    if filters:
+        if metadata_index is None:
+            metadata_index = MetadataIndex.from_frame(df)
+        allowed_ids = metadata_index.select(filters)
+    fused = []
+    for query, (positions, distances, ids) in zip(queries, hits):
+        lexical_ids, _ = lexical_index.search(query, lexical_k, allowed_ids)
+        # 語彙インデックスへの削除の反映が遅れていても、データフレームにない行は返さない
+        lexical_ids = lexical_ids[positions_for_ids(df, lexical_ids) >= 0]
+        fused_ids, _ = reciprocal_rank_fusion([ids, lexical_ids], rrf_k)
+        fused_ids = fused_ids[:k]
+        distance_by_id = dict(zip(ids.tolist(), distances.tolist()))
+        fused_distances = np.array([distance_by_id.get(chunk_id, np.nan) for chunk_id in fused_ids.tolist()],
+                                   dtype=np.float32)
+        fused.append((positions_for_ids(df, fused_ids), fused_distances, fused_ids))
+    return fused
+
+def _search_hits(queries, query_vectors, df, index, k, filters, metadata_index, vector_sidecar, lexical_index,
+                 rrf_k, lexical_k, mmr, mmr_lambda, mmr_fetch_k):
+    # MMR を使う場合は mmr_fetch_k 件の候補を取り、その中から多様な k 件を選ぶ
+    candidate_k = max(k, mmr_fetch_k) if mmr else k
+    if lexical_index is None:
+        hits = search_vectors(query_vectors, df, index, candidate_k, filters, metadata_index, vector_sidecar)
+    else:
+        # 統合後の順位が安定するよう、ベクトル検索も語彙検索と同じ件数まで取得する
+        fetch_k = max(candidate_k, lexical_k)
+        hits = search_vectors(query_vectors, df, index, fetch_k, filters, metadata_index, vector_sidecar)
+        hits = fuse_lexical_hits(queries, hits, df, lexical_index, candidate_k, filters, metadata_index, rrf_k, fetch_k)
+    if mmr:
+        hits = rerank_hits(query_vectors, hits, k, index, vector_sidecar, mmr_lambda)
+    return hits
+
+def search_db_batch(queries, df, index, embeddings, k=5, filters=None, metadata_index=None, vector_sidecar=None,
+                    lexical_index=None, rrf_k=DEFAULT_RRF_K, lexical_k=50, mmr=False, mmr_lambda=DEFAULT_MMR_LAMBDA,
+                    mmr_fetch_k=DEFAULT_MMR_FETCH_K):
+    """複数のクエリを1回のAPI呼び出しで埋め込み、1回の index.search で検索する"""
+    if not queries:
+        return []
+    query_vectors = np.array(embeddings.embed_documents(list(queries)), dtype=np.float32)
+    return hydrate_results(df, _search_hits(list(queries), query_vectors, df, index, k, filters, metadata_index,
+                                            vector_sidecar, lexical_index, rrf_k, lexical_k,
+                                            mmr, mmr_lambda, mmr_fetch_k))
+
+def search_db(query, df, index, embeddings, k=5, filters=None, metadata_index=None, vector_sidecar=None,
+              lexical_index=None, rrf_k=DEFAULT_RRF_K, lexical_k=50, mmr=False, mmr_lambda=DEFAULT_MMR_LAMBDA,
+              mmr_fetch_k=DEFAULT_MMR_FETCH_K):
+    """lexical_index を渡すと、ベクトル検索と語彙検索を RRF で統合したハイブリッド検索になる。
+    mmr=True のときは候補を mmr_fetch_k 件取得し、保存済みのベクトルを使って MMR で重複の少ない k 件を選ぶ
+    """
+    if index.ntotal == 0:
+        return []
+    query_vector = np.array(embeddings.embed_query(query), dtype=np.float32).reshape(1, -1)
+    return hydrate_results(df, _search_hits([query], query_vector, df, index, k, filters, metadata_index,
+                                            vector_sidecar, lexical_index, rrf_k, lexical_k,
+                                            mmr, mmr_lambda, mmr_fetch_k))[0]
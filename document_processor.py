@@ -1,7 +1,12 @@
 # document_processor.py
 import os
+import time
+import queue
+import signal
+import multiprocessing
 import pandas as pd
 from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import docx
 import xlrd
 import csv
@@ -14,6 +19,9 @@ import logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 1ファイルあたりの解析時間の上限 (秒)
+DEFAULT_PARSE_TIMEOUT = 300
+
 def find_documents(folder_path):
     document_files = []
     for root, _, files in os.walk(folder_path):
@@ -135,6 +143,7 @@ def process_pptx(file_path):
         return None
 
 def process_document(file_path):
+    """ファイルを読み込んでチャンクに分割する。読み込みに失敗した場合は None を返す (空のファイルの [] と区別する)"""
     file_extension = os.path.splitext(file_path)[1].lower()
     
     try:
@@ -155,13 +164,103 @@ def process_document(file_path):
             raise ValueError(f"Unsupported file type: {file_extension}")
 
         if documents is None:
-            return []
+            return None
 
         text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=200, separator="\n")
         return text_splitter.split_documents(documents)
     except Exception as e:
         logger.error(f"ファイル {file_path} の処理中にエラーが発生しました: {e}")
-        return []
+        return None
+
+def _register_worker(pid_queue):
+    pid_queue.put(os.getpid())
+
+class _ParsePool:
+    """ProcessPoolExecutor と、initializer で各ワーカーから通知されたPID
+
+    応答しないワーカーは shutdown では止まらないため、通知されたPIDのプロセスを直接終了させる
+    """
+
+    def __init__(self, max_workers):
+        context = multiprocessing.get_context()
+        self._pid_queue = context.Queue()
+        self.executor = ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                                            initializer=_register_worker, initargs=(self._pid_queue,))
+
+    def submit(self, fn, *args):
+        return self.executor.submit(fn, *args)
+
+    def _worker_pids(self):
+        pids = set()
+        while True:
+            try:
+                pids.add(self._pid_queue.get_nowait())
+            except (queue.Empty, OSError, ValueError):
+                return pids
+
+    def terminate(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for pid in self._worker_pids():
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                # 既に終了したワーカー
+                pass
+        self._pid_queue.close()
+
+def iter_processed_documents(document_files, max_workers=None, timeout=DEFAULT_PARSE_TIMEOUT):
+    """process_document をプロセスプールで並列に実行し、完了したファイルから順に (ファイル, チャンク) を返す
+
+    失敗したファイルと timeout 秒を超えたファイルはチャンクを None として返し、
+    プールを作り直して残りのファイルの処理を続ける
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    document_files = list(document_files)
+    if max_workers <= 1 or len(document_files) <= 1:
+        for doc_file in document_files:
+            yield doc_file, process_document(doc_file)
+        return
+
+    pending_files = iter(document_files)
+    executor = _ParsePool(max_workers)
+    running = {}
+    try:
+        while True:
+            # 投入数をワーカー数までに抑え、待ち時間がタイムアウトに含まれないようにする
+            while len(running) < max_workers:
+                doc_file = next(pending_files, None)
+                if doc_file is None:
+                    break
+                running[executor.submit(process_document, doc_file)] = (doc_file, time.monotonic() + timeout)
+            if not running:
+                break
+
+            next_deadline = min(deadline for _, deadline in running.values())
+            done, _ = wait(list(running), timeout=max(next_deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            for future in done:
+                doc_file, _ = running.pop(future)
+                try:
+                    chunks = future.result()
+                except Exception as e:
+                    logger.error(f"ファイル {doc_file} の処理中にエラーが発生しました: {e}")
+                    chunks = None
+                yield doc_file, chunks
+
+            now = time.monotonic()
+            expired = [future for future, (_, deadline) in running.items() if deadline <= now]
+            if expired:
+                for future in expired:
+                    doc_file, _ = running.pop(future)
+                    logger.error(f"ファイル {doc_file} の処理が {timeout} 秒を超えたため中断しました")
+                    yield doc_file, None
+                executor.terminate()
+                executor = _ParsePool(max_workers)
+                # 巻き添えで止まった処理中のファイルは新しいプールで再実行する
+                resubmit = [doc_file for doc_file, _ in running.values()]
+                running = {executor.submit(process_document, doc_file): (doc_file, time.monotonic() + timeout)
+                           for doc_file in resubmit}
+    finally:
+        executor.terminate()
 
 def process_all_documents(folder_path):
     logger.info(f"文書処理を開始: {folder_path}")
@@ -173,7 +272,7 @@ def process_all_documents(folder_path):
     all_chunks = []
     for doc_file in document_files:
         logger.info(f"処理中: {doc_file}")
-        chunks = process_document(doc_file)
+        chunks = process_document(doc_file) or []
         all_chunks.extend(chunks)
         logger.info(f"処理完了: {doc_file}, チャンク数: {len(chunks)}")
     
@@ -191,7 +290,7 @@ def process_changed_documents(folder_path, changed_files):
     changed_chunks = []
     for doc_file in changed_files:
         logger.info(f"変更ファイルを処理中: {doc_file}")
-        chunks = process_document(doc_file)
+        chunks = process_document(doc_file) or []
         changed_chunks.extend(chunks)
         logger.info(f"変更ファイル処理完了: {doc_file}, チャンク数: {len(chunks)}")
     
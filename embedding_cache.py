@@ -0,0 +1,169 @@
+# embedding_cache.py
+import os
+import sqlite3
+import hashlib
+import threading
+import logging
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CACHE_FILE = 'embedding_cache.sqlite3'
+
+# SQLiteのバインド変数上限を超えないように分割して問い合わせる
+_LOOKUP_CHUNK_SIZE = 500
+
+def cache_model_key(model, dimensions=None):
+    """次元数を指定したエンベディングは、同じモデルの元の次元数のものと区別して保存する"""
+    return f"{model}:{dimensions}" if dimensions else model
+
+def hash_text(text):
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+class EmbeddingCache:
+    """(embeddings_model, チャンク本文のハッシュ) をキーにしたエンベディングの永続キャッシュ"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash BLOB NOT NULL,
+                dim INTEGER NOT NULL,
+                vector BLOB NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            ) WITHOUT ROWID
+        """)
+        self._conn.commit()
+        logger.info(f"エンベディングキャッシュを開きました: {db_path}")
+
+    @classmethod
+    def for_directory(cls, persist_directory):
+        os.makedirs(persist_directory, exist_ok=True)
+        return cls(os.path.join(persist_directory, EMBEDDING_CACHE_FILE))
+
+    def get_many(self, model, texts):
+        """textsと同じ順序で、キャッシュ済みならfloat32ベクトル、未登録ならNoneを返す"""
+        hashes = [hash_text(text) for text in texts]
+        found = {}
+        unique_hashes = list(set(hashes))
+        with self._lock:
+            for i in range(0, len(unique_hashes), _LOOKUP_CHUNK_SIZE):
+                chunk = unique_hashes[i:i + _LOOKUP_CHUNK_SIZE]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *chunk]
+                ).fetchall()
+                for text_hash, vector in rows:
+                    found[bytes(text_hash)] = np.frombuffer(vector, dtype=np.float32)
+
+        results = [found.get(h) for h in hashes]
+        hits = sum(1 for r in results if r is not None)
+        logger.info(f"エンベディングキャッシュ: ヒット {hits} / {len(texts)} (モデル: {model})")
+        return results
+
+    def put_many(self, model, texts, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        rows = [(model, hash_text(text), vector.shape[0], vector.tobytes())
+                for text, vector in zip(texts, vectors)]
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, dim, vector) VALUES (?, ?, ?, ?)",
+                rows
+            )
+            self._conn.commit()
+        logger.debug(f"エンベディングキャッシュに {len(rows)} 件を保存しました")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def normalize_query(text):
+    """表記ゆれで別のキーにならないよう、NFKC正規化して前後と連続する空白を詰める"""
+    return " ".join(unicodedata.normalize('NFKC', text).split())
+
+class QueryEmbeddingCache:
+    """検索クエリのエンベディングをキャッシュする Embeddings のラッパー
+
+    (モデル, 次元数, 正規化したクエリ) をキーに、件数を制限したメモリ上の LRU と、
+    指定があれば再起動後も残る SQLite のキャッシュの2段で引く。どちらにもなければ元の Embeddings を呼ぶ
+    """
+
+    def __init__(self, embeddings, model, dimensions=None, max_entries=1024, disk_cache=None):
+        self.embeddings = embeddings
+        self.model_key = f"query:{cache_model_key(model, dimensions)}"
+        self.max_entries = max_entries
+        self.disk_cache = disk_cache
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def __getattr__(self, name):
+        # embed_query / embed_documents 以外は元の Embeddings に任せる
+        if name == 'embeddings':
+            raise AttributeError(name)
+        return getattr(self.embeddings, name)
+
+    def _remember(self, key, vector):
+        with self._lock:
+            self._lru[key] = vector
+            self._lru.move_to_end(key)
+            while len(self._lru) > self.max_entries:
+                self._lru.popitem(last=False)
+
+    def embed_documents(self, texts):
+        keys = [normalize_query(text) for text in texts]
+        results = [None] * len(keys)
+        with self._lock:
+            for i, key in enumerate(keys):
+                if key in self._lru:
+                    self._lru.move_to_end(key)
+                    results[i] = self._lru[key]
+                    self.memory_hits += 1
+
+        missing = [i for i, vector in enumerate(results) if vector is None]
+        if missing and self.disk_cache is not None:
+            for i, vector in zip(missing, self.disk_cache.get_many(self.model_key, [keys[i] for i in missing])):
+                if vector is not None:
+                    results[i] = vector
+                    self.disk_hits += 1
+                    self._remember(keys[i], vector)
+            missing = [i for i in missing if results[i] is None]
+
+        if missing:
+            # 同じクエリが複数含まれていても1回だけ埋め込む
+            unique_keys = list(dict.fromkeys(keys[i] for i in missing))
+            vectors = np.asarray(self.embeddings.embed_documents(unique_keys), dtype=np.float32)
+            by_key = dict(zip(unique_keys, vectors))
+            for key, vector in by_key.items():
+                self._remember(key, vector)
+            if self.disk_cache is not None:
+                self.disk_cache.put_many(self.model_key, unique_keys, vectors)
+            for i in missing:
+                results[i] = by_key[keys[i]]
+            self.misses += len(missing)
+
+        logger.info(f"クエリエンベディングキャッシュ: {self.stats()}")
+        return [vector.tolist() for vector in results]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            'entries': len(self._lru)
+        }
@@ -0,0 +1,109 @@
+# embedding_engine.py
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from openai import AsyncOpenAI, RateLimitError
+from tenacity import retry, wait_exponential, stop_after_attempt
+from rate_limiter import get_rate_limiter
+from token_counter import make_token_batches, MAX_EMBEDDING_BATCH_TOKENS, MAX_EMBEDDING_BATCH_INPUTS, MAX_EMBEDDING_INPUT_TOKENS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_IN_FLIGHT = 4
+
+def supports_dimensions(model):
+    """dimensions パラメータで短いベクトルを返せるモデルか (text-embedding-3 系のみ)"""
+    return model.startswith('text-embedding-3')
+
+def run_coroutine_sync(coro):
+    """イベントループ実行中のスレッドからでも呼べるように、必要なら別スレッドで asyncio.run する"""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+class AsyncEmbeddingEngine:
+    """最大 max_in_flight 個のバッチを同時に送信し、結果を元のチャンク順で float32 行列に書き込む"""
+
+    def __init__(self, model, max_in_flight=DEFAULT_MAX_IN_FLIGHT, rate_limiter=None, base_url=None, api_key=None,
+                 batch_max_tokens=MAX_EMBEDDING_BATCH_TOKENS, batch_max_inputs=MAX_EMBEDDING_BATCH_INPUTS,
+                 max_input_tokens=MAX_EMBEDDING_INPUT_TOKENS, dimensions=None):
+        self.model = model
+        self.dimensions = dimensions
+        self.max_in_flight = max(1, int(max_in_flight))
+        self.batch_max_tokens = batch_max_tokens
+        self.batch_max_inputs = batch_max_inputs
+        self.max_input_tokens = max_input_tokens
+        self.rate_limiter = rate_limiter or get_rate_limiter(model)
+        # base_url を指定するとローカルの疑似エンドポイントに向けられる
+        self.base_url = base_url
+        self.api_key = api_key
+
+    def _create_client(self):
+        # AsyncOpenAI はイベントループに紐づくため、実行ごとに作成する
+        # 429 の再送はレートリミッターの待機を挟む _embed_batch で行うため、クライアント側では再送しない
+        return AsyncOpenAI(base_url=self.base_url, api_key=self.api_key, max_retries=0)
+
+    @retry(wait=wait_exponential(multiplier=1, min=4, max=60), stop=stop_after_attempt(5), reraise=True)
+    async def _embed_batch(self, client, texts, token_count):
+        # APIは空文字列を受け付けないため空白1文字に置き換える
+        texts = [text if text else " " for text in texts]
+        await self.rate_limiter.acquire_async(token_count)
+        try:
+            options = {'dimensions': self.dimensions} if self.dimensions else {}
+            raw_response = await client.embeddings.with_raw_response.create(model=self.model, input=texts, **options)
+        except RateLimitError as e:
+            self.rate_limiter.on_rate_limited(e.response.headers)
+            raise
+        except Exception as e:
+            logger.error(f"Embeddings生成中にエラーが発生しました: {str(e)}")
+            raise
+        self.rate_limiter.update_from_headers(raw_response.headers)
+        self.rate_limiter.on_success()
+        response = raw_response.parse()
+        data = sorted(response.data, key=lambda item: item.index)
+        return np.array([item.embedding for item in data], dtype=np.float32)
+
+    async def _embed_all(self, texts, batches, on_batch_done):
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        result = {'matrix': None}
+
+        async def worker(batch):
+            async with semaphore:
+                vectors = await self._embed_batch(client, [texts[i] for i in batch.indices], batch.token_count)
+            if result['matrix'] is None:
+                result['matrix'] = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+            result['matrix'][batch.indices] = vectors
+            logger.info(f"バッチ完了: {len(batch.indices)} チャンク, {batch.token_count} トークン")
+            if on_batch_done is not None:
+                on_batch_done(batch.indices, vectors, batch.token_count)
+
+        client = self._create_client()
+        try:
+            outcomes = await asyncio.gather(*(worker(batch) for batch in batches), return_exceptions=True)
+        finally:
+            await client.close()
+
+        # 失敗したバッチがあっても、完了したバッチは on_batch_done で保存済み
+        errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+        if errors:
+            logger.error(f"{len(errors)} / {len(batches)} バッチのエンベディングに失敗しました")
+            raise errors[0]
+        return result['matrix']
+
+    def embed(self, texts, on_batch_done=None):
+        """texts をトークン予算ごとのバッチに分けて並列で埋め込み、(len(texts), dim) の float32 行列を返す
+
+        on_batch_done(indices, vectors, token_count) はバッチが完了するたびに呼ばれる
+        """
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        batches, request_texts = make_token_batches(
+            texts, self.model, max_tokens_per_batch=self.batch_max_tokens,
+            max_inputs_per_batch=self.batch_max_inputs, max_tokens_per_input=self.max_input_tokens)
+        total_tokens = sum(batch.token_count for batch in batches)
+        logger.info(f"{len(texts)} チャンク ({total_tokens} トークン) を {len(batches)} バッチで埋め込みます (同時実行数: {self.max_in_flight})")
+        return run_coroutine_sync(self._embed_all(request_texts, batches, on_batch_done))
@@ -5,20 +5,80 @@ import json
 import requests
 from datetime import datetime, timedelta
 import logging
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 logger = logging.getLogger(__name__)
 
-def calculate_file_hash(file_path):
+DEFAULT_HASH_ALGORITHM = 'md5'
+HASH_READ_SIZE = 1024 * 1024
+DEFAULT_HASH_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+def resolve_hash_algorithm(algorithm):
+    """実際に使うハッシュアルゴリズム。xxhash がインストールされていなければ blake2b"""
+    if algorithm == 'xxhash' and xxhash is None:
+        return 'blake2b'
+    return algorithm
+
+def _new_hasher(algorithm):
+    if algorithm == 'xxhash' and xxhash is not None:
+        return xxhash.xxh3_128()
+    return hashlib.new(resolve_hash_algorithm(algorithm))
+
+def calculate_file_hash(file_path, algorithm=DEFAULT_HASH_ALGORITHM):
     try:
-        hash_md5 = hashlib.md5()
+        hasher = _new_hasher(algorithm)
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+            for chunk in iter(lambda: f.read(HASH_READ_SIZE), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
     except Exception as e:
         logger.error(f"ファイルハッシュの計算中にエラーが発生しました: {file_path}, エラー: {str(e)}")
         return None
 
+def file_hash(entry):
+    """ハッシュマニフェストの値からハッシュ文字列を取り出す (旧形式はハッシュ文字列のみ)"""
+    if isinstance(entry, dict):
+        return entry.get('hash')
+    return entry
+
+def _entry_algorithm(entry):
+    """記録に使われたアルゴリズム (旧形式とアルゴリズムの記録がない値は md5)"""
+    if isinstance(entry, dict):
+        return entry.get('algorithm') or DEFAULT_HASH_ALGORITHM
+    return DEFAULT_HASH_ALGORITHM
+
+def _hash_for_comparison(file_path, old_entry, algorithm):
+    """(ハッシュ, 使ったアルゴリズム) を返す
+
+    前回と異なるアルゴリズムで記録されたファイルは、まず前回のアルゴリズムでハッシュする。
+    内容が同じなら前回のアルゴリズムのまま引き継ぎ、設定の変更だけで変更扱いにならないようにする
+    """
+    old_algorithm = _entry_algorithm(old_entry)
+    if (old_entry is not None and old_algorithm != algorithm
+            and resolve_hash_algorithm(old_algorithm) == old_algorithm):
+        previous_hash = calculate_file_hash(file_path, old_algorithm)
+        if previous_hash is not None and previous_hash == file_hash(old_entry):
+            return previous_hash, old_algorithm
+    return calculate_file_hash(file_path, algorithm), algorithm
+
+def _stat_or_none(file_path):
+    try:
+        return os.stat(file_path)
+    except OSError as e:
+        logger.error(f"ファイル情報の取得中にエラーが発生しました: {file_path}, エラー: {str(e)}")
+        return None
+
+def _stat_unchanged(entry, stat):
+    return (isinstance(entry, dict)
+            and entry.get('size') == stat.st_size
+            and entry.get('mtime_ns') == stat.st_mtime_ns
+            and entry.get('inode') == stat.st_ino)
+
 def save_file_hashes(hashes, file_path):
     try:
         with open(file_path, 'w') as f:
@@ -27,6 +87,14 @@ def save_file_hashes(hashes, file_path):
     except Exception as e:
         logger.error(f"ファイルハッシュの保存中にエラーが発生しました: {file_path}, エラー: {str(e)}")
 
+def refresh_file_hashes(current_hashes, file_path):
+    """内容は変わらずファイル情報だけが変わった場合にマニフェストを更新する (更新日時は維持する)"""
+    if not os.path.exists(file_path) or load_file_hashes(file_path) == current_hashes:
+        return
+    stat = os.stat(file_path)
+    save_file_hashes(current_hashes, file_path)
+    os.utime(file_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
 def load_file_hashes(file_path):
     try:
         if os.path.exists(file_path):
@@ -38,14 +106,14 @@ def load_file_hashes(file_path):
         logger.error(f"ファイルハッシュの読み込み中にエラーが発生しました: {file_path}, エラー: {str(e)}")
         return {}
 
-def check_file_changes(files_or_url, hash_file, is_website=False):
+def check_file_changes(files_or_url, hash_file, is_website=False, algorithm=DEFAULT_HASH_ALGORITHM, max_workers=DEFAULT_HASH_WORKERS):
     old_hashes = load_file_hashes(hash_file)
     logger.debug(f"ロードされた古いハッシュ: {old_hashes}")
     
     if is_website:
         return check_website_changes(files_or_url, old_hashes)
     else:
-        return check_file_system_changes(files_or_url, old_hashes)
+        return check_file_system_changes(files_or_url, old_hashes, algorithm=algorithm, max_workers=max_workers)
 
 def check_website_changes(url, old_hashes):
     current_time = datetime.now()
@@ -62,19 +130,59 @@ def check_website_changes(url, old_hashes):
     logger.info(f"ウェブサイトに変更があるため、再生成します: {url}")
     return True, {url: current_time.strftime('%Y-%m-%d %H:%M:%S')}
 
-def check_file_system_changes(files, old_hashes):
+def check_file_system_changes(files, old_hashes, algorithm=DEFAULT_HASH_ALGORITHM, max_workers=DEFAULT_HASH_WORKERS):
+    """(サイズ, mtime_ns, inode) が前回と同じファイルはハッシュ計算を省略し、変わったファイルだけを並列でハッシュする"""
+    # マニフェストには実際に使ったアルゴリズムを記録する
+    resolved_algorithm = resolve_hash_algorithm(algorithm)
+    if resolved_algorithm != algorithm:
+        logger.warning(f"{algorithm} がインストールされていないため {resolved_algorithm} を使用します")
+        algorithm = resolved_algorithm
     current_hashes = {}
     files_changed = False
-    for file_path in files:
-        current_hash = calculate_file_hash(file_path)
-        if current_hash is None:
-            continue
-        current_hashes[file_path] = current_hash
-        logger.debug(f"ファイル: {file_path}, 古いハッシュ: {old_hashes.get(file_path)}, 新しいハッシュ: {current_hash}")
-        
-        if old_hashes.get(file_path) != current_hash:
-            logger.info(f"変更が検出されたファイル: {file_path}")
-            files_changed = True
+    files = list(files)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        stats = list(executor.map(_stat_or_none, files))
+
+        files_to_hash = []
+        for file_path, stat in zip(files, stats):
+            old_entry = old_hashes.get(file_path)
+            if stat is None:
+                # 読み込めなかったファイルを削除扱いにしないよう、前回のハッシュを引き継ぐ
+                if old_entry is not None:
+                    current_hashes[file_path] = old_entry
+                continue
+            if _stat_unchanged(old_entry, stat):
+                current_hashes[file_path] = old_entry
+            else:
+                files_to_hash.append((file_path, stat))
+
+        logger.info(f"ハッシュを再計算するファイル: {len(files_to_hash)} / {len(files)}")
+        hashes = executor.map(lambda item: _hash_for_comparison(item[0], old_hashes.get(item[0]), algorithm), files_to_hash)
+
+        for (file_path, stat), (current_hash, hash_algorithm) in zip(files_to_hash, hashes):
+            old_entry = old_hashes.get(file_path)
+            if current_hash is None:
+                if old_entry is not None:
+                    current_hashes[file_path] = old_entry
+                continue
+            current_hashes[file_path] = {
+                'hash': current_hash,
+                'algorithm': hash_algorithm,
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'inode': stat.st_ino
+            }
+            logger.debug(f"ファイル: {file_path}, 古いハッシュ: {file_hash(old_entry)}, 新しいハッシュ: {current_hash}")
+
+            if file_hash(old_entry) != current_hash:
+                logger.info(f"変更が検出されたファイル: {file_path}")
+                files_changed = True
+    
+    deleted_files = find_deleted_files(old_hashes, current_hashes)
+    if deleted_files:
+        logger.info(f"削除または移動されたファイル: {deleted_files}")
+        files_changed = True
     
     if files_changed:
         logger.info("変更が検出されました。新しいハッシュを返します。")
@@ -83,6 +191,9 @@ def check_file_system_changes(files, old_hashes):
     
     return files_changed, current_hashes
 
+def find_deleted_files(old_hashes, current_hashes):
+    return [file_path for file_path in old_hashes if file_path not in current_hashes]
+
 def get_website_last_modified(url):
     try:
         response = requests.head(url)
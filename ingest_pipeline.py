@@ -0,0 +1,75 @@
+# ingest_pipeline.py
+import queue
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PREFETCH_SIZE = 32
+DEFAULT_GROUP_CHUNKS = 2000
+
+_END = object()
+
+class _ProducerError:
+    def __init__(self, error):
+        self.error = error
+
+def prefetch(iterable, maxsize=DEFAULT_PREFETCH_SIZE):
+    """iterable を別スレッドで先読みし、最大 maxsize 件を保持する有界キュー経由で返す"""
+    items = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    break
+        except BaseException as e:
+            put(_ProducerError(e))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+            put(_END)
+
+    producer = threading.Thread(target=produce, name="ingest-prefetch", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _END:
+                break
+            if isinstance(item, _ProducerError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+
+def iter_chunk_groups(processed_files, max_chunks=DEFAULT_GROUP_CHUNKS, failed_files=None):
+    """(ファイル, チャンク) の列を max_chunks 程度のグループにまとめて返す
+
+    1ファイルのチャンクは必ず同じグループに入るため、ソース内の通し番号に基づくチャンクIDが安定する。
+    処理に失敗したファイル (チャンクが None) は飛ばし、failed_files に追加する
+    """
+    group = []
+    for doc_file, chunks in processed_files:
+        if chunks is None:
+            logger.warning(f"処理に失敗したためスキップしました: {doc_file}")
+            if failed_files is not None:
+                failed_files.append(doc_file)
+            continue
+        logger.info(f"処理完了: {doc_file}, チャンク数: {len(chunks)}")
+        group.extend(chunks)
+        if len(group) >= max_chunks:
+            yield group
+            group = []
+    if group:
+        yield group
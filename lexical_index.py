@@ -0,0 +1,343 @@
+# lexical_index.py
+import os
+import re
+import json
+import shutil
+import hashlib
+import logging
+import unicodedata
+from array import array
+from collections import Counter
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+LEXICAL_INDEX_DIRECTORY = 'lexical_index'
+MANIFEST_FILE = 'manifest.json'
+# 1セグメントあたりの最大チャンク数。超えたら書き出して次のセグメントに移る
+SEGMENT_MAX_DOCS = 20000
+# セグメントがこの数を超えたら小さいものからまとめる。まとめた結果がこの件数を超えるセグメントは作らない
+MAX_SEGMENTS = 8
+MERGE_MAX_DOCS = 100000
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 全チャンクのこの割合以上に出現する語は、ほかに語があれば採点に使わない (ストップワード扱い)
+COMMON_TERM_RATIO = 0.2
+DEFAULT_RRF_K = 60
+
+# 英数字の連続 (型番やエラーコード) は1語、それ以外の文字の連続 (日本語) は文字bigramにする
+_TOKEN_RE = re.compile(r'[0-9a-z]+(?:[-_.][0-9a-z]+)*|[^\W\d_a-z]+')
+
+def tokenize(text):
+    text = unicodedata.normalize('NFKC', text).lower()
+    tokens = []
+    for match in _TOKEN_RE.finditer(text):
+        run = match.group()
+        if run[0].isascii():
+            tokens.append(run)
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return tokens
+
+def hash_terms(terms):
+    """語を永続化できる64ビットのハッシュに変換する"""
+    return np.array([int.from_bytes(hashlib.blake2b(term.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+                     for term in terms], dtype=np.int64)
+
+def _atomic_write_json(path, data):
+    temp_file = f"{path}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, path)
+
+def _load_array(path):
+    try:
+        return np.load(path, mmap_mode='r')
+    except ValueError:
+        # 空の配列はメモリマップできない
+        return np.load(path)
+
+class _Segment:
+    """読み取り専用のセグメント。語のハッシュ順に並んだ転置リストをメモリマップで持つ"""
+
+    def __init__(self, directory, name, generation):
+        self.name = name
+        self.generation = generation
+        path = os.path.join(directory, name)
+        load = lambda file_name: _load_array(os.path.join(path, file_name))
+        self.terms = load('terms.npy')
+        self.offsets = load('offsets.npy')
+        self.docs = load('docs.npy')
+        self.tfs = load('tfs.npy')
+        self.doc_ids = load('doc_ids.npy')
+        self.doc_lens = load('doc_lens.npy')
+        self.live = None
+
+    def postings(self, term_hash):
+        position = np.searchsorted(self.terms, term_hash)
+        if position >= len(self.terms) or self.terms[position] != term_hash:
+            return None, None
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return self.docs[start:end], self.tfs[start:end]
+
+    def document_frequency(self, term_hash):
+        position = np.searchsorted(self.terms, term_hash)
+        if position >= len(self.terms) or self.terms[position] != term_hash:
+            return 0
+        return int(self.offsets[position + 1] - self.offsets[position])
+
+def _write_segment(directory, name, term_hashes, docs, tfs, doc_ids, doc_lens):
+    """(語のハッシュ, 文書番号, 出現回数) の組からセグメントを書き出す"""
+    order = np.lexsort((docs, term_hashes))
+    term_hashes, docs, tfs = term_hashes[order], docs[order], tfs[order]
+    terms, starts = np.unique(term_hashes, return_index=True)
+    offsets = np.append(starts, len(term_hashes)).astype(np.int64)
+    temp_path = os.path.join(directory, f"{name}.tmp")
+    os.makedirs(temp_path, exist_ok=True)
+    for file_name, data in (('terms.npy', terms), ('offsets.npy', offsets), ('docs.npy', docs.astype(np.int32)),
+                            ('tfs.npy', tfs.astype(np.uint16)), ('doc_ids.npy', np.asarray(doc_ids, dtype=np.int64)),
+                            ('doc_lens.npy', np.asarray(doc_lens, dtype=np.int32))):
+        np.save(os.path.join(temp_path, file_name), data)
+    os.replace(temp_path, os.path.join(directory, name))
+
+class LexicalIndex:
+    """文字bigramと英数字の語による BM25 の転置インデックス
+
+    追加はセグメント単位、削除はチャンクIDと世代の組で記録する。
+    削除は記録した時点より前の世代のセグメントにだけ効くため、同じIDで追加し直したチャンクは残る。
+    """
+
+    def __init__(self, persist_directory):
+        self.directory = os.path.join(persist_directory, LEXICAL_INDEX_DIRECTORY)
+        self.manifest_file = os.path.join(self.directory, MANIFEST_FILE)
+        self.manifest = self._load_manifest()
+        self.segments = [_Segment(self.directory, seg['name'], seg['generation']) for seg in self.manifest['segments']]
+        self._manifest_mtime = os.path.getmtime(self.manifest_file) if os.path.exists(self.manifest_file) else None
+        self._apply_deletions()
+
+    def _load_manifest(self):
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        return {'segments': [], 'next_generation': 0, 'deleted_ids': [], 'deleted_generations': []}
+
+    def exists(self):
+        return self._manifest_mtime is not None
+
+    def is_stale(self):
+        """別の処理でマニフェストが更新されていれば True"""
+        current = os.path.getmtime(self.manifest_file) if os.path.exists(self.manifest_file) else None
+        return current != self._manifest_mtime
+
+    def _apply_deletions(self):
+        deleted_ids = np.asarray(self.manifest['deleted_ids'], dtype=np.int64)
+        deleted_generations = np.asarray(self.manifest['deleted_generations'], dtype=np.int64)
+        self.num_docs = 0
+        self.total_length = 0
+        for segment in self.segments:
+            ids = deleted_ids[deleted_generations > segment.generation]
+            segment.live = ~np.isin(segment.doc_ids, ids) if len(ids) > 0 else None
+            lens = segment.doc_lens if segment.live is None else segment.doc_lens[segment.live]
+            self.num_docs += len(lens)
+            self.total_length += int(np.sum(lens, dtype=np.int64))
+
+    def _commit(self):
+        os.makedirs(self.directory, exist_ok=True)
+        _atomic_write_json(self.manifest_file, self.manifest)
+        self._manifest_mtime = os.path.getmtime(self.manifest_file)
+        self._apply_deletions()
+
+    def _next_name(self):
+        generation = self.manifest['next_generation']
+        self.manifest['next_generation'] += 1
+        return f"segment_{generation:06d}", generation
+
+    def clear(self):
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory, ignore_errors=True)
+        self.manifest = self._load_manifest()
+        self.segments = []
+        self._manifest_mtime = None
+        self._apply_deletions()
+
+    def delete(self, chunk_ids, commit=True):
+        """チャンクを削除済みにする。これ以降に追加するセグメントには影響しない"""
+        chunk_ids = [int(chunk_id) for chunk_id in chunk_ids]
+        if not chunk_ids:
+            return
+        generation = self.manifest['next_generation']
+        self.manifest['deleted_ids'].extend(chunk_ids)
+        self.manifest['deleted_generations'].extend([generation] * len(chunk_ids))
+        if commit:
+            self._commit()
+
+    def add(self, chunk_ids, texts, commit=True):
+        """チャンクを SEGMENT_MAX_DOCS 件ごとのセグメントとして追加する"""
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        os.makedirs(self.directory, exist_ok=True)
+        for start in range(0, len(chunk_ids), SEGMENT_MAX_DOCS):
+            self._add_segment(chunk_ids[start:start + SEGMENT_MAX_DOCS], texts[start:start + SEGMENT_MAX_DOCS])
+        if commit:
+            self.commit()
+
+    def commit(self):
+        """必要ならセグメントをまとめ、マニフェストを書き出して追加と削除を確定する"""
+        self._merge_if_needed()
+        self._commit()
+
+    def _add_segment(self, chunk_ids, texts):
+        vocabulary = {}
+        term_ids, docs, tfs = array('q'), array('i'), array('H')
+        doc_lens = np.empty(len(texts), dtype=np.int32)
+        for doc, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lens[doc] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                term_ids.append(vocabulary.setdefault(term, len(vocabulary)))
+                docs.append(doc)
+                tfs.append(min(tf, 65535))
+        if not vocabulary:
+            hashes = np.empty(0, dtype=np.int64)
+        else:
+            hashes = hash_terms(list(vocabulary))[np.frombuffer(term_ids, dtype=np.int64)]
+        name, generation = self._next_name()
+        _write_segment(self.directory, name, hashes, np.frombuffer(docs, dtype=np.int32),
+                       np.frombuffer(tfs, dtype=np.uint16), chunk_ids, doc_lens)
+        self.manifest['segments'].append({'name': name, 'generation': generation, 'docs': len(texts)})
+        self.segments.append(_Segment(self.directory, name, generation))
+        logger.info(f"語彙インデックスのセグメントを追加しました: {name} ({len(texts)} チャンク, {len(vocabulary)} 語)")
+
+    def _merge_if_needed(self):
+        while len(self.segments) > MAX_SEGMENTS:
+            candidates, docs = [], 0
+            for segment in sorted(self.segments, key=lambda segment: len(segment.doc_ids)):
+                if candidates and docs + len(segment.doc_ids) > MERGE_MAX_DOCS:
+                    break
+                candidates.append(segment)
+                docs += len(segment.doc_ids)
+            if len(candidates) <= 1:
+                break
+            self.merge(candidates)
+
+    def compact(self, max_dead_ratio=0.2):
+        """削除済みのチャンクの割合が max_dead_ratio を超えたセグメントを書き直す"""
+        self._apply_deletions()
+        for segment in list(self.segments):
+            if segment.live is not None and 1.0 - segment.live.mean() > max_dead_ratio:
+                self.merge([segment])
+
+    def merge(self, segments=None):
+        """セグメントをまとめ、削除済みのチャンクを取り除く。まとめたセグメントは最も新しい世代を引き継ぐ"""
+        segments = list(self.segments if segments is None else segments)
+        if not segments:
+            return
+        self._apply_deletions()
+        all_hashes, all_docs, all_tfs, all_ids, all_lens = [], [], [], [], []
+        doc_offset = 0
+        for segment in sorted(segments, key=lambda s: s.generation):
+            live = segment.live if segment.live is not None else np.ones(len(segment.doc_ids), dtype=bool)
+            # 残すチャンクの新しい文書番号 (削除されたチャンクは -1)
+            remap = np.full(len(segment.doc_ids), -1, dtype=np.int64)
+            remap[live] = np.arange(int(live.sum())) + doc_offset
+            hashes = np.repeat(np.asarray(segment.terms), np.diff(segment.offsets))
+            docs = remap[np.asarray(segment.docs)]
+            keep = docs >= 0
+            all_hashes.append(hashes[keep])
+            all_docs.append(docs[keep])
+            all_tfs.append(np.asarray(segment.tfs)[keep])
+            all_ids.append(np.asarray(segment.doc_ids)[live])
+            all_lens.append(np.asarray(segment.doc_lens)[live])
+            doc_offset += int(live.sum())
+
+        generation = max(segment.generation for segment in segments)
+        merged_names = {segment.name for segment in segments}
+        self.manifest['segments'] = [seg for seg in self.manifest['segments'] if seg['name'] not in merged_names]
+        self.segments = [segment for segment in self.segments if segment.name not in merged_names]
+        name = None
+        if doc_offset > 0:
+            # 名前には新しい通し番号を使い、同じセグメントを何度書き直しても衝突しないようにする
+            name = f"segment_{generation:06d}_m{self._next_name()[1]:06d}"
+            _write_segment(self.directory, name, np.concatenate(all_hashes), np.concatenate(all_docs),
+                           np.concatenate(all_tfs), np.concatenate(all_ids), np.concatenate(all_lens))
+            self.manifest['segments'].append({'name': name, 'generation': generation, 'docs': doc_offset})
+            self.manifest['segments'].sort(key=lambda seg: seg['generation'])
+            self.segments.append(_Segment(self.directory, name, generation))
+            self.segments.sort(key=lambda segment: segment.generation)
+        # 残っているどのセグメントにも効かない削除記録は不要になる
+        oldest = min((segment.generation for segment in self.segments), default=self.manifest['next_generation'])
+        deleted = [(chunk_id, gen) for chunk_id, gen in zip(self.manifest['deleted_ids'], self.manifest['deleted_generations'])
+                   if gen > oldest]
+        self.manifest['deleted_ids'] = [chunk_id for chunk_id, _ in deleted]
+        self.manifest['deleted_generations'] = [gen for _, gen in deleted]
+        self._commit()
+        for merged_name in merged_names:
+            # Windowsではメモリマップ中のファイルを削除できないため、失敗しても次回に回す
+            shutil.rmtree(os.path.join(self.directory, merged_name), ignore_errors=True)
+        logger.info(f"語彙インデックスのセグメントを {len(segments)} 件まとめました: {name or '(空)'} ({doc_offset} チャンク)")
+
+    def search(self, query, k=20, allowed_ids=None):
+        """BM25 で上位 k 件の (チャンクID, スコア) を返す。allowed_ids を渡すとそのチャンクだけを対象にする"""
+        if self.num_docs == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        term_hashes = hash_terms(list(dict.fromkeys(tokenize(query))))
+        document_frequencies = np.array([sum(segment.document_frequency(h) for segment in self.segments)
+                                         for h in term_hashes], dtype=np.int64)
+        present = document_frequencies > 0
+        term_hashes, document_frequencies = term_hashes[present], document_frequencies[present]
+        if len(term_hashes) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        # 頻出するbigramは転置リストが長く寄与も小さいため、より珍しい語があれば除く
+        rare = document_frequencies < COMMON_TERM_RATIO * self.num_docs
+        if rare.any():
+            term_hashes, document_frequencies = term_hashes[rare], document_frequencies[rare]
+        idf = np.log1p((self.num_docs - document_frequencies + 0.5) / (document_frequencies + 0.5))
+        average_length = self.total_length / max(self.num_docs, 1)
+
+        result_ids, result_scores = [], []
+        for segment in self.segments:
+            docs_list, weights_list = [], []
+            for term_hash, term_idf in zip(term_hashes, idf):
+                docs, tfs = segment.postings(term_hash)
+                if docs is None:
+                    continue
+                tfs = tfs.astype(np.float32)
+                lens = segment.doc_lens[docs]
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lens / average_length)
+                docs_list.append(np.asarray(docs))
+                weights_list.append(term_idf * tfs * (BM25_K1 + 1) / (tfs + norm))
+            if not docs_list:
+                continue
+            docs, inverse = np.unique(np.concatenate(docs_list), return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(weights_list)).astype(np.float32)
+            keep = np.ones(len(docs), dtype=bool)
+            if segment.live is not None:
+                keep &= segment.live[docs]
+            ids = np.asarray(segment.doc_ids)[docs]
+            if allowed_ids is not None:
+                keep &= np.isin(ids, allowed_ids)
+            ids, scores = ids[keep], scores[keep]
+            if len(scores) > k:
+                top = np.argpartition(-scores, k - 1)[:k]
+                ids, scores = ids[top], scores[top]
+            result_ids.append(ids)
+            result_scores.append(scores)
+
+        if not result_ids:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        ids, scores = np.concatenate(result_ids), np.concatenate(result_scores)
+        order = np.argsort(-scores)[:k]
+        return ids[order], scores[order]
+
+def reciprocal_rank_fusion(rankings, k=DEFAULT_RRF_K):
+    """複数のID順位リストを RRF (Σ 1 / (k + 順位)) で統合し、(ID, スコア) をスコア順に返す"""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[int(chunk_id)] = scores.get(int(chunk_id), 0.0) + 1.0 / (k + rank + 1)
+    fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    return (np.array([chunk_id for chunk_id, _ in fused], dtype=np.int64),
+            np.array([score for _, score in fused], dtype=np.float32))
@@ -0,0 +1,163 @@
+# metadata_filter.py
+import os
+import logging
+import faiss
+import numpy as np
+import pandas as pd
+import pyarrow.compute as pc
+from chunk_store import ChunkStore
+from vector_store import index_params_of
+
+logger = logging.getLogger(__name__)
+
+# 候補がこの件数以下ならベクトルファイルから直接距離を計算する
+BRUTE_FORCE_MAX_CANDIDATES = 20000
+FILTER_KEYS = ('sources', 'source_prefix', 'extensions', 'title_contains', 'modified_after', 'modified_before')
+_MISSING_TIME = np.iinfo(np.int64).min
+
+def _as_list(value):
+    return [value] if isinstance(value, str) else list(value)
+
+def to_ns(value):
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert(None)
+    return timestamp.value
+
+def _factorize(df, column):
+    """列を (行ごとのコード, ユニーク値) に変換する。欠損値のコードは -1"""
+    if column not in df.columns:
+        return None
+    if isinstance(df, ChunkStore):
+        encoded = df.table.column(column).combine_chunks().dictionary_encode()
+        codes = pc.fill_null(encoded.indices, -1).to_numpy(zero_copy_only=False).astype(np.int32)
+        return codes, [str(value) for value in encoded.dictionary.to_pylist()]
+    codes, uniques = pd.factorize(df[column])
+    return codes.astype(np.int32), [str(value) for value in uniques]
+
+def _column_as_pandas(df, column):
+    if isinstance(df, ChunkStore):
+        return df.table.column(column).to_pandas()
+    return df[column]
+
+def _match_codes(codes, matches):
+    # コード -1 (欠損) は末尾に追加した False を参照する
+    return np.append(np.asarray(matches, dtype=bool), False)[codes]
+
+class MetadataIndex:
+    """フィルタ評価用の列指向のメタデータ。文字列の列はユニーク値と行ごとのコードで持ち、条件はユニーク値に対して評価する"""
+
+    def __init__(self, ids, source_codes, sources, title_codes, titles, modified_ns, live=None):
+        self.ids = ids
+        self.live = live
+        self.source_codes = source_codes
+        self.sources = sources
+        self.title_codes = title_codes
+        self.titles = titles
+        self.modified_ns = modified_ns
+        self.extensions = [os.path.splitext(source)[1].lower() for source in sources]
+
+    @classmethod
+    def from_frame(cls, df, source_mtimes=None):
+        """データフレームまたは ChunkStore から作成する。source_mtimes はソースごとの更新日時 (ns)"""
+        if 'chunk_id' in df.columns:
+            ids = df.chunk_ids if isinstance(df, ChunkStore) else df['chunk_id'].to_numpy(dtype=np.int64)
+        else:
+            # チャンクIDのないデータベースは行位置をIDとして使う
+            ids = np.arange(len(df), dtype=np.int64)
+        source_codes, sources = _factorize(df, 'source')
+
+        # タイトルは title 列、Notion ではページタイトルを持つ page 列、それ以外はファイル名
+        title = _factorize(df, 'title') or (_factorize(df, 'page') if 'metadata' in df.columns else None)
+        if title is None:
+            title = (source_codes, [os.path.basename(source) for source in sources])
+        title_codes, titles = title
+
+        if 'last_modified' in df.columns:
+            modified = pd.to_datetime(_column_as_pandas(df, 'last_modified'), errors='coerce', utc=True).dt.tz_convert(None)
+            # NaT は int64 の最小値になり、_MISSING_TIME と一致する
+            modified_ns = modified.to_numpy(dtype='datetime64[ns]').view(np.int64)
+        else:
+            source_times = np.array([(source_mtimes or {}).get(source, _MISSING_TIME) for source in sources] + [_MISSING_TIME],
+                                    dtype=np.int64)
+            modified_ns = source_times[source_codes]
+
+        logger.info(f"メタデータインデックスを作成しました: {len(ids)} 行, ソース {len(sources)} 件")
+        live = df.live_mask if isinstance(df, ChunkStore) else None
+        return cls(ids, source_codes, sources, title_codes, titles, modified_ns, live)
+
+    def select(self, filters):
+        """filters (すべてAND) に一致する行のIDを返す"""
+        unknown = set(filters) - set(FILTER_KEYS)
+        if unknown:
+            raise ValueError(f"不明なフィルタです: {sorted(unknown)}")
+        mask = np.ones(len(self.ids), dtype=bool) if self.live is None else self.live.copy()
+        if filters.get('sources'):
+            wanted = set(_as_list(filters['sources']))
+            mask &= _match_codes(self.source_codes, [source in wanted for source in self.sources])
+        if filters.get('source_prefix'):
+            prefixes = tuple(_as_list(filters['source_prefix']))
+            mask &= _match_codes(self.source_codes, [source.startswith(prefixes) for source in self.sources])
+        if filters.get('extensions'):
+            wanted = {ext.lower() if ext.startswith('.') else f".{ext.lower()}" for ext in _as_list(filters['extensions'])}
+            mask &= _match_codes(self.source_codes, [ext in wanted for ext in self.extensions])
+        if filters.get('title_contains'):
+            needle = filters['title_contains'].lower()
+            mask &= _match_codes(self.title_codes, [needle in title.lower() for title in self.titles])
+        if filters.get('modified_after') is not None:
+            mask &= (self.modified_ns != _MISSING_TIME) & (self.modified_ns >= to_ns(filters['modified_after']))
+        if filters.get('modified_before') is not None:
+            mask &= (self.modified_ns != _MISSING_TIME) & (self.modified_ns < to_ns(filters['modified_before']))
+        return self.ids[mask]
+
+def _search_parameters(index, selector, k, exhaustive=False):
+    """選択したIDだけを探索する検索パラメータ。パラメータを渡すとインデックスの nprobe / efSearch は使われないため明示する"""
+    params = index_params_of(index)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        nprobe = ivf.nlist if exhaustive else params.get('nprobe', ivf.nprobe)
+        return faiss.SearchParametersIVF(sel=selector, nprobe=nprobe)
+    if params['type'] == 'hnsw':
+        ef_search = max(params.get('ef_search', 64), k) * (8 if exhaustive else 1)
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=ef_search)
+    return faiss.SearchParameters(sel=selector)
+
+def _brute_force(query_vectors, vectors, ids, k):
+    """候補のベクトルとの二乗L2距離を直接計算して上位 k 件を返す (IndexFlatL2 と同じ距離)"""
+    distances = ((query_vectors ** 2).sum(axis=1)[:, None] - 2 * query_vectors @ vectors.T
+                 + (vectors ** 2).sum(axis=1)[None, :])
+    top_k = min(k, len(ids))
+    top = np.argpartition(distances, top_k - 1, axis=1)[:, :top_k]
+    top_distances = np.take_along_axis(distances, top, axis=1)
+    order = np.argsort(top_distances, axis=1)
+    D = np.full((len(query_vectors), k), np.inf, dtype=np.float32)
+    I = np.full((len(query_vectors), k), -1, dtype=np.int64)
+    D[:, :top_k] = np.take_along_axis(top_distances, order, axis=1)
+    I[:, :top_k] = ids[np.take_along_axis(top, order, axis=1)]
+    return D, I
+
+def search_filtered(query_vectors, index, metadata_index, filters, k=5, vector_sidecar=None):
+    """filters に一致するチャンクだけを対象に検索し、index.search と同じ形の (D, I) を返す (不足分のIDは -1)
+
+    候補が少なければベクトルファイルから直接計算し、多ければ IDSelector で FAISS の探索自体を絞り込む
+    """
+    query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+    candidate_ids = np.ascontiguousarray(metadata_index.select(filters), dtype=np.int64)
+    logger.info(f"フィルタ {filters} に一致するチャンク: {len(candidate_ids)} 件")
+    if len(candidate_ids) == 0:
+        return (np.full((len(query_vectors), k), np.inf, dtype=np.float32),
+                np.full((len(query_vectors), k), -1, dtype=np.int64))
+
+    if vector_sidecar is not None and vector_sidecar.exists() and len(candidate_ids) <= BRUTE_FORCE_MAX_CANDIDATES:
+        try:
+            return _brute_force(query_vectors, vector_sidecar.get(candidate_ids), candidate_ids, k)
+        except KeyError as e:
+            logger.info(f"ベクトルファイルを使えないため、インデックスで検索します: {str(e)}")
+
+    selector = faiss.IDSelectorBatch(len(candidate_ids), faiss.swig_ptr(candidate_ids))
+    D, I = index.search(query_vectors, k, params=_search_parameters(index, selector, k))
+    expected = min(k, len(candidate_ids))
+    if ((I >= 0).sum(axis=1) < expected).any():
+        # IVF の探索リストや HNSW のグラフ探索で k 件に届かなかった場合は範囲を広げて探索し直す
+        D, I = index.search(query_vectors, k, params=_search_parameters(index, selector, k, exhaustive=True))
+    return D, I
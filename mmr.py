@@ -0,0 +1,65 @@
+# mmr.py
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MMR_LAMBDA = 0.5
+DEFAULT_MMR_FETCH_K = 20
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def maximal_marginal_relevance(query_vector, candidate_vectors, k, lambda_mult=DEFAULT_MMR_LAMBDA):
+    """MMR で候補から k 件を選び、選んだ順に候補の位置を返す
+
+    スコアは λ・sim(クエリ, 候補) - (1-λ)・max sim(候補, 選択済み)。類似度はコサイン類似度で、
+    候補どうしの類似度行列を1回だけ計算し、選択済みとの最大類似度は選ぶたびに差分で更新する
+    """
+    count = len(candidate_vectors)
+    if count == 0 or k <= 0:
+        return np.empty(0, dtype=np.int64)
+    candidates = _normalize(np.asarray(candidate_vectors, dtype=np.float32))
+    query_similarity = candidates @ _normalize(np.asarray(query_vector, dtype=np.float32).ravel())
+    pairwise_similarity = candidates @ candidates.T
+
+    selected = [int(np.argmax(query_similarity))]
+    max_similarity = pairwise_similarity[selected[0]].copy()
+    available = np.ones(count, dtype=bool)
+    available[selected[0]] = False
+    for _ in range(min(k, count) - 1):
+        scores = lambda_mult * query_similarity - (1 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        chosen = int(np.argmax(scores))
+        selected.append(chosen)
+        available[chosen] = False
+        np.maximum(max_similarity, pairwise_similarity[chosen], out=max_similarity)
+    return np.array(selected, dtype=np.int64)
+
+def _candidate_vectors(ids, vector_sidecar, index):
+    """候補のベクトルをベクトルファイルから取り出す。なければインデックスから復元する"""
+    if vector_sidecar is not None and vector_sidecar.exists():
+        try:
+            return vector_sidecar.get(ids)
+        except KeyError as e:
+            logger.info(f"ベクトルファイルを使えないため、インデックスから復元します: {str(e)}")
+    return index.reconstruct_batch(np.ascontiguousarray(ids, dtype=np.int64))
+
+def rerank_hits(query_vectors, hits, k, index, vector_sidecar=None, lambda_mult=DEFAULT_MMR_LAMBDA):
+    """search_vectors の形の結果をクエリごとに MMR で並べ替え、k 件に絞る。エンベディングの呼び出しは行わない"""
+    reranked = []
+    for query_vector, (positions, distances, ids) in zip(query_vectors, hits):
+        if len(ids) <= 1:
+            reranked.append((positions[:k], distances[:k], ids[:k]))
+            continue
+        try:
+            vectors = _candidate_vectors(ids, vector_sidecar, index)
+        except Exception as e:
+            logger.error(f"MMR 用のベクトルを取得できないため、並べ替えを行いません: {str(e)}")
+            reranked.append((positions[:k], distances[:k], ids[:k]))
+            continue
+        order = maximal_marginal_relevance(query_vector, vectors, k, lambda_mult)
+        reranked.append((positions[order], distances[order], ids[order]))
+    return reranked
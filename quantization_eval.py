@@ -0,0 +1,112 @@
+# quantization_eval.py
+"""量子化したインデックスとベクトルファイルの recall@k を、Flat インデックスの厳密な検索結果と比較して表示する
+
+使い方: python quantization_eval.py <persist_directory> [--k 10] [--queries 1000] [--index-type flat]
+"""
+import os
+import time
+import argparse
+import tempfile
+import logging
+import faiss
+import numpy as np
+from vector_store import create_faiss_index, index_params_of, QUANTIZATIONS
+from vector_sidecar import VectorSidecar, RowView
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+def split_held_out(count, num_queries, seed=0):
+    """評価用のクエリとして使う行を取り分け、(クエリの行位置, 残りの行位置) を返す
+
+    クエリは全体の1割まで (少なくとも1件) とし、クエリと残りの行がそれぞれ1件以上必要
+    """
+    if num_queries < 1:
+        raise ValueError(f"クエリ数は1以上を指定してください: {num_queries}")
+    if count < 2:
+        raise ValueError(f"評価には2件以上のベクトルが必要です: {count} 件")
+    rng = np.random.default_rng(seed)
+    query_positions = np.sort(rng.choice(count, size=min(num_queries, max(count // 10, 1)), replace=False))
+    base_mask = np.ones(count, dtype=bool)
+    base_mask[query_positions] = False
+    return query_positions, np.flatnonzero(base_mask)
+
+def recall_at_k(ground_truth, result_ids, k):
+    hits = [len(np.intersect1d(truth[:k], found[:k])) for truth, found in zip(ground_truth, result_ids)]
+    return float(np.mean(hits)) / k
+
+def _search(index, queries, k):
+    start = time.perf_counter()
+    _, I = index.search(queries, k)
+    elapsed_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    return I, elapsed_ms
+
+def evaluate_index_quantization(base, base_ids, queries, ground_truth, k, index_type, index_options=None):
+    results = []
+    for quantization in QUANTIZATIONS:
+        options = dict(index_options or {}, quantization=quantization)
+        index = create_faiss_index(base, base_ids, index_type=index_type, index_options=options)
+        params = index_params_of(index)
+        I, elapsed_ms = _search(index, queries, k)
+        results.append({
+            'target': f"index:{params['type']}/{params.get('quantization', 'none')}",
+            'recall': recall_at_k(ground_truth, I, k),
+            'bytes': len(faiss.serialize_index(index)),
+            'ms_per_query': elapsed_ms
+        })
+        del index
+    return results
+
+def evaluate_sidecar_quantization(base, base_ids, queries, ground_truth, k):
+    results = []
+    for dtype in ('float16', 'sq8'):
+        with tempfile.TemporaryDirectory() as temp_directory:
+            sidecar = VectorSidecar(temp_directory, dtype)
+            sidecar.write(base_ids, base)
+            index = create_faiss_index(sidecar.vectors(), np.array(sidecar.ids()), index_type='flat')
+            I, elapsed_ms = _search(index, queries, k)
+            results.append({
+                'target': f"sidecar:{dtype}",
+                'recall': recall_at_k(ground_truth, I, k),
+                'bytes': os.path.getsize(sidecar.vector_file),
+                'ms_per_query': elapsed_ms
+            })
+            del index
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="量子化設定ごとの recall@k とサイズを評価します")
+    parser.add_argument('persist_directory', help="ベクトルファイル (vectors.bin) のあるディレクトリ")
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=1000, help="評価用に取り分けるクエリ数")
+    parser.add_argument('--index-type', default='flat', help="flat / ivf_flat / hnsw / auto")
+    args = parser.parse_args()
+
+    sidecar = VectorSidecar(args.persist_directory)
+    if not sidecar.exists():
+        raise SystemExit(f"ベクトルファイルが見つかりません: {sidecar.vector_file}")
+    vectors = sidecar.vectors()
+    try:
+        query_positions, base_positions = split_held_out(sidecar.count, args.queries)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    queries = np.asarray(vectors[query_positions], dtype=np.float32)
+    base = RowView(vectors, base_positions)
+    logger.info(f"評価対象: {len(base_positions)} 件, クエリ: {len(query_positions)} 件, k={args.k}")
+
+    exact = create_faiss_index(base, base_positions, index_type='flat')
+    ground_truth, exact_ms = _search(exact, queries, args.k)
+    exact_bytes = len(faiss.serialize_index(exact))
+    del exact
+
+    results = [{'target': "index:flat/none (基準)", 'recall': 1.0, 'bytes': exact_bytes, 'ms_per_query': exact_ms}]
+    results += evaluate_index_quantization(base, base_positions, queries, ground_truth, args.k, args.index_type)
+    results += evaluate_sidecar_quantization(base, base_positions, queries, ground_truth, args.k)
+
+    print(f"{'対象':<32}{'recall@' + str(args.k):>12}{'サイズ(MB)':>14}{'圧縮率':>10}{'ms/クエリ':>12}")
+    for result in results:
+        print(f"{result['target']:<32}{result['recall']:>12.4f}{result['bytes'] / 1024 / 1024:>14.1f}"
+              f"{exact_bytes / max(result['bytes'], 1):>10.1f}{result['ms_per_query']:>12.3f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+# rate_limiter.py
+import re
+import time
+import asyncio
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# settings.ini の [RateLimits] で上書きされない場合の既定値 (リクエスト/分, トークン/分)
+DEFAULT_RATE_LIMITS = {
+    'text-embedding-3-small': (3000, 1000000),
+    'text-embedding-3-large': (3000, 1000000),
+    'text-embedding-ada-002': (3000, 1000000),
+}
+FALLBACK_RATE_LIMIT = (500, 200000)
+
+# 429を受けたときに流量を絞る下限の倍率
+MIN_RATE_SCALE = 0.1
+
+_DURATION_PATTERN = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+_DURATION_UNITS = {'ms': 0.001, 's': 1.0, 'm': 60.0, 'h': 3600.0}
+
+def parse_reset_duration(value):
+    """OpenAIの x-ratelimit-reset-* ヘッダー ('1s', '6m0s', '20ms' など) を秒に変換する"""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    matches = _DURATION_PATTERN.findall(value)
+    if not matches:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in matches)
+
+def _header_int(headers, name):
+    value = headers.get(name) if headers is not None else None
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+class RateLimiter:
+    """リクエスト数/分とトークン数/分の2つのトークンバケットで流量を制御する"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute, name=''):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._available_requests = float(requests_per_minute)
+        self._available_tokens = float(tokens_per_minute)
+        self._rate_scale = 1.0
+        self._blocked_until = 0.0
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._available_requests = min(
+            self.requests_per_minute,
+            self._available_requests + elapsed * self.requests_per_minute * self._rate_scale / 60.0)
+        self._available_tokens = min(
+            self.tokens_per_minute,
+            self._available_tokens + elapsed * self.tokens_per_minute * self._rate_scale / 60.0)
+
+    def _reserve(self, tokens):
+        """予約できれば0を、できなければ待機すべき秒数を返す"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if now < self._blocked_until:
+                return self._blocked_until - now
+
+            # 1リクエストで予算全体を超える場合はバケットが満杯になるまで待って通す
+            tokens = min(tokens, self.tokens_per_minute)
+            if self._available_requests >= 1 and self._available_tokens >= tokens:
+                self._available_requests -= 1
+                self._available_tokens -= tokens
+                return 0.0
+
+            request_rate = self.requests_per_minute * self._rate_scale / 60.0
+            token_rate = self.tokens_per_minute * self._rate_scale / 60.0
+            return max((1 - self._available_requests) / request_rate,
+                       (tokens - self._available_tokens) / token_rate,
+                       0.01)
+
+    def acquire(self, tokens=0):
+        waited = 0.0
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                break
+            time.sleep(wait)
+            waited += wait
+        if waited > 1.0:
+            logger.info(f"レート制限のため {waited:.1f} 秒待機しました ({self.name}, トークン数: {tokens})")
+
+    async def acquire_async(self, tokens=0):
+        waited = 0.0
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                break
+            await asyncio.sleep(wait)
+            waited += wait
+        if waited > 1.0:
+            logger.info(f"レート制限のため {waited:.1f} 秒待機しました ({self.name}, トークン数: {tokens})")
+
+    def update_from_headers(self, headers):
+        """レスポンスの x-ratelimit-* ヘッダーから実際の上限と残量を反映する"""
+        if not headers:
+            return
+        limit_requests = _header_int(headers, 'x-ratelimit-limit-requests')
+        limit_tokens = _header_int(headers, 'x-ratelimit-limit-tokens')
+        remaining_requests = _header_int(headers, 'x-ratelimit-remaining-requests')
+        remaining_tokens = _header_int(headers, 'x-ratelimit-remaining-tokens')
+
+        with self._lock:
+            if limit_requests and limit_requests != self.requests_per_minute:
+                logger.info(f"リクエスト上限をヘッダーから更新します: {self.requests_per_minute} -> {limit_requests} ({self.name})")
+                self.requests_per_minute = limit_requests
+            if limit_tokens and limit_tokens != self.tokens_per_minute:
+                logger.info(f"トークン上限をヘッダーから更新します: {self.tokens_per_minute} -> {limit_tokens} ({self.name})")
+                self.tokens_per_minute = limit_tokens
+            # サーバー側の残量の方が少なければそちらに合わせる
+            if remaining_requests is not None:
+                self._available_requests = min(self._available_requests, float(remaining_requests))
+            if remaining_tokens is not None:
+                self._available_tokens = min(self._available_tokens, float(remaining_tokens))
+
+    def on_success(self):
+        with self._lock:
+            if self._rate_scale < 1.0:
+                self._rate_scale = min(1.0, self._rate_scale + 0.05)
+
+    def on_rate_limited(self, headers=None):
+        """429を受けたときに流量を半分に絞り、サーバーの指示する時間だけ停止する"""
+        retry_after = None
+        if headers:
+            retry_after = parse_reset_duration(headers.get('retry-after'))
+            if retry_after is None:
+                retry_after = max(
+                    parse_reset_duration(headers.get('x-ratelimit-reset-requests')) or 0.0,
+                    parse_reset_duration(headers.get('x-ratelimit-reset-tokens')) or 0.0) or None
+        with self._lock:
+            self._rate_scale = max(MIN_RATE_SCALE, self._rate_scale * 0.5)
+            self._available_requests = 0.0
+            self._available_tokens = 0.0
+            if retry_after:
+                self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+        logger.warning(f"レート制限を受けました ({self.name})。流量倍率: {self._rate_scale:.2f}, 待機: {retry_after}")
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(model, rate_limits=None):
+    """モデルごとに1つのRateLimiterをプロセス全体で共有する"""
+    with _limiters_lock:
+        if model not in _limiters:
+            rate_limits = rate_limits or {}
+            requests_per_minute, tokens_per_minute = rate_limits.get(
+                model, DEFAULT_RATE_LIMITS.get(model, FALLBACK_RATE_LIMIT))
+            _limiters[model] = RateLimiter(requests_per_minute, tokens_per_minute, name=model)
+            logger.info(f"レートリミッターを作成しました: {model} ({requests_per_minute} req/分, {tokens_per_minute} tokens/分)")
+        return _limiters[model]
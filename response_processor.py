@@ -1,25 +1,44 @@
 # response_processor.py
+import re
 from ai_models import AIModelManager, create_output_parser, create_prompt_template
+from context_packer import pack_context, context_budget, DEFAULT_HISTORY_RATIO
 
-def process_response(query, search_results, config, custom_role, ai_manager):
+_FIELD_RE = re.compile(r'"(answer|important_points|additional_info|sources)"\s*:\s*')
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+def build_messages(query, search_results, custom_role):
     output_parser = create_output_parser()
     format_instructions = output_parser.get_format_instructions()
     prompt = create_prompt_template(custom_role)
 
     context = "\n".join([f"- {result['content']}" for result in search_results])
-    
-    messages = prompt.format_messages(context=context, query=query, format_instructions=format_instructions)
-    
-    response = ai_manager.generate_response(messages, query)
 
+    return prompt.format_messages(context=context, query=query, format_instructions=format_instructions)
+
+def build_packed_messages(query, search_results, config, custom_role, ai_manager):
+    """モデルごとのトークン予算に収まるよう会話履歴と検索結果を詰めてから、プロンプトを組み立てる
+
+    (プロンプト, 会話履歴, プロンプトに入れた検索結果) を返す
+    """
+    model = config['openai_model']
+    template_text = "".join(message.content for message in build_messages(query, [], custom_role))
+    packed = pack_context(search_results, ai_manager.conversation_history,
+                          [ai_manager.system_message, template_text, query], model,
+                          context_budget(config, model), config.get('context_history_ratio', DEFAULT_HISTORY_RATIO))
+    # 参照元の表示には、切り詰める前の本文を使う
+    used_results = [search_results[i] for i in packed.positions]
+    return build_messages(query, packed.results, custom_role), packed.history, used_results
+
+def parse_response(response, search_results):
+    output_parser = create_output_parser()
     try:
         parsed_response = output_parser.parse(response)
         if isinstance(parsed_response["important_points"], str):
             parsed_response["important_points"] = [point.strip() for point in parsed_response["important_points"].split('-') if point.strip()]
-        
+
         # 詳細な参照元を追加
         parsed_response["detailed_sources"] = search_results
-        
+
         return parsed_response
     except Exception as e:
         print(f"Error parsing response: {e}")
@@ -31,8 +50,120 @@ def process_response(query, search_results, config, custom_role, ai_manager):
             "detailed_sources": search_results
         }
 
+def process_response(query, search_results, config, custom_role, ai_manager):
+    messages, history, used_results = build_packed_messages(query, search_results, config, custom_role, ai_manager)
+    response = ai_manager.generate_response(messages, query, history)
+    return parse_response(response, used_results)
+
+def process_response_stream(query, search_results, config, custom_role, ai_manager, on_update):
+    """応答をストリーミングで生成し、届いた分までの各項目を on_update に渡す。最後に process_response と同じ形で返す"""
+    messages, history, used_results = build_packed_messages(query, search_results, config, custom_role, ai_manager)
+    parser = StreamingResponseParser()
+    for chunk in ai_manager.stream_response(messages, query, history):
+        on_update(parser.feed(chunk))
+    return parse_response(parser.text, used_results)
+
+def _partial_string(text, pos):
+    """pos から始まるJSON文字列の中身を、届いている分だけ復号する。(文字列, 閉じ引用符の次の位置 または None)"""
+    chars = []
+    while pos < len(text):
+        char = text[pos]
+        if char == '"':
+            return ''.join(chars), pos + 1
+        if char == '\\':
+            if pos + 1 >= len(text):
+                break
+            escape = text[pos + 1]
+            if escape == 'u':
+                if pos + 6 > len(text):
+                    break
+                try:
+                    chars.append(chr(int(text[pos + 2:pos + 6], 16)))
+                except ValueError:
+                    pass
+                pos += 6
+                continue
+            chars.append(_ESCAPES.get(escape, escape))
+            pos += 2
+            continue
+        chars.append(char)
+        pos += 1
+    return ''.join(chars), None
+
+def _partial_value(text, pos):
+    """文字列または文字列の配列の値を、届いている分だけ返す。(値, 値の次の位置 または None)"""
+    if pos >= len(text):
+        return None, None
+    if text[pos] == '"':
+        return _partial_string(text, pos + 1)
+    if text[pos] == '[':
+        items = []
+        pos += 1
+        while pos < len(text):
+            if text[pos] == ']':
+                return items, pos + 1
+            if text[pos] == '"':
+                item, end = _partial_string(text, pos + 1)
+                items.append(item)
+                if end is None:
+                    return items, None
+                pos = end
+                continue
+            pos += 1
+        return items, None
+    return None, None
+
+class StreamingResponseParser:
+    """構造化出力 (```json ... ```) を受信途中で解析し、answer などの項目を届いた分まで取り出す"""
+
+    def __init__(self):
+        self.text = ""
+
+    def feed(self, chunk):
+        self.text += chunk
+        return self.fields()
+
+    def fields(self):
+        values = {}
+        pos = 0
+        while True:
+            match = _FIELD_RE.search(self.text, pos)
+            if match is None:
+                break
+            value, end = _partial_value(self.text, match.end())
+            if value is not None:
+                values[match.group(1)] = value
+            if end is None:
+                break
+            pos = end
+        if not values and '{' not in self.text and not self.text.lstrip().startswith('`'):
+            # 構造化されていない応答はそのまま回答として表示する
+            values['answer'] = self.text
+        return values
+
+def format_response(response):
+    """構造化された応答をチャットに表示するMarkdownにする。受信途中の (一部の項目だけの) 応答にも使う"""
+    text = f"{response.get('answer', '')}\n\n"
+
+    important_points = response.get("important_points")
+    if important_points:
+        text += "**重要ポイント:**\n"
+        if isinstance(important_points, str):
+            text += f"{important_points}\n"
+        else:
+            for point in important_points:
+                text += f"- {point}\n"
+        text += "\n"
+
+    if response.get("additional_info"):
+        text += f"**補足情報:**\n{response['additional_info']}\n\n"
+
+    if response.get("sources"):
+        text += f"**参照元:**\n{response['sources']}"
+    return text
+
 def format_sources(search_results):
     sources = set()
     for result in search_results:
         sources.add(f"{result['source']} (ページ: {result['page']})")
-    return list(sources)
\ No newline at end of file
+    return list(sources)
@@ -0,0 +1,6 @@
+# conftest.py
+import os
+import sys
+
+# モジュールはリポジトリの直下に置かれているため、テストから import できるようにする
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,136 @@
+# test_embedding_engine.py
+"""AsyncEmbeddingEngine を、同じプロセスで起動した疑似 Embeddings エンドポイントに向けて確認する"""
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("openai")
+pytest.importorskip("tiktoken")
+tenacity = pytest.importorskip("tenacity")
+
+from embedding_engine import AsyncEmbeddingEngine
+from rate_limiter import RateLimiter
+
+MODEL = 'text-embedding-3-small'
+RESET_SECONDS = 0.2
+
+def fake_embedding(text):
+    """テキストから決まるベクトル。返ってきた行がどの入力のものかを確かめられる"""
+    return [float(len(text)), float(sum(map(ord, text)) % 997), 1.0]
+
+class FakeEmbeddingServer:
+    """POST /v1/embeddings に OpenAI 形式で応答し、最初の rate_limited 回は 429 を返す"""
+
+    def __init__(self, rate_limited=0):
+        self.rate_limited = rate_limited
+        self.requests = []
+        self._lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                with server._lock:
+                    server.requests.append((time.monotonic(), body['input']))
+                    limited = server.rate_limited > 0
+                    if limited:
+                        server.rate_limited -= 1
+                if limited:
+                    self._send(429, {'error': {'message': 'Rate limit reached', 'type': 'requests', 'code': 'rate_limit_exceeded'}},
+                               {'x-ratelimit-reset-requests': f"{int(RESET_SECONDS * 1000)}ms"})
+                    return
+                data = []
+                for i, text in enumerate(body['input']):
+                    vector = fake_embedding(text)
+                    if body.get('encoding_format') == 'base64':
+                        vector = base64.b64encode(np.array(vector, dtype='<f4').tobytes()).decode('ascii')
+                    data.append({'object': 'embedding', 'index': i, 'embedding': vector})
+                # index の順に並べ替えることも確かめるため、逆順で返す
+                self._send(200, {'object': 'list', 'data': data[::-1], 'model': body['model'],
+                                 'usage': {'prompt_tokens': 0, 'total_tokens': 0}},
+                           {'x-ratelimit-limit-requests': '6000', 'x-ratelimit-remaining-requests': '5999'})
+
+            def _send(self, status, payload, headers):
+                content = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self._server.server_address[1]}/v1"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._server.shutdown()
+        self._server.server_close()
+
+@pytest.fixture
+def no_retry_wait(monkeypatch):
+    """tenacity の指数バックオフを無効にし、429 後の待機がレートリミッターによるものだけになるようにする"""
+    monkeypatch.setattr(AsyncEmbeddingEngine._embed_batch.retry, 'wait', tenacity.wait_none())
+
+def make_engine(server, **kwargs):
+    return AsyncEmbeddingEngine(MODEL, base_url=server.base_url, api_key='test',
+                                rate_limiter=RateLimiter(6000, 10000000, name='test'), **kwargs)
+
+def test_embed_splits_batches_and_keeps_order(no_retry_wait):
+    texts = [f"チャンク {i} " * (i + 1) for i in range(7)]
+    with FakeEmbeddingServer() as server:
+        engine = make_engine(server, max_in_flight=3, batch_max_inputs=2)
+        completed = []
+        vectors = engine.embed(texts, on_batch_done=lambda indices, batch_vectors, tokens: completed.extend(indices))
+
+    # バッチは並列に送られるため、届く順序は問わない
+    assert sorted(len(inputs) for _, inputs in server.requests) == [1, 2, 2, 2]
+    assert sorted(text for _, inputs in server.requests for text in inputs) == sorted(texts)
+    assert sorted(completed) == list(range(len(texts)))
+    assert vectors.dtype == np.float32
+    np.testing.assert_allclose(vectors, np.array([fake_embedding(text) for text in texts], dtype=np.float32))
+
+def test_embed_splits_batches_by_token_budget(no_retry_wait):
+    texts = ["トークン数の予算でバッチを分ける " * 20] * 6
+    with FakeEmbeddingServer() as server:
+        engine = make_engine(server, batch_max_tokens=300, max_input_tokens=200)
+        vectors = engine.embed(texts)
+
+    assert len(server.requests) > 1
+    assert vectors.shape == (len(texts), 3)
+
+def test_embed_backs_off_after_429(no_retry_wait):
+    texts = ["429 のあとに再送する"]
+    with FakeEmbeddingServer(rate_limited=1) as server:
+        limiter = RateLimiter(6000, 10000000, name='test')
+        engine = AsyncEmbeddingEngine(MODEL, base_url=server.base_url, api_key='test', rate_limiter=limiter)
+        vectors = engine.embed(texts)
+
+    # 429 の1回と再送の1回。再送はヘッダーで指示された時間だけ待ってから行う
+    assert len(server.requests) == 2
+    assert server.requests[1][0] - server.requests[0][0] >= RESET_SECONDS * 0.9
+    # 流量は半分に絞られ、成功のたびに少しずつ戻る
+    assert limiter._rate_scale < 1.0
+    np.testing.assert_allclose(vectors, np.array([fake_embedding(texts[0])], dtype=np.float32))
+
+def test_embed_raises_after_repeated_429(no_retry_wait, monkeypatch):
+    monkeypatch.setattr(AsyncEmbeddingEngine._embed_batch.retry, 'stop', tenacity.stop_after_attempt(2))
+    with FakeEmbeddingServer(rate_limited=10) as server:
+        engine = make_engine(server)
+        with pytest.raises(Exception):
+            engine.embed(["ずっと 429 が返る"])
+
+    assert len(server.requests) == 2
@@ -0,0 +1,72 @@
+# token_counter.py
+import logging
+from collections import namedtuple
+from functools import lru_cache
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ENCODING = 'cl100k_base'
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        logger.warning(f"モデル {model} のエンコーディングが不明のため {DEFAULT_ENCODING} を使用します")
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+def count_tokens(text, model):
+    return len(get_encoding(model).encode(text, disallowed_special=()))
+
+def count_tokens_batch(texts, model):
+    encoded = get_encoding(model).encode_batch(list(texts), disallowed_special=())
+    return [len(tokens) for tokens in encoded]
+
+# OpenAI Embeddings API の上限 (1入力あたりのトークン数 / 1リクエストあたりの入力数・合計トークン数)
+MAX_EMBEDDING_INPUT_TOKENS = 8191
+MAX_EMBEDDING_BATCH_INPUTS = 2048
+MAX_EMBEDDING_BATCH_TOKENS = 300000
+
+TokenBatch = namedtuple('TokenBatch', ['indices', 'token_count'])
+
+def truncate_tokens(tokens, model, max_tokens):
+    """トークン列を先頭から max_tokens で切り詰めて文字列に戻す (同じ入力なら常に同じ結果になる)"""
+    text = get_encoding(model).decode(tokens[:max_tokens], errors='replace')
+    # 多バイト文字の途中で切れた場合の置換文字を取り除く
+    return text.rstrip('�')
+
+def make_token_batches(texts, model, max_tokens_per_batch=MAX_EMBEDDING_BATCH_TOKENS,
+                       max_inputs_per_batch=MAX_EMBEDDING_BATCH_INPUTS,
+                       max_tokens_per_input=MAX_EMBEDDING_INPUT_TOKENS):
+    """トークン数の合計が max_tokens_per_batch を超えないようにテキストをバッチに詰める
+
+    1入力の上限を超えるテキストは切り詰めた上で、(バッチのリスト, 送信用テキストのリスト) を返す
+    """
+    max_tokens_per_input = min(max_tokens_per_input, max_tokens_per_batch)
+    encoded = get_encoding(model).encode_batch(list(texts), disallowed_special=())
+
+    request_texts = list(texts)
+    batches = []
+    current_indices = []
+    current_tokens = 0
+    truncated = 0
+    for i, tokens in enumerate(encoded):
+        token_count = len(tokens)
+        if token_count > max_tokens_per_input:
+            request_texts[i] = truncate_tokens(tokens, model, max_tokens_per_input)
+            token_count = max_tokens_per_input
+            truncated += 1
+        if current_indices and (current_tokens + token_count > max_tokens_per_batch
+                                or len(current_indices) >= max_inputs_per_batch):
+            batches.append(TokenBatch(current_indices, current_tokens))
+            current_indices = []
+            current_tokens = 0
+        current_indices.append(i)
+        current_tokens += token_count
+    if current_indices:
+        batches.append(TokenBatch(current_indices, current_tokens))
+
+    if truncated:
+        logger.warning(f"{truncated} 件のテキストが1入力あたりの上限 {max_tokens_per_input} トークンを超えたため切り詰めました")
+    return batches, request_texts
@@ -103,17 +103,40 @@ def display_sidebar_info(config):
     st.sidebar.write(f"使用モデル (Embeddings): {config['embeddings_model']}")
     st.sidebar.write(f"Temperature: {config['temperature']}")
 
-def display_chat_messages(messages, data_source):
-    st.markdown('<div class="chat-container">', unsafe_allow_html=True)
-    for message in messages:
-        role_class = "user" if message['role'] == 'user' else "bot"
-        avatar_url = "https://via.placeholder.com/40/4CAF50/ffffff?text=You" if role_class == "user" else "https://via.placeholder.com/40/2196F3/ffffff?text=Bot"
-        st.markdown(f'''
+def display_search_filters(reference_type):
+    """検索対象を絞り込む条件をサイドバーに表示し、指定された条件だけを dict で返す"""
+    st.sidebar.subheader("検索の絞り込み")
+    filters = {}
+    source_prefix = st.sidebar.text_input("参照元 (前方一致)", key="filter_source_prefix")
+    if source_prefix:
+        filters['source_prefix'] = source_prefix
+    if reference_type == 'ファイル':
+        extensions = st.sidebar.multiselect("ファイルの種類", ['.pdf', '.docx', '.xlsx', '.xls', '.pptx', '.txt'], key="filter_extensions")
+        if extensions:
+            filters['extensions'] = extensions
+    title_contains = st.sidebar.text_input("タイトルに含む文字列", key="filter_title_contains")
+    if title_contains:
+        filters['title_contains'] = title_contains
+    if st.sidebar.checkbox("更新日で絞り込む", key="filter_by_modified"):
+        modified_after = st.sidebar.date_input("この日以降に更新", key="filter_modified_after")
+        filters['modified_after'] = modified_after
+    return filters
+
+def chat_message_html(role, content):
+    role_class = "user" if role == 'user' else "bot"
+    avatar_url = "https://via.placeholder.com/40/4CAF50/ffffff?text=You" if role_class == "user" else "https://via.placeholder.com/40/2196F3/ffffff?text=Bot"
+    return f'''
             <div class="chat-message {role_class}">
                 <img src="{avatar_url}" class="avatar" alt="{role_class}">
-                <div class="message-content">{message["content"]}</div>
+                <div class="message-content">{content}</div>
             </div>
-        ''', unsafe_allow_html=True)
+        '''
+
+def display_chat_messages(messages, data_source):
+    """会話を表示し、送信中のメッセージと受信中の回答を表示するためのコンテナを返す"""
+    st.markdown('<div class="chat-container">', unsafe_allow_html=True)
+    for message in messages:
+        st.markdown(chat_message_html(message['role'], message["content"]), unsafe_allow_html=True)
         if message['role'] == 'assistant' and 'detailed_sources' in message:
             with st.expander("詳細な参照元"):
                 for source in message['detailed_sources']:
@@ -125,11 +148,13 @@ def display_chat_messages(messages, data_source):
                         st.markdown(f"**最終更新日**: {last_modified.strftime('%Y-%m-%d %H:%M:%S')}")
                     st.markdown(f"**抜粋**: {source['content'][:200]}...")
                     st.markdown("---")
+    pending_container = st.container()
     st.markdown('</div>', unsafe_allow_html=True)
+    return pending_container
 
 def display_chat_interface(messages, data_source, reference_type, selected_source_name, conversation_count):
     # チャットメッセージを表示
-    display_chat_messages(messages, data_source)
+    pending_container = display_chat_messages(messages, data_source)
     
     # ダウンロードボタンを表示（メッセージがあり、かつ会話が開始された後のみ）
     if messages and conversation_count > 0:
@@ -152,7 +177,7 @@ def display_chat_interface(messages, data_source, reference_type, selected_sourc
         conversation_count=conversation_count
     )
     
-    return user_input, send_button
+    return user_input, send_button, pending_container
 
 def display_statistics(data_source):
     statistics = data_source.get_statistics()
@@ -29,7 +29,7 @@ def load_database_once(config, data_source):
         
         st.sidebar.success(message)
         
-        embeddings = OpenAIEmbeddings(model=config['embeddings_model'])
+        embeddings = OpenAIEmbeddings(model=config['embeddings_model'], dimensions=source_config.get('dimensions'))
         logger.info("OpenAIEmbeddingsが初期化されました")
         
         return df, index, role, embeddings
@@ -0,0 +1,340 @@
+# vector_sidecar.py
+import os
+import json
+import time
+import logging
+import numpy as np
+import pandas as pd
+from vector_store import create_faiss_index
+
+logger = logging.getLogger(__name__)
+
+VECTOR_FILE = 'vectors.bin'
+VECTOR_IDS_FILE = 'vector_ids.bin'
+VECTOR_META_FILE = 'vectors.json'
+# sq8 は次元ごとの最小値と刻み幅で8ビットに量子化して保存する
+SUPPORTED_DTYPES = ('float32', 'float16', 'sq8')
+WRITE_BATCH_ROWS = 65536
+REPLACE_RETRIES = 5
+REPLACE_RETRY_INTERVAL = 0.2
+
+def truncate_embeddings(vectors, dimensions):
+    """先頭 dimensions 次元に切り詰め、L2ノルムが1になるよう正規化し直す (text-embedding-3 の短縮と同じ処理)"""
+    vectors = np.asarray(vectors, dtype=np.float32)[:, :dimensions]
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+def _storage_dtype(dtype):
+    return np.uint8 if dtype == 'sq8' else np.dtype(dtype)
+
+def _fsync_write(path, data, mode):
+    with open(path, mode) as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+class VectorSidecar:
+    """チャンクIDと対応づけた生のベクトルを、連続した float32 / float16 / sq8 のファイルとして persist_directory に保持する
+
+    更新は追記のみで行い、vectors.json の count までの行を有効とする。
+    同じIDが複数回追記された場合は最後の行が有効で、インデックスから外れた行はコンパクションで取り除く。
+    """
+
+    def __init__(self, persist_directory, dtype='float32'):
+        if dtype not in SUPPORTED_DTYPES:
+            raise ValueError(f"サポートされていないベクトルの型です: {dtype}")
+        self.persist_directory = persist_directory
+        self.dtype = dtype
+        self.vector_file = os.path.join(persist_directory, VECTOR_FILE)
+        self.ids_file = os.path.join(persist_directory, VECTOR_IDS_FILE)
+        self.meta_file = os.path.join(persist_directory, VECTOR_META_FILE)
+        self._meta_mtime = self._current_meta_mtime()
+        self.meta = self._load_meta()
+        self._lookup = None
+
+    def _current_meta_mtime(self):
+        return os.path.getmtime(self.meta_file) if os.path.exists(self.meta_file) else None
+
+    def is_stale(self):
+        """別の処理で vectors.json が更新されていれば True"""
+        return self._current_meta_mtime() != self._meta_mtime
+
+    def _load_meta(self):
+        if not os.path.exists(self.meta_file):
+            return None
+        try:
+            with open(self.meta_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"ベクトルファイルのメタデータの読み込み中にエラーが発生しました: {self.meta_file}, エラー: {str(e)}")
+            return None
+
+    def _write_meta(self, meta):
+        temp_file = f"{self.meta_file}.tmp"
+        _fsync_write(temp_file, json.dumps(meta).encode('utf-8'), 'wb')
+        os.replace(temp_file, self.meta_file)
+        self.meta = meta
+        self._meta_mtime = self._current_meta_mtime()
+        self._lookup = None
+
+    def exists(self):
+        return self.meta is not None
+
+    @property
+    def count(self):
+        return self.meta['count'] if self.meta else 0
+
+    @property
+    def dim(self):
+        return self.meta['dim'] if self.meta else None
+
+    def ids(self):
+        if self.count == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.memmap(self.ids_file, dtype=np.int64, mode='r', shape=(self.count,))
+
+    def vectors(self):
+        """メモリマップで返す。sq8 の場合は読み出した行だけを float32 に復号するビューを返す"""
+        if self.count == 0:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        codes = np.memmap(self.vector_file, dtype=_storage_dtype(self.meta['dtype']), mode='r',
+                          shape=(self.count, self.dim))
+        if self.meta['dtype'] == 'sq8':
+            return _DecodedView(codes, self.meta)
+        return codes
+
+    def _encode(self, vectors, meta):
+        if meta['dtype'] != 'sq8':
+            return np.ascontiguousarray(vectors, dtype=meta['dtype'])
+        vmin = np.asarray(meta['sq_min'], dtype=np.float32)
+        scale = np.asarray(meta['sq_scale'], dtype=np.float32)
+        codes = np.rint((np.asarray(vectors, dtype=np.float32) - vmin) / scale)
+        return np.clip(codes, 0, 255).astype(np.uint8)
+
+    def _sq8_ranges(self, vectors):
+        vmin = np.full(vectors.shape[1], np.inf, dtype=np.float32)
+        vmax = np.full(vectors.shape[1], -np.inf, dtype=np.float32)
+        for start in range(0, vectors.shape[0], WRITE_BATCH_ROWS):
+            batch = np.asarray(vectors[start:start + WRITE_BATCH_ROWS], dtype=np.float32)
+            vmin = np.minimum(vmin, batch.min(axis=0))
+            vmax = np.maximum(vmax, batch.max(axis=0))
+        scale = (vmax - vmin) / 255.0
+        scale[scale == 0] = 1.0
+        return {'sq_min': vmin.tolist(), 'sq_scale': scale.tolist()}
+
+    def _exceeds_sq8_range(self, vectors, meta):
+        """保存済みの sq8 の範囲から刻み幅の半分を超えてはみ出す値があれば True"""
+        vmin = np.asarray(meta['sq_min'], dtype=np.float32)
+        scale = np.asarray(meta['sq_scale'], dtype=np.float32)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return bool(((vectors < vmin - scale / 2) | (vectors > vmin + scale * 255.5)).any())
+
+    def _rewrite_with(self, ids, vectors):
+        """保存済みの行の後ろに ids, vectors を加えた全体を、範囲を求め直して書き直す"""
+        all_ids = np.concatenate([np.array(self.ids()), ids])
+        view = AppendedView(self.vectors(), np.asarray(vectors, dtype=np.float32))
+        staged = self._write_temp(all_ids, view)
+        # 置き換える前に元のファイルのメモリマップを閉じる
+        del view
+        self._replace_files(*staged)
+
+    def append(self, ids, vectors):
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        meta = dict(self.meta) if self.meta else {'dim': int(vectors.shape[1]), 'dtype': self.dtype, 'count': 0}
+        if vectors.shape[1] != meta['dim']:
+            raise ValueError(f"ベクトルの次元が一致しません: {vectors.shape[1]} != {meta['dim']}")
+        if meta['dtype'] == 'sq8' and 'sq_min' not in meta:
+            meta.update(self._sq8_ranges(vectors))
+        elif meta['dtype'] == 'sq8' and self._exceeds_sq8_range(vectors, meta):
+            # そのまま符号化すると範囲外の値が丸められるため、範囲を広げて全体を符号化し直す
+            logger.warning(f"sq8 の範囲外の値を含むため、範囲を広げてベクトルファイルを書き直します: {self.vector_file}")
+            self._rewrite_with(ids, vectors)
+            return
+        vectors = self._encode(vectors, meta)
+        row_bytes = meta['dim'] * np.dtype(_storage_dtype(meta['dtype'])).itemsize
+        # 前回の追記が途中で中断した場合に備え、有効な行数までファイルを切り詰めてから追記する
+        for path, data, valid_bytes in ((self.vector_file, vectors, meta['count'] * row_bytes),
+                                        (self.ids_file, ids, meta['count'] * 8)):
+            with open(path, 'ab') as f:
+                f.truncate(valid_bytes)
+                f.write(data.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+        meta['count'] += len(ids)
+        self._write_meta(meta)
+        logger.info(f"ベクトルファイルに {len(ids)} 件を追記しました (合計 {meta['count']} 件)")
+
+    def write(self, ids, vectors):
+        """ベクトルファイルを書き直す。vectors はメモリマップでもよく、分割して書き出す"""
+        self._replace_files(*self._write_temp(ids, vectors))
+
+    def _write_temp(self, ids, vectors):
+        """一時ファイルに書き出し、(ids, メタデータ) を返す。置き換えは _replace_files で行う"""
+        ids = np.ascontiguousarray(ids, dtype=np.int64)
+        dim = int(vectors.shape[1])
+        meta = {'dim': dim, 'dtype': self.dtype, 'count': len(ids)}
+        if self.dtype == 'sq8' and len(ids) > 0:
+            # 範囲を求める1回目と符号化する2回目で、行列を2回走査する
+            meta.update(self._sq8_ranges(vectors))
+        try:
+            with open(f"{self.vector_file}.tmp", 'wb') as f:
+                for start in range(0, len(ids), WRITE_BATCH_ROWS):
+                    f.write(self._encode(vectors[start:start + WRITE_BATCH_ROWS], meta).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            _fsync_write(f"{self.ids_file}.tmp", ids.tobytes(), 'wb')
+        except Exception:
+            self._remove_temp_files()
+            raise
+        return ids, meta
+
+    def _replace_files(self, ids, meta):
+        """一時ファイルで置き換える。呼び出し側は元のファイルのメモリマップを閉じておくこと
+
+        Windows では開いているメモリマップのファイルを置き換えられないため、
+        検索中の読み出しが終わるのを少し待ってやり直す
+        """
+        try:
+            for path in (self.vector_file, self.ids_file):
+                for attempt in range(REPLACE_RETRIES):
+                    try:
+                        os.replace(f"{path}.tmp", path)
+                        break
+                    except PermissionError:
+                        if attempt == REPLACE_RETRIES - 1:
+                            raise
+                        time.sleep(REPLACE_RETRY_INTERVAL)
+            self._write_meta(meta)
+            logger.info(f"ベクトルファイルを保存しました: {self.vector_file} ({len(ids)} 件, {self.dtype})")
+        finally:
+            self._remove_temp_files()
+
+    def _remove_temp_files(self):
+        for temp_file in (f"{self.vector_file}.tmp", f"{self.ids_file}.tmp"):
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+
+    def _latest_mask(self):
+        return ~pd.Index(self.ids()).duplicated(keep='last')
+
+    def positions_for_ids(self, ids):
+        """IDに対応する行位置を返す (見つからないIDは-1)"""
+        if self._lookup is None:
+            latest = np.flatnonzero(self._latest_mask())
+            self._lookup = (pd.Index(np.asarray(self.ids())[latest]), latest)
+        lookup, latest = self._lookup
+        found = lookup.get_indexer(np.asarray(ids, dtype=np.int64))
+        return np.where(found >= 0, latest[found], -1)
+
+    def get(self, ids):
+        """IDの順にベクトルを float32 で返す"""
+        positions = self.positions_for_ids(ids)
+        if (positions < 0).any():
+            raise KeyError(f"ベクトルファイルに存在しないIDがあります: {int((positions < 0).sum())} 件")
+        return np.asarray(self.vectors()[positions], dtype=np.float32)
+
+    def truncate(self, dimensions):
+        """保存済みのベクトルを dimensions 次元に切り詰めて正規化し直し、書き直す"""
+        if not self.exists() or dimensions >= self.dim:
+            return
+        logger.info(f"ベクトルを {self.dim} 次元から {dimensions} 次元に切り詰めます: {self.vector_file}")
+        view = TruncatedView(self.vectors(), dimensions)
+        staged = self._write_temp(np.array(self.ids()), view)
+        # 置き換える前に元のファイルのメモリマップを閉じる
+        del view
+        self._replace_files(*staged)
+
+    def dead_ratio(self, live_count):
+        return 1.0 - live_count / self.count if self.count else 0.0
+
+    def compact(self, live_ids):
+        """live_ids に含まれない行と、同じIDの古い行を取り除いて書き直す"""
+        if not self.exists():
+            return
+        keep = self._latest_mask() & np.isin(self.ids(), np.asarray(live_ids, dtype=np.int64))
+        if keep.all() and self.meta['dtype'] == self.dtype:
+            return
+        positions = np.flatnonzero(keep)
+        ids = np.array(self.ids()[positions])
+        removed = self.count - len(positions)
+        view = RowView(self.vectors(), positions)
+        staged = self._write_temp(ids, view)
+        # 置き換える前に元のファイルのメモリマップを閉じる
+        del view
+        self._replace_files(*staged)
+        logger.info(f"ベクトルファイルをコンパクションしました: {removed} 件を削除, 残り {len(ids)} 件")
+
+class _DecodedView:
+    """sq8 の符号をスライスやインデックスで読み出したときに float32 へ復号する"""
+
+    def __init__(self, codes, meta):
+        self.codes = codes
+        self.shape = codes.shape
+        self.vmin = np.asarray(meta['sq_min'], dtype=np.float32)
+        self.scale = np.asarray(meta['sq_scale'], dtype=np.float32)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        return self.codes[item].astype(np.float32) * self.scale + self.vmin
+
+class TruncatedView:
+    """読み出した行を truncate_embeddings で切り詰めて返す"""
+
+    def __init__(self, source, dimensions):
+        self.source = source
+        self.dimensions = dimensions
+        self.shape = (source.shape[0], dimensions)
+
+    def __getitem__(self, item):
+        return truncate_embeddings(self.source[item], self.dimensions)
+
+class RowView:
+    """メモリマップされた行列の一部の行を、スライスで分割して読めるように見せる"""
+
+    def __init__(self, source, positions):
+        self.source = source
+        self.positions = positions
+        self.shape = (len(positions), source.shape[1])
+
+    def __getitem__(self, item):
+        return self.source[self.positions[item]]
+
+class AppendedView:
+    """メモリマップされた行列の後ろに追加の行をつなげたものを、スライスで読めるように見せる"""
+
+    def __init__(self, source, extra):
+        self.source = source
+        self.extra = extra
+        self.shape = (source.shape[0] + extra.shape[0], extra.shape[1])
+
+    def __getitem__(self, item):
+        start, stop, _ = item.indices(self.shape[0])
+        split = self.source.shape[0]
+        parts = []
+        if start < split:
+            parts.append(np.asarray(self.source[start:min(stop, split)], dtype=np.float32))
+        if stop > split:
+            parts.append(self.extra[max(start - split, 0):stop - split])
+        return np.vstack(parts) if parts else np.empty((0, self.shape[1]), dtype=np.float32)
+
+def backfill_from_index(sidecar, index, ids, batch_size=WRITE_BATCH_ROWS):
+    """ベクトルファイルのない既存データベース向けに、インデックスからベクトルを復元して書き出す
+
+    IVF-PQ などの量子化インデックスから復元したベクトルは近似値になる
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    logger.info(f"インデックスからベクトルを復元してベクトルファイルを作成します: {len(ids)} 件")
+    for start in range(0, len(ids), batch_size):
+        batch_ids = ids[start:start + batch_size]
+        sidecar.append(batch_ids, index.reconstruct_batch(batch_ids))
+
+def rebuild_index_from_sidecar(sidecar, live_ids, index_type='flat', index_options=None):
+    """エンベディングをやり直さずに、保存済みのベクトルからインデックスを作り直す (再学習を含む)"""
+    sidecar.compact(live_ids)
+    ids = np.array(sidecar.ids())
+    return create_faiss_index(sidecar.vectors(), ids, index_type=index_type, index_options=index_options)
@@ -1,27 +1,438 @@
 # vector_store.py
 import faiss
+import hashlib
+import json
+import numpy as np
 import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
-import base64
 import os
-import shutil
 import logging
 import uuid
+import threading
+import weakref
+from chunk_store import ChunkStore
 
 logger = logging.getLogger(__name__)
 
-def create_faiss_index(vectors):
+TOMBSTONE_FILE = 'tombstones.npy'
+
+def make_chunk_ids(sources, contents):
+    """(ソース, ソース内の通し番号, 本文) から安定した63ビットのチャンクIDを生成する"""
+    ids = np.empty(len(sources), dtype=np.int64)
+    ordinals = {}
+    for i, (source, content) in enumerate(zip(sources, contents)):
+        ordinal = ordinals.get(source, 0)
+        ordinals[source] = ordinal + 1
+        digest = hashlib.blake2b(f"{source}\0{ordinal}\0{content}".encode('utf-8'), digest_size=8).digest()
+        # FAISSは負のIDを無効値として扱うため最上位ビットを落とす
+        ids[i] = int.from_bytes(digest, 'little') & 0x7FFFFFFFFFFFFFFF
+    return ids
+
+def index_by_chunk_id(df):
+    """chunk_id列をデータフレームのインデックスにして、FAISSのIDから行位置を引けるようにする"""
+    if 'chunk_id' in df.columns:
+        df.index = pd.Index(df['chunk_id'].to_numpy(dtype=np.int64))
+    return df
+
+def positions_for_ids(df, ids):
+    """FAISSの検索結果のIDをデータフレームの行位置に変換する (見つからないIDは-1)"""
+    if isinstance(df, ChunkStore):
+        return df.positions_for_ids(ids)
+    ids = np.asarray(ids, dtype=np.int64)
+    if 'chunk_id' not in df.columns:
+        return ids
+    return df.index.get_indexer(ids)
+
+def take_rows(df, positions):
+    """行位置の行をデータフレームとして取り出す (ChunkStore の場合は該当行だけを読み出す)"""
+    if isinstance(df, ChunkStore):
+        return df.take(positions)
+    return df.iloc[positions]
+
+# 自動選択のしきい値 (ベクトル数)
+AUTO_FLAT_MAX_VECTORS = 50000
+AUTO_IVF_FLAT_MAX_VECTORS = 1000000
+# IVF の学習には1クラスタあたり39点以上が必要。これより少ない場合は Flat を使う
+MIN_TRAINING_POINTS_PER_CENTROID = 39
+TRAINING_POINTS_PER_CENTROID = 64
+INDEX_TYPES = ('flat', 'ivf_flat', 'ivf_pq', 'hnsw')
+# ベクトルの符号化方式。none は float32 のまま、fp16 は半精度、sq8 は次元ごとの8ビットスカラー量子化
+QUANTIZATIONS = ('none', 'fp16', 'sq8', 'pq')
+# PQ / SQ の学習に使うサンプル数の下限
+MIN_TRAINING_SAMPLE = 100000
+INDEX_PARAMS_SUFFIX = '.params.json'
+# Windows ではメモリマップ中のファイルを置き換えられないため、既定ではメモリマップを使わない
+DEFAULT_INDEX_MMAP = os.name != 'nt'
+
+class IndexSideTable:
+    """FAISS のインデックスごとの付随情報を、インデックスの外で保持する
+
+    SWIG のオブジェクトには faiss 1.13 以降 Python の属性を追加できないため、id をキーにして保持する。
+    id の再利用で別のインデックスの情報を返さないよう、弱参照で本人か確かめ、破棄されたら取り除く。
+    弱参照に対応しない版では、インデックスへの参照を一緒に保持する
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, index, default=None):
+        with self._lock:
+            entry = self._entries.get(id(index))
+        if entry is None or entry[0]() is not index:
+            return default
+        return entry[1]
+
+    def set(self, index, value):
+        key = id(index)
+        try:
+            ref = weakref.ref(index, lambda _, key=key: self._discard(key))
+        except TypeError:
+            ref = lambda index=index: index
+        with self._lock:
+            self._entries[key] = (ref, value)
+
+    def _discard(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0]() is None:
+                del self._entries[key]
+
+# インデックスの種類・検索時のパラメータ・エンベディングの情報 (.params.json に保存する内容)
+_index_params = IndexSideTable()
+# メモリマップで読み込んだ読み取り専用のインデックスの、読み込み元のファイル
+_mmap_paths = IndexSideTable()
+
+def _pq_subquantizers(dim):
+    for m in (64, 48, 32, 24, 16, 8):
+        if dim % m == 0:
+            return m
+    return 1
+
+def _select_quantization(params, n, overrides):
+    quantization = overrides.get('quantization') or 'none'
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"不明な量子化の種類です: {quantization}")
+    if params['type'] == 'ivf_pq':
+        # IVF-PQ は常に PQ で符号化する
+        return params
+    if quantization == 'pq':
+        nbits = overrides.get('pq_nbits') or 8
+        if n < (1 << nbits) * MIN_TRAINING_POINTS_PER_CENTROID:
+            logger.info(f"ベクトル数 ({n}) が PQ の学習には少ないため、8ビットのスカラー量子化を使用します")
+            quantization = 'sq8'
+        else:
+            params['pq_m'] = overrides.get('pq_m') or _pq_subquantizers(params['dim'])
+            params['pq_nbits'] = nbits
+    if quantization != 'none':
+        params['quantization'] = quantization
+    return params
+
+def select_index_params(n, dim, index_type='auto', overrides=None):
+    """ベクトル数と次元からインデックスの種類とパラメータ (nlist, nprobe, M, efSearch, 量子化など) を決める
+
+    overrides に指定した値は自動で決めた値より優先する
+    """
+    overrides = {k: v for k, v in (overrides or {}).items() if v is not None}
+    return _select_quantization(_select_structure(n, dim, index_type, overrides), n, overrides)
+
+def _select_structure(n, dim, index_type, overrides):
+    if index_type == 'auto':
+        if n < AUTO_FLAT_MAX_VECTORS:
+            index_type = 'flat'
+        elif n < AUTO_IVF_FLAT_MAX_VECTORS:
+            index_type = 'ivf_flat'
+        else:
+            index_type = 'ivf_pq'
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"不明なインデックスの種類です: {index_type}")
+
+    params = {'type': index_type, 'dim': int(dim)}
+    if index_type in ('ivf_flat', 'ivf_pq'):
+        nlist = overrides.get('nlist') or int(4 * np.sqrt(n))
+        nlist = max(1, min(nlist, n // MIN_TRAINING_POINTS_PER_CENTROID))
+        if nlist < 2:
+            logger.info(f"ベクトル数 ({n}) が IVF の学習には少ないため、Flat インデックスを使用します")
+            return {'type': 'flat', 'dim': int(dim)}
+        params['nlist'] = nlist
+        params['nprobe'] = min(nlist, overrides.get('nprobe') or max(8, nlist // 16))
+    if index_type == 'ivf_pq':
+        params['pq_m'] = overrides.get('pq_m') or _pq_subquantizers(dim)
+        params['pq_nbits'] = overrides.get('pq_nbits') or 8
+        if n < (1 << params['pq_nbits']) * MIN_TRAINING_POINTS_PER_CENTROID:
+            logger.info(f"ベクトル数 ({n}) が PQ の学習には少ないため、IVF-Flat インデックスを使用します")
+            params['type'] = 'ivf_flat'
+            del params['pq_m'], params['pq_nbits']
+    if index_type == 'hnsw':
+        params['hnsw_m'] = overrides.get('hnsw_m') or 32
+        params['ef_construction'] = overrides.get('ef_construction') or 80
+        params['ef_search'] = overrides.get('ef_search') or 64
+    return params
+
+def _encoding_string(params):
+    quantization = params.get('quantization', 'none')
+    if quantization == 'fp16':
+        return "SQfp16"
+    if quantization == 'sq8':
+        return "SQ8"
+    if quantization == 'pq' or params['type'] == 'ivf_pq':
+        return f"PQ{params['pq_m']}x{params['pq_nbits']}"
+    return "Flat"
+
+def _factory_string(params):
+    if params['type'] in ('ivf_flat', 'ivf_pq'):
+        return f"IVF{params['nlist']},{_encoding_string(params)}"
+    if params['type'] == 'hnsw':
+        return f"HNSW{params['hnsw_m']},{_encoding_string(params)}"
+    return _encoding_string(params)
+
+def _training_size(params, n):
+    return min(n, max(params.get('nlist', 0) * TRAINING_POINTS_PER_CENTROID, MIN_TRAINING_SAMPLE))
+
+def _training_sample(vectors, sample_size):
+    n = vectors.shape[0]
+    if sample_size >= n:
+        return np.ascontiguousarray(vectors[:n], dtype=np.float32)
+    # メモリマップされた行列から読む量を減らすため、行番号を昇順に並べて取り出す
+    rows = np.sort(np.random.default_rng(0).choice(n, size=sample_size, replace=False))
+    return np.ascontiguousarray(vectors[rows], dtype=np.float32)
+
+def apply_search_params(index, params):
+    """保存されたパラメータから検索時の設定 (nprobe / efSearch) を復元する"""
+    if not params:
+        return index
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and params.get('nprobe'):
+        ivf.nprobe = params['nprobe']
+    if params.get('type') == 'hnsw' and params.get('ef_search'):
+        inner = faiss.downcast_index(index.index) if hasattr(index, 'id_map') else index
+        inner.hnsw.efSearch = params['ef_search']
+    _index_params.set(index, dict(params))
+    return index
+
+def _build_empty_index(params):
+    index = faiss.index_factory(params['dim'], _factory_string(params))
+    if params['type'] == 'hnsw':
+        index.hnsw.efConstruction = params['ef_construction']
+    return index
+
+def create_faiss_index(vectors, ids=None, add_batch_size=65536, index_type='flat', index_options=None):
+    """ベクトルからインデックスを作成する。index_type は flat / ivf_flat / ivf_pq / hnsw / auto"""
     try:
         logger.info(f"ベクトルの形状: {vectors.shape}")
-        index = faiss.IndexFlatL2(vectors.shape[1])
-        index.add(vectors)
+        params = select_index_params(vectors.shape[0], vectors.shape[1], index_type, index_options)
+        logger.info(f"インデックスのパラメータ: {params}")
+        index = _build_empty_index(params)
+        if not index.is_trained:
+            sample = _training_sample(vectors, _training_size(params, vectors.shape[0]))
+            logger.info(f"インデックスを学習します: {sample.shape[0]} 件のサンプル")
+            index.train(sample)
+            del sample
+        if params['type'] in ('ivf_flat', 'ivf_pq'):
+            # IVF は自前でIDを保持する。ID指定での再構成と削除ができるようハッシュテーブルの直接マップを持たせる
+            index.set_direct_map_type(faiss.DirectMap.Hashtable)
+        elif ids is not None:
+            index = faiss.IndexIDMap2(index)
+        if ids is not None:
+            ids = np.asarray(ids, dtype=np.int64)
+        # メモリマップされた行列でも一度に全体を読み込まないよう、分割して追加する
+        for start in range(0, vectors.shape[0], add_batch_size):
+            batch = np.ascontiguousarray(vectors[start:start + add_batch_size], dtype=np.float32)
+            if ids is not None:
+                index.add_with_ids(batch, ids[start:start + add_batch_size])
+            else:
+                index.add(batch)
+        apply_search_params(index, params)
         logger.info(f"FAISSインデックスを作成しました。サイズ: {index.ntotal}")
         return index
     except Exception as e:
         logger.error(f"FAISSインデックスの作成中にエラーが発生しました: {str(e)}", exc_info=True)
         raise
 
+def set_embedding_info(index, model, dimensions=None):
+    """インデックスのメタデータにエンベディングのモデルと次元数 (dimensions 指定時) を記録する"""
+    _index_params.set(index, dict(index_params_of(index), embeddings_model=model, dimensions=dimensions))
+    return index
+
+def index_params_of(index):
+    return _index_params.get(index) or {'type': 'flat', 'dim': int(index.d)}
+
+def has_chunk_ids(index):
+    return hasattr(index, 'id_map') or faiss.try_extract_index_ivf(index) is not None
+
+def remove_ids_from_index(index, ids):
+    """ids をインデックスから削除し、(インデックス, 削除件数) を返す
+
+    HNSW は削除に対応していないため、残すベクトルを取り出して同じパラメータで作り直す
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    if len(ids) == 0:
+        return index, 0
+    params = index_params_of(index)
+    if faiss.try_extract_index_ivf(index) is not None:
+        # ハッシュテーブルの直接マップを持つ IVF は IDSelectorArray での削除のみ対応している
+        return index, index.remove_ids(faiss.IDSelectorArray(len(ids), faiss.swig_ptr(ids)))
+    if params['type'] != 'hnsw':
+        return index, index.remove_ids(ids)
+    stored_ids = faiss.vector_to_array(index.id_map)
+    keep = ~np.isin(stored_ids, ids)
+    vectors = index.index.reconstruct_n(0, index.ntotal)[keep]
+    options = {k: v for k, v in params.items() if k not in ('type', 'dim')}
+    logger.info(f"HNSWインデックスを再構築します: {int(keep.sum())} 件")
+    rebuilt = create_faiss_index(vectors, stored_ids[keep], index_type='hnsw', index_options=options)
+    return apply_search_params(rebuilt, params), int((~keep).sum())
+
+def ensure_id_mapped(df, index):
+    """旧形式 (IndexFlatL2 + 行位置) のデータベースをチャンクID付きの形式に移行する"""
+    if 'chunk_id' in df.columns and has_chunk_ids(index):
+        return df, index
+    logger.info("チャンクIDのないデータベースをID付きの形式に移行します")
+    sources = df['source'] if 'source' in df.columns else df['metadata'].apply(lambda x: x['source'])
+    df = df.reset_index(drop=True)
+    df['chunk_id'] = make_chunk_ids(sources.tolist(), df['content'].tolist())
+    vectors = index.reconstruct_n(0, index.ntotal)
+    return index_by_chunk_id(df), create_faiss_index(vectors, df['chunk_id'].to_numpy())
+
+def _source_mask(df, sources):
+    existing_sources = df['source'] if 'source' in df.columns else df['metadata'].apply(lambda x: x['source'])
+    return existing_sources.isin(list(sources)).to_numpy()
+
+def ids_for_sources(df, sources):
+    return df['chunk_id'].to_numpy(dtype=np.int64)[_source_mask(df, sources)]
+
+def replace_source_chunks(df, index, sources, new_df, new_vectors, tombstones=None):
+    """sources に属する既存チャンクをインデックスとデータフレームの両方から削除し、新しいチャンクを追加する
+
+    tombstones を渡すと、インデックスに残っている削除済みIDも同時に取り除く
+    """
+    index = ensure_writable_index(index)
+    stale_mask = _source_mask(df, sources)
+    stale_ids = df['chunk_id'].to_numpy(dtype=np.int64)[stale_mask]
+    if tombstones is not None and len(tombstones) > 0:
+        stale_ids = np.concatenate([stale_ids, np.asarray(tombstones, dtype=np.int64)])
+    if len(stale_ids) > 0:
+        index, removed = remove_ids_from_index(index, stale_ids)
+        logger.info(f"変更されたソースの古いチャンクを削除しました: {removed} 件")
+
+    new_df = new_df.copy()
+    new_df['chunk_id'] = make_chunk_ids(new_df['source'].tolist(), new_df['content'].tolist())
+    if len(new_df) > 0:
+        index.add_with_ids(np.asarray(new_vectors, dtype=np.float32), new_df['chunk_id'].to_numpy())
+
+    df = pd.concat([df[~stale_mask], new_df], ignore_index=True)
+    return index_by_chunk_id(df), index
+
+def load_tombstones(persist_directory):
+    tombstone_file = os.path.join(persist_directory, TOMBSTONE_FILE)
+    if os.path.exists(tombstone_file):
+        return np.load(tombstone_file)
+    return np.empty(0, dtype=np.int64)
+
+def save_tombstones(persist_directory, ids):
+    tombstone_file = os.path.join(persist_directory, TOMBSTONE_FILE)
+    ids = np.unique(np.asarray(ids, dtype=np.int64))
+    if len(ids) == 0:
+        if os.path.exists(tombstone_file):
+            os.remove(tombstone_file)
+        return
+    temp_file = f"{tombstone_file}.tmp"
+    with open(temp_file, 'wb') as f:
+        np.save(f, ids)
+    os.replace(temp_file, tombstone_file)
+    logger.info(f"削除済みチャンクIDを保存しました: {len(ids)} 件")
+
+def drop_tombstoned_rows(df, tombstones):
+    """削除済み (tombstone) のチャンクをデータフレームから除外する。インデックス側のベクトルはコンパクションまで残る"""
+    if len(tombstones) == 0 or 'chunk_id' not in df.columns:
+        return df
+    return df[~np.isin(df['chunk_id'].to_numpy(), tombstones)]
+
+def compact_faiss_index(index, tombstones):
+    """削除済みIDを取り除いたインデックスのコピーを返す"""
+    index = ensure_writable_index(index)
+    params = index_params_of(index)
+    compacted = index if params['type'] == 'hnsw' else faiss.clone_index(index)
+    compacted, removed = remove_ids_from_index(compacted, tombstones)
+    apply_search_params(compacted, params)
+    logger.info(f"インデックスをコンパクションしました: {removed} 件を削除, 残り {compacted.ntotal} 件")
+    return compacted
+
+class VectorFileWriter:
+    """ベクトルを float32 の生データとしてファイルに追記し、あとからメモリマップで読めるようにする"""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.count = 0
+        self.dim = None
+        self._file = open(file_path, 'wb')
+
+    def append(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"ベクトルの次元が一致しません: {vectors.shape[1]} != {self.dim}")
+        self._file.write(vectors.tobytes())
+        self.count += vectors.shape[0]
+
+    def close(self):
+        if not self._file.closed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+    def open_memmap(self):
+        self.close()
+        if self.count == 0:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return np.memmap(self.file_path, dtype=np.float32, mode='r', shape=(self.count, self.dim))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class ChunkParquetWriter:
+    """チャンクの行をグループごとにParquetへ書き出す。close() するまで元のファイルは置き換えない"""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.temp_file_path = f"{file_path}.tmp"
+        self.rows = 0
+        self._writer = None
+
+    def write(self, df):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self.temp_file_path, table.schema)
+        self._writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            os.replace(self.temp_file_path, self.file_path)
+            logger.info(f"Parquetファイルを保存しました: {self.file_path} ({self.rows} 行)")
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        if os.path.exists(self.temp_file_path):
+            os.remove(self.temp_file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
 def save_to_parquet(df, file_path, is_web_source=False):
     try:
         # Webソースの場合、last_modified列を処理
@@ -30,17 +441,26 @@ def save_to_parquet(df, file_path, is_web_source=False):
         
         # ファイルソースの場合、last_modified列が存在しても無視
         
-        table = pa.Table.from_pandas(df)
-        pq.write_table(table, file_path)
+        # 行の対応はchunk_id列で保持するため、データフレームのインデックスは保存しない
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        # バックグラウンドのコンパクションと読み込みが競合しないよう、一時ファイルに書いてから置き換える
+        temp_file_path = f"{file_path}.tmp"
+        pq.write_table(table, temp_file_path)
+        os.replace(temp_file_path, file_path)
         logger.info(f"データフレームをParquetファイルとして保存しました: {file_path}")
     except Exception as e:
         logger.error(f"Parquetファイルの保存中にエラーが発生しました: {str(e)}", exc_info=True)
         raise
 
+def parquet_columns(file_path):
+    """データを読み込まずに列名だけを返す"""
+    return pq.read_schema(file_path).names
+
 def load_from_parquet(file_path, is_web_source=False):
     try:
         df = pd.read_parquet(file_path)
         df['page'] = df['page'].astype(str)
+        index_by_chunk_id(df)
         
         # Webソースの場合、last_modified列を処理
         if is_web_source and 'last_modified' in df.columns:
@@ -54,52 +474,102 @@ def load_from_parquet(file_path, is_web_source=False):
         logger.error(f"Parquetファイルの読み込み中にエラーが発生しました: {str(e)}", exc_info=True)
         raise
 
-def save_faiss_index(index, file_path):
-    temp_file_path = None
+def save_index_params(index, file_path):
+    """インデックスの種類と検索時のパラメータをインデックスファイルの隣に JSON で保存する"""
+    params_file = f"{file_path}{INDEX_PARAMS_SUFFIX}"
+    temp_file = f"{params_file}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(dict(index_params_of(index), ntotal=int(index.ntotal)), f, ensure_ascii=False, indent=2)
+    os.replace(temp_file, params_file)
+
+def load_index_params(file_path):
+    params_file = f"{file_path}{INDEX_PARAMS_SUFFIX}"
+    if not os.path.exists(params_file):
+        return None
     try:
-        unique_id = uuid.uuid4().hex
-        encoded_file_path = base64.urlsafe_b64encode(f"{file_path}_{unique_id}".encode('utf-8')).decode('utf-8')
-        temp_directory = "C:\\ref_file\\temp_faiss"
-        temp_file_path = os.path.join(temp_directory, encoded_file_path)
+        with open(params_file, 'r', encoding='utf-8') as f:
+            params = json.load(f)
+        params.pop('ntotal', None)
+        logger.info(f"インデックスのパラメータを読み込みました: {params}")
+        return params
+    except Exception as e:
+        logger.error(f"インデックスのパラメータの読み込み中にエラーが発生しました: {params_file}, エラー: {str(e)}")
+        return None
 
-        os.makedirs(temp_directory, exist_ok=True)
+def index_version(file_path):
+    """インデックスの内容が変わるたびに変わる文字列。インデックスの保存と tombstone の記録のどちらでも変わる"""
+    parts = []
+    for path in (file_path, os.path.join(os.path.dirname(file_path), TOMBSTONE_FILE)):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            parts.append(f"{stat.st_mtime_ns}-{stat.st_size}")
+        else:
+            parts.append("none")
+    return ":".join(parts)
 
-        logger.info(f"FAISSインデックスを一時ディレクトリに保存します: {temp_file_path}")
-        faiss.write_index(index, temp_file_path)
-        logger.info(f"FAISSインデックスの保存に成功しました: {temp_file_path}")
+def _is_ascii_path(file_path):
+    # Windows の FAISS はファイルパスを ANSI で開くため、日本語を含むパスは直接渡せない
+    return file_path.isascii()
 
-        shutil.move(temp_file_path, file_path)
-        logger.info(f"FAISSインデックスを一時ディレクトリから移動しました: {file_path}")
+def _mmap_io_flags():
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    # IndexFlat 系のコードをメモリマップするフラグは新しい FAISS にのみ存在する
+    return flags | getattr(faiss, 'IO_FLAG_MMAP_IFC', 0)
+
+def ensure_writable_index(index):
+    """メモリマップで読み込んだ読み取り専用のインデックスを、変更できるようにメモリへ読み込み直す"""
+    mmap_path = _mmap_paths.get(index)
+    if mmap_path is None:
+        return index
+    logger.info(f"インデックスを変更するため、メモリマップを使わずに読み込み直します: {mmap_path}")
+    return load_faiss_index(mmap_path, mmap=False)
+
+def save_faiss_index(index, file_path):
+    """同じディレクトリの一時ファイルに書き込み、fsync してから置き換える"""
+    temp_file_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_file_path, 'wb') as f:
+            writer = faiss.PyCallbackIOWriter(f.write)
+            faiss.write_index(index, writer)
+            del writer
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_file_path, file_path)
+        save_index_params(index, file_path)
+        logger.info(f"FAISSインデックスを保存しました: {file_path}")
     except Exception as e:
         logger.error(f"FAISSインデックスの保存中にエラーが発生しました: {str(e)}", exc_info=True)
         raise
     finally:
-        if temp_file_path and os.path.exists(temp_file_path):
+        if os.path.exists(temp_file_path):
             os.remove(temp_file_path)
             logger.info(f"一時ファイルを削除しました: {temp_file_path}")
 
-def load_faiss_index(file_path):
-    temp_file_path = None
+def load_faiss_index(file_path, mmap=DEFAULT_INDEX_MMAP):
+    """mmap=True のときはメモリマップで読み込み、ページキャッシュをプロセス間で共有する
+
+    メモリマップで読み込んだインデックスは読み取り専用のため、変更する前に ensure_writable_index を通す
+    """
     try:
-        encoded_file_path = base64.urlsafe_b64encode(file_path.encode('utf-8')).decode('utf-8')
-        temp_directory = "C:\\ref_file\\temp_faiss"
-        temp_file_path = os.path.join(temp_directory, encoded_file_path)
-
-        if os.path.exists(file_path):
-            os.makedirs(temp_directory, exist_ok=True)
-            
-            shutil.copy(file_path, temp_file_path)
-            logger.info(f"FAISSインデックスを一時ディレクトリにコピーしました: {temp_file_path}")
-
-            index = faiss.read_index(temp_file_path)
-            logger.info(f"FAISSインデックスを読み込みました: {temp_file_path}")
-            return index
-        else:
+        if not os.path.exists(file_path):
             raise FileNotFoundError(f"FAISSインデックスファイルが見つかりません: {file_path}")
+        params = load_index_params(file_path)
+
+        if mmap and _is_ascii_path(file_path):
+            try:
+                index = faiss.read_index(file_path, _mmap_io_flags())
+                _mmap_paths.set(index, file_path)
+                logger.info(f"FAISSインデックスをメモリマップで読み込みました: {file_path}")
+                return apply_search_params(index, params)
+            except Exception as e:
+                logger.info(f"メモリマップでの読み込みに対応していないため、通常の読み込みを行います: {str(e)}")
+
+        with open(file_path, 'rb') as f:
+            reader = faiss.PyCallbackIOReader(f.read)
+            index = faiss.read_index(reader)
+            del reader
+        logger.info(f"FAISSインデックスを読み込みました: {file_path}")
+        return apply_search_params(index, params)
     except Exception as e:
         logger.error(f"FAISSインデックスの読み込み中にエラーが発生しました: {str(e)}", exc_info=True)
         raise
-    finally:
-        if temp_file_path and os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
-            logger.info(f"一時ファイルを削除しました: {temp_file_path}")
\ No newline at end of file
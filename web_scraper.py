@@ -10,7 +10,8 @@ from datetime import datetime
 import logging
 from langchain.schema import Document
 from langchain_openai import OpenAIEmbeddings
-from vector_store import create_faiss_index, save_to_parquet, save_faiss_index, load_faiss_index, load_from_parquet
+from vector_store import create_faiss_index, save_to_parquet, save_faiss_index, load_faiss_index, load_from_parquet, DEFAULT_INDEX_MMAP, set_embedding_info
+from vector_sidecar import VectorSidecar
 from file_cache import check_file_changes, save_file_hashes
 from role_generator import generate_role_from_db
 
@@ -178,9 +179,9 @@ def scrape_website(url, config, last_crawl_time=None):
         logger.info("ウェブサイトに変更がないため、既存のデータベースを使用します。")
         try:
             df = pd.read_parquet(parquet_file)
-            index = load_faiss_index(faiss_index_file)
+            index = load_faiss_index(faiss_index_file, mmap=config.get('index_mmap', DEFAULT_INDEX_MMAP))
             role = generate_role_from_db(df, config)
-            embeddings = OpenAIEmbeddings(model=config['embeddings_model'])
+            embeddings = OpenAIEmbeddings(model=config['embeddings_model'], dimensions=config.get('dimensions'))
             logger.info("既存のデータベースを正常に読み込みました。")
             return df, index, role, embeddings, "既存のウェブデータベースを読み込みました。"
         except Exception as e:
@@ -226,7 +227,7 @@ def scrape_website(url, config, last_crawl_time=None):
         raise ValueError("embeddings_model が設定されていません。")
 
     logger.info(f"使用される embeddings_model: {embeddings_model}")
-    embeddings = OpenAIEmbeddings(model=embeddings_model)
+    embeddings = OpenAIEmbeddings(model=embeddings_model, dimensions=config.get('dimensions'))
 
     logger.info("埋め込みを作成します。")
     try:
@@ -253,8 +254,14 @@ def scrape_website(url, config, last_crawl_time=None):
 
     logger.info(f"FAISS インデックスを作成します: {faiss_index_file}")
     try:
-        index = create_faiss_index(np.array(vectors))
+        vectors = np.array(vectors, dtype=np.float32)
+        index = create_faiss_index(vectors, index_type=config.get('index_type', 'flat'),
+                                   index_options=config.get('index_options'))
+        set_embedding_info(index, embeddings_model, config.get('dimensions'))
         save_faiss_index(index, faiss_index_file)
+        # Webソースはチャンク位置をIDとして使う
+        VectorSidecar(config['persist_directory_web'], config.get('vector_dtype', 'float32')).write(
+            np.arange(len(vectors)), vectors)
         logger.info(f"FAISS インデックスを保存しました: {faiss_index_file}")
     except Exception as e:
         logger.error(f"FAISS インデックスの作成中にエラーが発生しました: {str(e)}")